@@ -0,0 +1,272 @@
+"""
+run.py
+Author: Ian Smith
+Description: End to end throughput benchmark of the server. For every queue depth a fresh server (Main without the CLI)
+is started in a scratch directory while paused, the given number of synthetic YAML + image submissions are dropped
+into rec, and once they are all queued processing is resumed and timed until every job is archived. segment.py is
+replaced by stub_segment.py and sftp/ssh by stub_transport.py, both with configurable latency, so the numbers are the
+server's own overhead on top of the configured model and network time.
+Usage: python benchmark/run.py --depths 1 10 100 1000 10000 [--seg-latency 0.05] [--net-latency 0.01]
+       [--net-handshake 2] [--json out.json]
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import constants  # noqa: E402  Patched in configure before the server modules that read it are imported
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="End to end throughput benchmark with a stub segmenter and transport")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="Queue depths to run, each depth is a separate run on a fresh server")
+    parser.add_argument("--seg-latency", type=float, default=0.0, help="Seconds the stub segmenter takes per image")
+    parser.add_argument("--net-latency", type=float, default=0.0, help="Seconds every stub sftp/ssh call takes")
+    parser.add_argument("--net-handshake", type=float, default=0.0,
+                        help="Extra seconds stub sftp/ssh calls take when they open their own connection")
+    parser.add_argument("--no-multiplex", action="store_true", default=False,
+                        help="Open a connection for every sftp/ssh call instead of sharing one per host")
+    parser.add_argument("--image-kb", type=int, default=64, help="Size of the synthetic images in KB")
+    parser.add_argument("--workers", type=int, default=constants.PROCESSING_WORKERS, help="Processing worker threads")
+    parser.add_argument("--cores-per-job", type=int, default=1, help="Cores reserved for each job")
+    parser.add_argument("--memory-per-job", type=float, default=0.1, help="Memory reserved for each job in GB")
+    parser.add_argument("--batch-size", type=int, default=constants.BATCH_SIZE, help="Max jobs per micro-batch")
+    parser.add_argument("--warm-workers", type=int, default=0, help="Warm segmentation workers, 0 for one-shot")
+    parser.add_argument("--result-cache", action="store_true", default=False, help="Turn the result cache on")
+    parser.add_argument("--timeout", type=float, default=3600, help="Max seconds a single depth may take")
+    parser.add_argument("--workdir", default=None, help="Directory the scratch directories are made in")
+    parser.add_argument("--keep", action="store_true", default=False, help="Keep the scratch directories")
+    parser.add_argument("--json", default=None, help="Also write the results to this file as JSON")
+    return parser
+
+
+def configure(args):
+    """
+    Points the server at the stubs and applies the benchmark settings, must run before the server modules are imported
+    :param args: Parsed arguments
+    :return: Directory with the sftp/ssh wrappers, to be put first on the PATH
+    """
+    constants.RAD_TIB_PATH_TO_ENV = sys.executable
+    constants.RAD_TIB_PATH_TO_START = os.path.join(BENCH_DIR, "stub_segment.py")
+    constants.RAD_TIB_CPU_CORES = args.cores_per_job
+    constants.RAD_TIB_MEMORY_GB = args.memory_per_job
+    constants.PROCESSING_WORKERS = args.workers
+    constants.BATCH_SIZE = args.batch_size
+    constants.WARM_WORKERS = args.warm_workers
+    constants.RESULT_CACHE = args.result_cache
+    constants.READY_STABLE_TIME = 0  # Submissions are renamed into rec complete
+    constants.SSH_MULTIPLEX = not args.no_multiplex
+    constants.SSH_CONTROL_DIR = tempfile.mkdtemp(prefix="bench-ssh-")
+
+    bin_dir = tempfile.mkdtemp(prefix="bench-bin-")
+    for command in ("sftp", "ssh"):
+        path = os.path.join(bin_dir, command)
+        with open(path, "w") as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+                sys.executable, os.path.join(BENCH_DIR, "stub_transport.py"), command))
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["BENCH_SEG_LATENCY"] = str(args.seg_latency)
+    os.environ["BENCH_NET_LATENCY"] = str(args.net_latency)
+    os.environ["BENCH_NET_HANDSHAKE"] = str(args.net_handshake)
+    os.environ["BENCH_REMOTE_DIR"] = os.path.join(bin_dir, "remote")
+    os.makedirs(os.environ["BENCH_REMOTE_DIR"])
+    return bin_dir
+
+
+def submit(index, image_bytes):
+    """
+    Drops one synthetic submission into rec, the image first and the yaml last like the VMS side does
+    Files are written outside rec and renamed in so the server never sees them half written
+    :param index: Number of the submission, makes the names and image content unique
+    :param image_bytes: Size of the image
+    :return: None
+    """
+    name = "BENCH{:06d}".format(index)
+    image = name + ".AIM"
+    data = {
+        constants.F_NAME: name,
+        constants.TARGET_IMAGE: image,
+        constants.JOB_TYPE: "radius_tibia_final",
+        "CLIENT_USERNAME": "bench",
+        "CLIENT_HOSTNAME": "localhost",
+        "CLIENT_DIR": "DK0:[MICROCT.DATA.BENCH]",
+        "FILE_AIM": "DK0:[MICROCT.DATA.BENCH]{}".format(image),
+        "FILE_CORT_MASK_AIM": "DK0:[MICROCT.DATA.BENCH]{}_CORT_MASK.AIM".format(name),
+        "FILE_TRAB_MASK_AIM": "DK0:[MICROCT.DATA.BENCH]{}_TRAB_MASK.AIM".format(name),
+    }
+    header = "{:016d}".format(index).encode()
+    with open(os.path.join(constants.TMP, image), "wb") as f:
+        f.write(header + b"\0" * max(image_bytes - len(header), 0))
+    os.rename(os.path.join(constants.TMP, image), os.path.join(constants.REC, image))
+    with open(os.path.join(constants.TMP, name + ".yaml"), "w") as f:
+        f.write("".join("{}: '{}'\n".format(k, v) for k, v in data.items()))
+    os.rename(os.path.join(constants.TMP, name + ".yaml"), os.path.join(constants.REC, name + ".yaml"))
+
+
+class RssSampler:
+    """
+    Samples the resident memory of the benchmark process in the background and keeps the peak
+    """
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_kb = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            try:
+                with open("/proc/self/status", "r") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            self.peak_kb = max(self.peak_kb, int(line.split()[1]))
+            except (OSError, ValueError, IndexError):
+                pass
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.peak_kb / 1024
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _wait(condition, deadline):
+    """
+    Polls a condition until it is true
+    :param condition: Function returning True when done
+    :param deadline: time.monotonic() value to give up at
+    :return: True if the condition became true before the deadline
+    """
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def run_depth(depth, args):
+    """
+    Runs the benchmark at one queue depth on a fresh server
+    :param depth: Number of submissions
+    :param args: Parsed arguments
+    :return: Dict of results
+    """
+    from job import JOB_CACHE
+    from main import Main
+    from metrics import METRICS
+
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix="bench-{}-".format(depth), dir=args.workdir)
+    os.chdir(work)
+    os.makedirs("logs")
+    JOB_CACHE.clear()
+    METRICS.reset()
+    server = None
+    try:
+        server = Main(cli=False)  # Starts paused
+        sampler = RssSampler()
+        cpu_self, cpu_children = _cpu_seconds(resource.RUSAGE_SELF), _cpu_seconds(resource.RUSAGE_CHILDREN)
+        deadline = time.monotonic() + args.timeout
+
+        start = time.monotonic()
+        for i in range(depth):
+            submit(i, args.image_kb * 1024)
+        submitted = time.monotonic()
+        ingested_all = _wait(lambda: len(server.job_queue) >= depth, deadline)
+        ingested = time.monotonic()
+
+        server.set_processing_state(False)
+
+        def finished():
+            counters = METRICS.summary()["counters"]
+            return counters.get("jobs_done", 0) + counters.get("jobs_failed", 0) >= depth
+
+        finished_all = ingested_all and _wait(finished, deadline)
+        end = time.monotonic()
+
+        summary = METRICS.summary()
+        result = {
+            "depth": depth,
+            "completed": finished_all,
+            "done": summary["counters"].get("jobs_done", 0),
+            "failed": summary["counters"].get("jobs_failed", 0),
+            "submit_seconds": submitted - start,
+            "ingest_seconds": ingested - start,
+            "process_seconds": end - ingested,
+            "ingest_jobs_per_second": depth / max(ingested - start, 1e-9),
+            "jobs_per_second": depth / max(end - ingested, 1e-9),
+            "server_cpu_seconds": _cpu_seconds(resource.RUSAGE_SELF) - cpu_self,
+            "stub_cpu_seconds": _cpu_seconds(resource.RUSAGE_CHILDREN) - cpu_children,
+            "peak_rss_mb": sampler.stop(),
+            "stages": summary["stages"],
+            "counters": summary["counters"],
+        }
+        result["server_cpu_ms_per_job"] = 1000 * result["server_cpu_seconds"] / max(depth, 1)
+        return result
+    finally:
+        if server is not None:
+            server.shutdown()
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+def _ms(stages, stage, key):
+    value = stages.get(stage, {}).get(key)
+    return "-" if value is None else "{:.1f}".format(value * 1000)
+
+
+def print_results(results):
+    columns = ["depth", "ok", "ingest/s", "jobs/s", "total p50", "total p95", "wait p50", "segment p50",
+               "transfer p50", "move p50", "cpu ms/job", "rss MB"]
+    print(("{:>8}" + "{:>13}" * (len(columns) - 1)).format(*columns))
+    for r in results:
+        s = r["stages"]
+        row = [r["depth"], "{}/{}".format(r["done"], r["depth"]), "{:.1f}".format(r["ingest_jobs_per_second"]),
+               "{:.1f}".format(r["jobs_per_second"]), _ms(s, "total", "p50"), _ms(s, "total", "p95"),
+               _ms(s, "queue_wait", "p50"), _ms(s, "segment", "p50") if "segment" in s else _ms(s, "segment_batch", "p50"),
+               _ms(s, "transfer", "p50"), _ms(s, "move", "p50"), "{:.2f}".format(r["server_cpu_ms_per_job"]),
+               "{:.0f}".format(r["peak_rss_mb"])]
+        print(("{:>8}" + "{:>13}" * (len(row) - 1)).format(*row))
+    print("Latencies in ms, wait is the time on the queue after processing was resumed for the first jobs and "
+          "includes the whole backlog for the last ones")
+
+
+def main():
+    args = create_parser().parse_args()
+    bin_dir = configure(args)
+    results = []
+    try:
+        for depth in args.depths:
+            result = run_depth(depth, args)
+            results.append(result)
+            if not result["completed"]:
+                print("Depth {} did not finish within {} seconds".format(depth, args.timeout), file=sys.stderr)
+    finally:
+        shutil.rmtree(bin_dir, ignore_errors=True)
+        shutil.rmtree(constants.SSH_CONTROL_DIR, ignore_errors=True)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    return 0 if all(r["completed"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""
+stub_segment.py
+Author: Ian Smith
+Description: Stand-in for HR-pQCT-Segmentation segment.py used by the benchmark. Takes the same arguments, sleeps for
+BENCH_SEG_LATENCY seconds per image and writes empty CORT and TRAB masks for every image matching the pattern into
+<dir>/masks, so the rest of the pipeline runs as it would after a real segmentation.
+Usage: python stub_segment.py <dir> <trained models> [--image-pattern <pattern>]
+"""
+import fnmatch
+import os
+import sys
+import time
+
+
+def main(argv):
+    directory = argv[0]
+    pattern = argv[argv.index("--image-pattern") + 1] if "--image-pattern" in argv else "*.aim"
+    latency = float(os.environ.get("BENCH_SEG_LATENCY", "0"))
+    images = [f for f in sorted(os.listdir(directory))
+              if fnmatch.fnmatch(f.lower(), pattern.lower()) and os.path.isfile(os.path.join(directory, f))]
+    if not images:
+        print("No images matching {} in {}".format(pattern, directory), file=sys.stderr)
+        return 1
+    masks = os.path.join(directory, "masks")
+    os.makedirs(masks, exist_ok=True)
+    for image in images:
+        time.sleep(latency)
+        stem = os.path.splitext(image)[0].upper()
+        for kind in ("CORT", "TRAB"):
+            with open(os.path.join(masks, "{}_{}_MASK.AIM".format(stem, kind)), "wb") as f:
+                f.write(b"\0" * 512)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
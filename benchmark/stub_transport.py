@@ -0,0 +1,96 @@
+"""
+stub_transport.py
+Author: Ian Smith
+Description: Local stand-in for the sftp and ssh commands used to send results back to OpenVMS, used by the benchmark.
+The benchmark puts wrappers named sftp and ssh on the PATH that call this script with the name they were called by.
+Every call sleeps for BENCH_NET_LATENCY seconds, calls that open a connection of their own also sleep for
+BENCH_NET_HANDSHAKE seconds. A master (ssh -M) creates its ControlPath as a plain file and calls with ControlMaster=no
+that find it skip the handshake, ssh -O check and exit look at and remove it. sftp checks that the files in its batch
+file exist and keeps the DCL procedures it puts in BENCH_REMOTE_DIR, ssh @<procedure> prints a successful status line
+for every step of the kept procedure like it would on VMS.
+Usage: python stub_transport.py <sftp|ssh> [arguments of the real command]
+"""
+import os
+import re
+import shlex
+import shutil
+import sys
+import time
+
+
+def _check_batch(path):
+    """
+    Checks that every file put by an sftp batch file exists
+    :param path: Path to the batch file
+    :return: 0 if every file exists, 1 otherwise
+    """
+    with open(path, "r") as f:
+        for line in f:
+            parts = shlex.split(line)
+            if len(parts) >= 2 and parts[0] == "put":
+                if not os.path.exists(parts[1]):
+                    print("sftp: {} not found".format(parts[1]), file=sys.stderr)
+                    return 1
+                if parts[1].upper().endswith(".COM") and os.environ.get("BENCH_REMOTE_DIR"):
+                    shutil.copy(parts[1], os.path.join(os.environ["BENCH_REMOTE_DIR"], os.path.basename(parts[1])))
+    return 0
+
+
+def _run_procedure(command):
+    """
+    Pretends to run a DCL procedure that was put earlier, every step succeeds
+    :param command: Remote command, @ followed by the VMS path of the procedure
+    :return: 0 if the procedure was found, 1 otherwise
+    """
+    name = re.split(r"[\]:]", command[1:])[-1]
+    path = os.path.join(os.environ.get("BENCH_REMOTE_DIR", ""), name)
+    if not os.path.isfile(path):
+        print("%DCL-E-OPENIN, error opening {}".format(command[1:]))
+        return 1
+    with open(path, "r") as f:
+        for step in re.findall(r"IPS_STEP (\w+)", f.read()):
+            print("IPS_STEP {} 1".format(step))
+    os.remove(path)
+    return 0
+
+
+def _option(args, name):
+    """
+    Gets the value of an -oName=value option
+    :param args: Arguments of the command
+    :param name: Name of the option
+    :return: Value, None if it was not given
+    """
+    prefix = "-o{}=".format(name)
+    for arg in args:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return None
+
+
+def main(argv):
+    command, args = os.path.basename(argv[0]), argv[1:]
+    control_path = _option(args, "ControlPath")
+    if "-O" in args:  # Control command to a master
+        exists = control_path is not None and os.path.exists(control_path)
+        if exists and args[args.index("-O") + 1] == "exit":
+            os.remove(control_path)
+        return 0 if exists else 255
+    multiplexed = _option(args, "ControlMaster") == "no" and control_path is not None and os.path.exists(control_path)
+    if not multiplexed:
+        time.sleep(float(os.environ.get("BENCH_NET_HANDSHAKE", "0")))
+    time.sleep(float(os.environ.get("BENCH_NET_LATENCY", "0")))
+    if "-M" in args:
+        open(control_path, "w").close()
+        return 0
+    if command == "ssh" and args and args[-1].startswith("@"):
+        return _run_procedure(args[-1])
+    if command == "sftp":
+        for arg in args:
+            if arg.startswith("-b") and len(arg) > 2:
+                return _check_batch(arg[2:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -18,6 +18,10 @@ Commands that can be used:
 -p, --pause: pauses the processing on the server. if there is a job currently running it will finish before pausing
 
 -u, --unpause: unpauses the server if it is paused
+
+-s <jobname>, --skip <jobname>: kills the processing of a running job, the job is moved to failed
+
+-S, --stats: shows latency percentiles of every stage and counters
 '''
 
 
@@ -117,6 +121,22 @@ def create_parser():
         default=False,
         help="Shows failed jobs within the last {} days".format(constants.TIME_TO_DELETE)
     )
+    parser.add_argument(
+        "-s",
+        "--skip",
+        metavar="JOBNAME",
+        action="store",
+        type=str,
+        default=None,
+        help="Kill the processing of a running job, the job is moved to failed"
+    )
+    parser.add_argument(
+        "-S",
+        "--stats",
+        action="store_true",
+        default=False,
+        help="Shows latency percentiles of every stage and counters"
+    )
     return parser
 
 
@@ -175,6 +195,14 @@ def handle_response(data):
             print("Processsing unpaused")
         elif data[1] == "already_unpaused":
             print("Processing is already unpaused, use -p to pause")
+    elif command == "stats":
+        print_stats(data[1])
+    elif command == "skip":
+        if data[1]:
+            print("Job Skipped:")
+            print_jobs(data[1])
+        else:
+            print("Job is not being processed")
     else:
         print("Please input a command")
     print()
@@ -191,6 +219,19 @@ def print_info(info):
         print("Client Name:\t\t{}@{}".format(info.data.get(ACCOUNT_NAME), info.data.get(CLIENT_ADDR)))
 
 
+def print_stats(stats):
+    print("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format("Stage", "Count", "Mean", "p50", "p95", "p99", "Max"))
+    for stage, s in sorted(stats["stages"].items()):
+        row = [s.get(k) for k in ("mean", "p50", "p95", "p99", "max")]
+        print("{:<16}{:>8}".format(stage, s["count"]) +
+              "".join("{:>10}".format("-" if v is None else "{:.3f}s".format(v)) for v in row))
+    print()
+    for name, count in sorted(stats["counters"].items()):
+        print("{}:\t\t{}".format(name, count))
+    for name, value in stats.get("gauges", {}).items():
+        print("{}:\t\t{}".format(name, value))
+
+
 def print_jobs(job_list):
     count = 0
     for job in job_list:
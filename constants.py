@@ -3,6 +3,7 @@ constants.py
 Author: Ian Smith
 Module to hold needed constants for this program
 """
+import os
 
 # Important Directories
 
@@ -14,16 +15,99 @@ DONE = 'processed'
 REC = 'rec'
 TMP = 'tmp'
 STATE = 'state'
-DIRS = [BATCHES, DEL, DEST, FAILED, DONE, REC, TMP, STATE]
-JOB_DIRS = [BATCHES, DEST, DONE, FAILED]
+OUTBOX = 'outbox'  # Segmented jobs waiting to be sent back, kept across restarts
+DIRS = [BATCHES, DEL, DEST, OUTBOX, FAILED, DONE, REC, TMP, STATE]
+JOB_DIRS = [BATCHES, DEST, OUTBOX, DONE, FAILED]
 
 PAUSED = True
 
 
+# rec directory monitoring, WATCH_MODE is either "inotify" or "poll" (inotify falls back to polling if unavailable)
+WATCH_MODE = "inotify"
+POLL_INTERVAL = 1  # Seconds between scans of rec when polling
+WATCH_TIMEOUT = 60  # Max seconds the monitor sleeps waiting for an event before checking on housekeeping
+CLEANUP_INTERVAL = 3600  # Seconds between cleanups of the failed and processed directories
+INGEST_WORKERS = 4  # Number of submissions from rec that are formatted in parallel
+
+
+# Upload readiness, a file in rec is complete once it is unchanged for READY_STABLE_TIME seconds or once a sidecar
+# marker file <file><READY_MARKER_EXT> exists (set READY_MARKER_EXT to None to only use the stability window)
+READY_STABLE_TIME = 2
+READY_MARKER_EXT = ".done"
+READY_CHECK_INTERVAL = 1  # Seconds between checks on submissions that are still uploading
+READY_TIMEOUT = 3600  # Seconds to wait on an incomplete submission before it is moved to failed
+
+
 # Time before a file gets deleted in days
 TIME_TO_DELETE = 7
 
 
+# Processing workers, jobs are only started while the CPU cores and memory they need are free
+PROCESSING_WORKERS = 4  # Max number of jobs processed at once
+JOB_CPU_CORES = 8  # Default cores reserved for a job, job types can ask for more or less in job_types.py
+JOB_MEMORY_GB = 8  # Default memory reserved for a job
+JOB_TIMEOUT = 2 * 3600  # Default max seconds a processing command may run before it is killed, 0 for no limit
+JOB_NICE = 5  # Nice level of processing commands so the server and CLI stay responsive
+JOB_MEMORY_RLIMIT_FACTOR = 2  # Data segment limit of a processing command as a multiple of its reserved memory
+MAX_QUEUE_SKIPS = 8  # Times a job that does not fit can be passed by smaller jobs behind it before they have to wait
+RESERVED_CORES = 1  # Cores left for the server itself and the rest of the system
+RESERVED_MEMORY_GB = 2  # Memory left for the server itself and the rest of the system
+
+
+# Pipeline stages after segmentation
+TRANSFER_WORKERS = 4  # Threads sending jobs back to the scanners, sends to different hosts run in parallel
+TRANSFER_HOST_CONCURRENCY = 2  # Max sends to one host at once, the VMS sshd can not take many sessions
+TRANSFER_HOST_LIMITS = {}  # Host -> max sends at once, overrides TRANSFER_HOST_CONCURRENCY for that host
+TRANSFER_QUEUE_SIZE = 8  # Segmented jobs waiting on their first transfer before segmentation stops taking new jobs
+TRANSFER_BATCH_SIZE = 10  # Max waiting jobs for the same host and directory sent in one sftp session, 1 to turn off
+
+
+# Transfer retries, a failed transfer is retried after an exponential backoff with jitter until the job has failed
+# TRANSFER_RETRY_LIMIT times or TRANSFER_RETRY_HOURS have passed since its first failure, only then is it moved to
+# failed. A host is considered down after BREAKER_THRESHOLD failures in a row, its jobs then wait without using up
+# their retries and one job is tried after the cool down to see if it is back
+TRANSFER_RETRY_LIMIT = 20
+TRANSFER_RETRY_HOURS = 72
+TRANSFER_BACKOFF_BASE = 30  # Seconds before the first retry, doubled for every retry after that
+TRANSFER_BACKOFF_MAX = 3600
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60  # Seconds a host is left alone before it is tried again, doubled while it stays down
+BREAKER_MAX_COOLDOWN = 1800
+
+
+# SSH to the VMS hosts, every sftp and ssh call to a host is multiplexed over one long lived master connection so the
+# slow key exchange is only done once. Masters close after SSH_IDLE_TIMEOUT seconds without use
+SSH_MULTIPLEX = True  # False to open a new connection for every command
+SSH_CONTROL_DIR = "/tmp/ip_server_ssh"  # Holds the master sockets, unix socket paths must stay under 108 characters
+SSH_IDLE_TIMEOUT = 600
+SSH_CHECK_INTERVAL = 60  # Seconds a master is trusted before it is checked again with ssh -O check
+SSH_CONNECT_TIMEOUT = 60
+SSH_ALIVE_INTERVAL = 30  # Seconds between keepalives, a connection is dropped after 3 go unanswered
+SSH_COMMAND_TIMEOUT = 1800  # Max seconds one sftp or ssh command may run before it is killed and the send retried
+SSH_RETRY_TIME = 300  # Seconds before a master is tried again after it failed to start, commands connect on their own
+VMS_SSH_OPTIONS = ['-oPort=22', '-oCiphers=3des-cbc', '-oKexAlgorithms=+diffie-hellman-group1-sha1',
+                   '-oHostKeyAlgorithms=+ssh-dss']  # Work with both ssh and sftp
+
+
+# Micro-batching, a worker that takes a job of a type with a batch method in job_types.py also takes up to
+# BATCH_SIZE - 1 more queued jobs of that type (waiting up to BATCH_WINDOW seconds for them) and segments them with one
+# invocation
+BATCH_SIZE = 4  # 1 to turn batching off
+BATCH_WINDOW = 1
+BATCH_IMAGE_EXT = ".aim"  # Only images with this extension are batched, others are processed on their own
+
+
+# Max number of jobs kept in the shared JobData cache
+JOB_CACHE_SIZE = 4096
+
+
+# Metrics, percentiles are taken over the latest METRICS_WINDOW durations of each stage and the stage times of every
+# finished job are appended to TIMINGS_FILE
+METRICS_WINDOW = 1000
+TIMINGS_FILE = STATE + '/timings.jsonl'
+TIMINGS_FILE_MAX_MB = 50  # Rotated to TIMINGS_FILE.1 past this size
+
+
 # Important Values from COM file
 DATE = "DATE"
 F_NAME = "FILE_FNAME"
@@ -33,6 +117,20 @@ EVAL_FEXT = "EVAL_FEXT"
 JOB_TYPE = "JOB_TYPE"
 
 
+# Processing stages recorded in the com file under STAGE, in the order they are completed
+STAGE = "STAGE"
+STAGE_INGESTED = "ingested"
+STAGE_SEGMENTED = "segmented"
+STAGE_TRANSFERRED = "transferred"
+STAGE_POST_PROCESSED = "post_processed"  # Masks fixed up and converted to GOBJ on the VMS side
+STAGES = [STAGE_INGESTED, STAGE_SEGMENTED, STAGE_TRANSFERRED, STAGE_POST_PROCESSED]
+
+
+# Transfer retry state recorded in the com file
+TRANSFER_ATTEMPTS = "TRANSFER_ATTEMPTS"  # Failed transfer attempts
+TRANSFER_FIRST_FAILURE = "TRANSFER_FIRST_FAILURE"  # Time of the first failed attempt, seconds since the epoch
+
+
 # Socket details for communicating from CLI to daemon
 ip_addr = "127.0.0.1"
 port = 4003
@@ -45,7 +143,10 @@ ERROR = "logs/error.log"
 
 
 # Checkpoint Files
-QUEUE_CHECKPOINT = '/state/queue.txt'
+QUEUE_JOURNAL = STATE + '/queue.journal'  # Append-only record of every change to the queue
+QUEUE_SNAPSHOT = STATE + '/queue.json'  # Queue state the journal is replayed on top of
+JOURNAL_COMPACT_AFTER = 1000  # Journal records written before a new snapshot is taken
+JOURNAL_FSYNC = True  # fsync every journal record, slower but no queue change is lost on a power failure
 PROCESS_CHECKPOINT = '/state/process.txt'
 
 
@@ -53,5 +154,28 @@ PROCESS_CHECKPOINT = '/state/process.txt'
 RAD_TIB_PATH_TO_ENV = r"/home/iangs/miniconda3/envs/bl_torch/bin/python"
 RAD_TIB_PATH_TO_START = r"/home/iangs/repos/HR-pQCT-Segmentation/segment.py"
 RAD_TIB_TRAINED_MODELS = "radius_tibia_final"
+RAD_TIB_CPU_CORES = JOB_CPU_CORES
+RAD_TIB_MEMORY_GB = JOB_MEMORY_GB  # segment.py needs several GB
+RAD_TIB_MAX_CONCURRENCY = 0  # 0 for no limit other than the resources
+RAD_TIB_TIMEOUT = JOB_TIMEOUT
+RAD_TIB_SEGMENTER_VERSION = None  # None to use the content hash of segment.py in result cache keys
+
+
+# Result cache, masks are stored by a hash of the image, job type, model and segmenter version and reused when an
+# identical scan is submitted or a job is restarted
+RESULT_CACHE = True
+MASK_PATTERNS = ["*_CORT_MASK.AIM", "*_TRAB_MASK.AIM"]  # Outputs of a job that are cached and sent back
+RESULT_CACHE_DIR = STATE + '/results'
+RESULT_CACHE_MAX_GB = 20
+
+
+# Warm segmentation workers keep segment.py's interpreter and libraries loaded between jobs, 0 to always start a new
+# interpreter per job. Workers are restarted after WARM_WORKER_MAX_JOBS jobs or once they use WARM_WORKER_MAX_RSS_GB
+WARM_WORKERS = 1
+WARM_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "seg_worker.py")
+WARM_WORKER_CACHE_WEIGHTS = True  # Keep model weights loaded with torch.load in memory while the file is unchanged
+WARM_WORKER_MAX_JOBS = 200
+WARM_WORKER_MAX_RSS_GB = 12
+WARM_WORKER_RETRY_TIME = 300  # Seconds before starting a worker is tried again after it failed
 
 
@@ -5,7 +5,8 @@ Description: Handles communication with the external cli python program
 """
 import os.path
 
-from job import JobData
+from job import get_job_data, set_stage
+from metrics import METRICS
 import constants, ip_utils
 
 import pickle
@@ -90,6 +91,10 @@ class CLI:
             self._handle_pause()
         elif command == "unpause":
             self._handle_unpause()
+        elif command == "skip":
+            self._skip_current(cmd[1])
+        elif command == "stats":
+            self._handle_stats()
 
 
     def _get_jobs(self):
@@ -98,9 +103,7 @@ class CLI:
         :return: None
         """
         jobs = self.queue.get_state()
-        if self.processor.current is not None:
-            jobs.insert(0, self.processor.current)
-        return jobs
+        return self.processor.get_running() + jobs
 
     @staticmethod
     def _jobs_from_dir(directory):
@@ -112,7 +115,7 @@ class CLI:
         job_pths = ip_utils.get_abs_paths(directory)
         jobs = []
         for path in job_pths:
-            jobs.append(JobData(path))
+            jobs.append(get_job_data(path))
         return jobs
 
     def _handle_jobs(self):
@@ -172,7 +175,8 @@ class CLI:
         """
         paths = ip_utils.get_abs_paths("processed")
         for path in paths:
-            if jobname.lower() == JobData(path).base_name.lower():
+            if jobname.lower() == get_job_data(path).base_name.lower():
+                set_stage(path, constants.STAGE_INGESTED)  # Restarted jobs are processed again from the start
                 self.queue.enqueue(path)
                 jbs = self._get_jobs()
                 self._send_to_cli(jbs, "restart")
@@ -184,10 +188,29 @@ class CLI:
         :param jobname: Job to be removed
         :return: None
         """
-        self.queue.remove_from_queue(jobname)
+        job_path = self.queue.remove_from_queue(jobname)
+        if job_path is not None:
+            self.file_manager.delete(job_path)
         jbs = self._get_jobs()
         self._send_to_cli(jbs, "delete")
         
+    def _handle_stats(self):
+        """
+        Handles the collection of stage latencies and counters and sends them to CLI
+        :return: None
+        """
+        stats = METRICS.summary()
+        stats["gauges"] = {
+            "queued": len(self.queue),
+            "running": len(self.processor.get_running()),
+            "awaiting transfer": len(self.main.transfer_queue),
+            "retrying transfer": self.main.transfer_queue.retrying(),
+            "sending": ", ".join("{} ({})".format(host, n) for host, n in
+                                 sorted(self.main.transfer_queue.sending().items())) or "none",
+            "hosts down": ", ".join(self.main.transfer_queue.hosts_down()) or "none",
+        }
+        self._send_to_cli(stats, "stats")
+
     def _handle_pause(self):
         if self.main.paused == False:
             self.main.set_processing_state(True)
@@ -204,9 +227,11 @@ class CLI:
             self._send_to_cli("already_unpaused","unpause")
         
 
-    def _skip_current(self):
+    def _skip_current(self, jobname):
         """
-        Unimplemented command to kill the currently processing job
-        :return:
+        Kills the processing of a running job, the job is moved to failed
+        :param jobname: Name of the job to skip
+        :return: None
         """
-        self.processor.shutdown()
\ No newline at end of file
+        jbs = self.processor.skip(jobname)
+        self._send_to_cli(jbs, "skip")
\ No newline at end of file
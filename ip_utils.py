@@ -1,4 +1,6 @@
 import os
+import stat
+import tempfile
 
 DATE = "DATE_FINISHED"
 
@@ -14,10 +16,14 @@ TMP = 'tmp'
 DIRS = [BATCHES, DEL, DEST, FAILED, LOGS, MODELS, DONE, REC, TMP]
 
 
+# Lists the entries of a directory as absolute paths, hidden entries such as the temp copies of the move engine are
+# left out
 def get_abs_paths(directory):
     files = os.listdir(directory)
     n_files = []
     for f in files:
+        if f.startswith("."):
+            continue
         f = os.path.join(directory, f)
         f = os.path.abspath(f)
         f = os.path.normpath(f)
@@ -36,8 +42,23 @@ def convert_path(path):
     return path
 
 
-
-
-
-
-
+# Writes text to a file by writing a temp file in the same directory and renaming it over the original
+def write_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))  # Keep the permissions of the original file
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
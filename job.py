@@ -9,12 +9,18 @@ Created 2023-06-12
 """
 import yaml
 
-import constants, ip_utils
+import constants, ip_utils, mover
+from metrics import METRICS
+from readiness import ReadinessTracker, FileNotReadyError
 
+import copy
 import os
 import shutil
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
+import time
 
 
 class JobData:
@@ -41,26 +47,40 @@ class JobData:
         self.proc_dir_name = 'masks'
         self.proc_dir_path = os.path.join(base_dir, self.proc_dir_name)
 
+        self._loaded = {}  # Copy of data as it was read, used to skip writing the com file when nothing changed
+        self._loaded_stat = None
+
         self.initialize()
 
     def __enter__(self):
         """
         Method to implement opening up job data via a context manager
+        Data is only read again if the com file changed since it was last read
         :return: self
         """
-        self.initialize()
+        if self._loaded_stat is None or self._loaded_stat != self._stat_com():
+            self.initialize()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
         Method to implement opening up job data via a context manager
-        Whatever is changed in the data attribute will be written to the com file
+        Whatever is changed in the data attribute will be written to the com file, nothing is written if it is unchanged
         :param exc_type:
         :param exc_val:
         :param exc_tb:
         :return:
         """
-        self._write_yaml()
+        if self.is_dirty():
+            self._write_yaml()
+            JOB_CACHE.invalidate(self.base)
+
+    def is_dirty(self):
+        """
+        Checks if the data attribute has been changed since it was read from the com file
+        :return: True if the com file needs to be written
+        """
+        return self.data != self._loaded
 
     def initialize(self):
         """
@@ -69,8 +89,11 @@ class JobData:
         """
         self.com_file_name = self._find_com()
         self.com_file_path = os.path.join(self.base, self.com_file_name)
+        # Stat before parsing, a write landing in between then shows up as a changed file instead of being missed
+        self._loaded_stat = self._stat_com()
         # self.data = self._parse_com()
         self.data = self._parse_yaml()
+        self._loaded = copy.deepcopy(self.data)
         image_path = self._find_image()
         self.image_file_path = image_path
         self.image_file_name = self.data.get(constants.TARGET_IMAGE)
@@ -97,7 +120,7 @@ class JobData:
         for file in contents:
             if file.lower().endswith(".yaml"):
                 return file
-        raise FileNotFoundError
+        raise FileNotFoundError("No com file in {}".format(self.base))
 
     def _parse_yaml(self):
         with open(self.com_file_path, 'r') as file:
@@ -105,9 +128,197 @@ class JobData:
         return command_file
 
     def _write_yaml(self):
-        with open(self.com_file_path, 'w') as file:
-            yaml.safe_dump(self.data, file, default_flow_style=False)
+        """
+        Writes the data to the com file through a temp file so a crash can never leave a half written com file
+        :return: None
+        """
+        ip_utils.write_atomic(self.com_file_path, yaml.safe_dump(self.data, default_flow_style=False))
+        self._loaded = copy.deepcopy(self.data)
+        self._loaded_stat = self._stat_com()
 
+    def _stat_com(self):
+        """
+        Gets the (mtime, size) of the com file
+        :return: Tuple of mtime in ns and size, None if the com file is missing
+        """
+        try:
+            st = os.stat(self.com_file_path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+
+
+class JobDataCache:
+    """
+    A class to share read only JobData instances between the queue, processor, sender and CLI
+    Entries are validated against the (mtime, size) of the job's com file and evicted least recently used first
+    JobData returned from the cache must not be modified, use JobData as a context manager to change metadata
+    """
+    def __init__(self, max_size=None):
+        """
+        Constructor method
+        :param max_size: Max number of jobs to keep, defaults to constants.JOB_CACHE_SIZE
+        """
+        self.max_size = constants.JOB_CACHE_SIZE if max_size is None else max_size
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()  # base dir -> (JobData, com file mtime_ns, com file size)
+
+    def get(self, base_dir):
+        """
+        Gets the JobData of a job, only parses the com file if it changed since it was last read
+        :param base_dir: Base directory of the job
+        :return: JobData
+        :raises FileNotFoundError: if the job or its com file does not exist
+        """
+        key = os.path.abspath(base_dir)
+        with self.lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            jd, mtime, size = entry
+            try:
+                st = os.stat(jd.com_file_path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and st.st_mtime_ns == mtime and st.st_size == size:
+                with self.lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                return jd
+        jd = JobData(key)
+        if jd._loaded_stat is None:
+            raise FileNotFoundError("No com file in {}".format(key))
+        mtime, size = jd._loaded_stat  # Taken before the parse so a write during it is not cached as current
+        with self.lock:
+            self._entries[key] = (jd, mtime, size)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return jd
+
+    def invalidate(self, base_dir):
+        """
+        Removes a job from the cache, used when a job is moved, renamed, deleted or its metadata is written
+        :param base_dir: Base directory of the job
+        :return: None
+        """
+        with self.lock:
+            self._entries.pop(os.path.abspath(base_dir), None)
+
+    def clear(self):
+        """
+        Empties the cache
+        :return: None
+        """
+        with self.lock:
+            self._entries.clear()
+
+
+# Shared cache of JobData used throughout the server
+JOB_CACHE = JobDataCache()
+
+
+def get_job_data(base_dir):
+    """
+    Gets the read only JobData for a job from the shared cache
+    :param base_dir: Base directory of the job
+    :return: JobData
+    """
+    return JOB_CACHE.get(base_dir)
+
+
+def stage_reached(job_data, stage):
+    """
+    Checks if a job has completed a processing stage
+    :param job_data: JobData of the job
+    :param stage: One of constants.STAGES
+    :return: True if the job's recorded stage is the given stage or a later one
+    """
+    current = job_data.data.get(constants.STAGE, constants.STAGE_INGESTED)  # No stage yet means only ingested
+    if current not in constants.STAGES:
+        return False
+    return constants.STAGES.index(current) >= constants.STAGES.index(stage)
+
+
+def set_stage(base_dir, stage):
+    """
+    Records the last completed processing stage of a job in its com file
+    :param base_dir: Base directory of the job
+    :param stage: One of constants.STAGES
+    :return: None
+    """
+    with JobData(base_dir) as jd:
+        jd.data[constants.STAGE] = stage
+
+
+class JobNameRegistry:
+    """
+    A class to keep track of every job name in use so names can be handed out without scanning the job directories
+    Holds a set of the names in use and a counter per base name for the next version number to try
+    """
+    def __init__(self):
+        """
+        Constructor method
+        """
+        self.lock = threading.Lock()
+        self.names = set()
+        self.counters = {}
+
+    def rebuild(self, dirs):
+        """
+        Fills the registry from the job directories on disk, only needed once on startup
+        :param dirs: List of directories that contain jobs
+        :return: None
+        """
+        with self.lock:
+            self.names.clear()
+            self.counters.clear()
+            for folder in dirs:
+                if not os.path.isdir(folder):
+                    continue
+                for entry in os.scandir(folder):
+                    if entry.is_dir() and not entry.name.startswith("."):  # Hidden entries are not jobs
+                        self._add(entry.name)
+
+    def _add(self, name):
+        """
+        Adds a name to the registry and bumps the counter of its base name, lock must be held
+        :param name: Job name
+        :return: None
+        """
+        self.names.add(name)
+        base, sep, version = name.rpartition("-")
+        if sep and version.isdigit():
+            self.counters[base] = max(self.counters.get(base, 1), int(version) + 1)
+
+    def allocate(self, name):
+        """
+        Reserves a unique job name, the first job with a name gets it as is and later ones get -1, -2, ... appended
+        :param name: Requested job name
+        :return: The reserved job name
+        """
+        with self.lock:
+            if name in self.names:
+                version = self.counters.get(name, 1)
+                while "{}-{}".format(name, version) in self.names:
+                    version += 1
+                self.counters[name] = version + 1
+                name = "{}-{}".format(name, version)
+            self._add(name)
+            return name
+
+    def release(self, name):
+        """
+        Frees up a job name once the job is deleted
+        :param name: Job name
+        :return: None
+        """
+        with self.lock:
+            self.names.discard(name)
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.names
 
 
 class JobManager:
@@ -120,7 +331,11 @@ class JobManager:
         :param logger: Injected Logger
         """
         self.logs = logger
+        self.readiness = ReadinessTracker()
         self._ensure_directories_exist()
+        self._remove_partials()
+        self.names = JobNameRegistry()
+        self.names.rebuild(constants.JOB_DIRS + [constants.REC])  # Jobs left in rec by a crash keep their names
 
     # Function to move job data once formatted into the standard format
     def move(self, job_base, destination):
@@ -130,39 +345,57 @@ class JobManager:
         :param destination: Destination location of where you want to move the dir
         :return: Returns the path of the moved directory
         """
-        with JobData(job_base) as jd:
-            date = datetime.today()
-            date_str = date.strftime("%Y-%m-%d")
-            jd.data[constants.DATE] = date_str
-
+        date = datetime.today()
+        date_str = date.strftime("%Y-%m-%d")
         try:
-            new_base = shutil.move(job_base, destination)
-        except FileExistsError:
-            rename = self._name_dir(job_base)
-            path = os.path.dirname(job_base)
-            new_path = os.path.join(path, rename)
-            os.rename(job_base, rename)
-            self.logs.log_debug("{} renamed to {}".format(os.path.basename(job_base), rename))
-            new_base = shutil.move(new_path, destination)
-        except shutil.Error:
+            stamped = get_job_data(job_base).data.get(constants.DATE) == date_str
+        except (OSError, AttributeError, yaml.YAMLError):  # Com file missing or corrupt, still moved so it can be failed
+            stamped = True
+        if not stamped:  # Com file is only written if the date changes
             with JobData(job_base) as jd:
-                com_file = jd.com_file_path
-            rename = self._name_dir(com_file) + "\\"
-            path = os.path.dirname(job_base)
-            new_path = os.path.join(path, rename)
+                jd.data[constants.DATE] = date_str
+
+        JOB_CACHE.invalidate(job_base)
+        start = time.monotonic()
+        try:
+            new_base = self._move(job_base, destination)
+        except (FileExistsError, shutil.Error):
+            # Only happens if a directory was put into a job dir outside of the server, names are unique otherwise
+            old_name = os.path.basename(job_base)
+            rename = self.names.allocate(old_name)
+            new_path = os.path.join(os.path.dirname(job_base), rename)
             os.rename(job_base, new_path)
-            self.logs.log_debug("{} renamed to {}".format(os.path.basename(job_base), rename))
-            new_base = shutil.move(new_path, destination)
+            self.names.release(old_name)
+            METRICS.rename(old_name, rename)
+            self.logs.log_debug("{} renamed to {}".format(old_name, rename))
+            new_base = self._move(new_path, destination)
+        METRICS.observe("move", time.monotonic() - start, os.path.basename(new_base))
         return os.path.abspath(new_base)
 
+    def _move(self, src, destination):
+        """
+        Moves a file or directory with the move engine and records whether it was renamed or copied across devices
+        :param src: Path of the file or directory to move
+        :param destination: Directory to move it into
+        :return: New path
+        """
+        new_path, method = mover.move(src, destination)
+        METRICS.incr("move_" + method)  # Shows in stats how many moves had to copy across devices
+        if method != mover.RENAME:
+            self.logs.log_debug("{} copied across devices to {} using {}".format(os.path.basename(src), destination,
+                                                                                method))
+        return new_path
+
     def create_job_data(self, com_file):
         """
         Initialization method for formatting files into JobData format
         :param com_file: COM file of data that you want to format
         :return: returns the path of the formatted JobData
         """
+        start = time.monotonic()
         com, img = self._create_association(com_file)
         base = self._format_job_data(com, img)
+        METRICS.observe("ingest", time.monotonic() - start, os.path.basename(base))
         return base
 
     def _format_job_data(self, com_file, image_file):
@@ -179,8 +412,12 @@ class JobManager:
         base = os.path.join(dir_name, self._name_dir(com_file))
         os.mkdir(base)
 
-        shutil.move(com_file, base)
-        shutil.move(image_file, base)
+        self._move(com_file, base)
+        self._move(image_file, base)
+        for uploaded in (com_file, image_file):  # Sidecar markers are no longer needed once the job is formed
+            marker = self.readiness.marker_path(uploaded)
+            if marker is not None and os.path.exists(marker):
+                os.remove(marker)
         mask_dir = os.path.join(base, "masks")
         os.mkdir(mask_dir)
         return base
@@ -188,43 +425,23 @@ class JobManager:
     def _name_dir(self, com_file):
         """
         Method to name a jobs base directory, will append a version number to it if there are multiple of the same name
+        The name is reserved in the name registry until the job is deleted
         :param com_file: com file
         :return: Returns the job name
         """
-        # metadata = self._parse_com(com_file)
         metadata = self._parse_yaml(com_file)
-        job_names = self._get_all_jobs()
-        cur_job_name = metadata.get(constants.F_NAME)  # TODO: Change this to the proper param
-        count = 0
-
-        for name in job_names:
-            if cur_job_name in name:
-                count += 1
+        return self.names.allocate(metadata.get(constants.F_NAME))
 
-        if count > 0:
-            cur_job_name = cur_job_name + "-{}".format(count)
-        # TODO change job name within com file? or just add
-
-        return cur_job_name
-
-    # TODO fix possible bug here may also be in move. Currently unsure.
-    @staticmethod
-    def _get_all_jobs():
+    def delete(self, job_base):
         """
-        Gets all jobs from all locations (Failed, Processed, batches, rec...)
-        :return: returns the list of job names
+        Deletes a job directory and frees up its name
+        :param job_base: Path to the job
+        :return: None
         """
-        job_names = []
-        for folder in constants.JOB_DIRS:
-            job_names = job_names + ip_utils.get_abs_paths(folder)
-        for path in job_names:
-            if os.path.isdir(path):
-                with JobData(path) as jd:
-                    job_names = list(map(lambda x: x.replace(path, jd.base_name), job_names))
-            else:
-                job_names.remove(path)
-                
-        return job_names
+        JOB_CACHE.invalidate(job_base)
+        shutil.rmtree(job_base)
+        self.names.release(os.path.basename(job_base))
+        METRICS.forget(os.path.basename(job_base))
 
     def _parse_yaml(self, file_path):
         with open(file_path, 'r') as file:
@@ -240,9 +457,12 @@ class JobManager:
         """
         if os.path.isdir(com_file_path):
             raise FileNotFoundError
-        
+
+        nm = os.path.basename(com_file_path)
+        if not self.readiness.is_ready(com_file_path):
+            raise FileNotReadyError("{} is still being uploaded".format(nm))
         dir_path = os.path.dirname(com_file_path)
-        data = self._parse_yaml(com_file_path)
+        data = self.readiness.parse(com_file_path, self._parse_yaml)
         pths = os.listdir(dir_path)
         target = data.get(constants.TARGET_IMAGE)
         if target is None or target.endswith(".ISQ"):
@@ -250,14 +470,29 @@ class JobManager:
         image_file_path = None
         for file in pths:
             if file.lower() == target.lower():
-                image_file_path = file
-                image_file_path = os.path.join(dir_path, image_file_path)
-                self.logs.log_debug("{} Received".format(data.get(constants.TARGET_IMAGE)))
-                return com_file_path, image_file_path
+                image_file_path = os.path.join(dir_path, file)
+                break
         if image_file_path is None:
-            nm = os.path.basename(com_file_path)
+            if self.readiness.waiting_for(com_file_path) < constants.READY_TIMEOUT:
+                raise FileNotReadyError("Waiting on image file for {}".format(nm))
             self.logs.log_error('Could not find associated image file for {}'.format(nm))
             raise FileNotFoundError("Image file not found for {}".format(nm))
+        if not self.readiness.is_ready(image_file_path):
+            if self.readiness.waiting_for(com_file_path) < constants.READY_TIMEOUT:
+                raise FileNotReadyError("{} is still being uploaded".format(os.path.basename(image_file_path)))
+            raise FileNotFoundError("Image file for {} never finished uploading".format(nm))
+        self.readiness.forget(com_file_path, image_file_path)
+        self.logs.log_debug("{} Received".format(data.get(constants.TARGET_IMAGE)))
+        return com_file_path, image_file_path
+
+    def _remove_partials(self):
+        """
+        Removes the temp copies left in the job directories by a move that was interrupted by a crash
+        :return: None
+        """
+        for folder in constants.JOB_DIRS:
+            for name in mover.remove_partials(folder):
+                self.logs.log_debug("Removed {} left in {} by an interrupted move".format(name, folder))
 
     def _ensure_directories_exist(self, dirs=None):
         """
@@ -294,7 +529,7 @@ class JobManager:
                 elif self._check_date(jd.data.get(constants.DATE)):
                     to_del = True
             if to_del:
-                shutil.rmtree(file)
+                self.delete(file)
 
     @staticmethod
     def _check_date(date_str):
@@ -0,0 +1,89 @@
+"""
+job_types.py
+Author: Ian Smith
+Description: Registry of the job types the server can run. Each JobType names the Processor method that processes it,
+the Send method that sends its results back, and the resources one job of the type needs so the scheduler can run
+light jobs beside heavy ones. Adding a job type means writing those methods and registering the type here.
+"""
+import constants
+
+
+class JobType:
+    """
+    Description of one job type
+    """
+    def __init__(self, name, process, send, process_batch=None, send_batch=None, cores=None, memory_gb=None,
+                 max_concurrency=0, timeout=None, model=None, segmenter=None, segmenter_version=None):
+        """
+        Constructor method
+        :param name: Job type as written in JOB_TYPE of a submission, case insensitive
+        :param process: Name of the Processor method that processes a single job, called with its JobData
+        :param send: Name of the Send method that sends the results of a job back
+        :param process_batch: Name of the Processor method that processes a list of JobData with one invocation,
+                              None if jobs of the type can not be batched
+        :param send_batch: Name of the Send method that sends a list of JobData going to the same host and directory
+                           together, None if every job is sent on its own
+        :param cores: CPU cores one job needs, defaults to constants.JOB_CPU_CORES
+        :param memory_gb: Memory one job needs in GB, defaults to constants.JOB_MEMORY_GB
+        :param max_concurrency: Max jobs of the type running at once, 0 for no limit other than the resources
+        :param timeout: Max time the processing command of one job may run in seconds, defaults to constants.JOB_TIMEOUT
+        :param model: Name of the model the job type runs, results are only cached for job types with a model
+        :param segmenter: Path to the script that runs the model, its content hash is the segmenter version
+        :param segmenter_version: Fixed segmenter version, used instead of the hash of the script
+        """
+        self.name = name.lower()
+        self.process = process
+        self.send = send
+        self.process_batch = process_batch
+        self.send_batch = send_batch
+        self.cores = constants.JOB_CPU_CORES if cores is None else cores
+        self.memory_gb = constants.JOB_MEMORY_GB if memory_gb is None else memory_gb
+        self.max_concurrency = max_concurrency
+        self.timeout = constants.JOB_TIMEOUT if timeout is None else timeout
+        self.model = model
+        self.segmenter = segmenter
+        self.segmenter_version = segmenter_version
+
+
+JOB_TYPES = {}
+
+
+def register(job_type):
+    """
+    Adds a job type to the registry, replaces a type with the same name
+    :param job_type: JobType
+    :return: The JobType
+    """
+    JOB_TYPES[job_type.name] = job_type
+    return job_type
+
+
+def get_job_type(name):
+    """
+    Looks up a job type
+    :param name: Job type as written in JOB_TYPE of a submission
+    :return: JobType
+    :raises NotImplementedError: if the job type is not registered
+    """
+    job_type = JOB_TYPES.get((name or "").lower())
+    if job_type is None:
+        raise NotImplementedError(f"Job Type: {name} not implemented in this system.")
+    return job_type
+
+
+def is_batched(name):
+    """
+    Checks if jobs of a type are segmented in batches
+    :param name: Job type as written in JOB_TYPE of a submission
+    :return: True if the job type is registered with a batch method
+    """
+    job_type = JOB_TYPES.get((name or "").lower())
+    return job_type is not None and job_type.process_batch is not None
+
+
+register(JobType("radius_tibia_final", "_radius_tibia_final", "_send_radius_tibia_final",
+                 process_batch="_radius_tibia_final_batch", send_batch="_send_radius_tibia_final_batch",
+                 cores=constants.RAD_TIB_CPU_CORES, memory_gb=constants.RAD_TIB_MEMORY_GB,
+                 max_concurrency=constants.RAD_TIB_MAX_CONCURRENCY, timeout=constants.RAD_TIB_TIMEOUT,
+                 model=constants.RAD_TIB_TRAINED_MODELS, segmenter=constants.RAD_TIB_PATH_TO_START,
+                 segmenter_version=constants.RAD_TIB_SEGMENTER_VERSION))
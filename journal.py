@@ -0,0 +1,166 @@
+"""
+journal.py
+Author: Ian Smith
+Description: Contains the QueueJournal class, an append-only journal of every change made to the ManagedQueue. On
+startup the queue is rebuilt from the last snapshot plus the journal records written after it, so the queue order and
+any priority changes made with the CLI survive a restart or crash.
+"""
+import constants, ip_utils
+
+import json
+import os
+import threading
+
+
+ENQUEUE = "enqueue"
+DEQUEUE = "dequeue"
+MOVE = "move"
+REMOVE = "remove"
+
+
+class QueueJournal:
+    """
+    A class to persist the state of the job queue
+    The snapshot holds [name, path, key, job type] for every queued job, the journal holds one JSON record per line
+    """
+    def __init__(self, logger, journal_path=None, snapshot_path=None):
+        """
+        Constructor method
+        :param logger: Injected Logger from ip_logging
+        :param journal_path: Path of the journal file, defaults to constants.QUEUE_JOURNAL
+        :param snapshot_path: Path of the snapshot file, defaults to constants.QUEUE_SNAPSHOT
+        """
+        self.logs = logger
+        self.journal_path = constants.QUEUE_JOURNAL if journal_path is None else journal_path
+        self.snapshot_path = constants.QUEUE_SNAPSHOT if snapshot_path is None else snapshot_path
+        self.lock = threading.Lock()
+        self.records = 0  # Records written since the last snapshot
+        self._file = None
+
+    def append(self, op, name, path=None, key=None, job_type=None):
+        """
+        Appends a record to the journal
+        :param op: ENQUEUE, DEQUEUE, MOVE or REMOVE
+        :param name: Job name
+        :param path: Base directory of the job, needed for ENQUEUE
+        :param key: Position key of the job, needed for ENQUEUE and MOVE
+        :param job_type: Job type of the job, kept for ENQUEUE and MOVE so recovery does not have to read the com file
+        :return: None
+        """
+        record = {"op": op, "name": name}
+        if path is not None:
+            record["path"] = path
+        if key is not None:
+            record["key"] = key
+        if job_type is not None:
+            record["type"] = job_type
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.journal_path, "a")
+            self._file.write(line)
+            self._file.flush()
+            if constants.JOURNAL_FSYNC:
+                os.fsync(self._file.fileno())
+            self.records += 1
+
+    def needs_compaction(self):
+        """
+        Checks if enough records have been written that a new snapshot should be taken
+        :return: True if compact should be called
+        """
+        return self.records >= constants.JOURNAL_COMPACT_AFTER
+
+    def compact(self, entries):
+        """
+        Writes a snapshot of the queue and empties the journal
+        :param entries: List of (name, path, key, job type) in queue order
+        :return: None
+        """
+        with self.lock:
+            ip_utils.write_atomic(self.snapshot_path, json.dumps([list(e) for e in entries]))
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.journal_path, "w")  # Truncates the journal, everything in it is in the snapshot
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.records = 0
+
+    def recover(self, batches):
+        """
+        Rebuilds the queue from the snapshot and journal and reconciles it with the jobs that are actually on disk
+        Jobs in batches that the journal does not know about (jobs put back from destination after a crash) are put
+        at the front of the queue in the order they were last modified
+        :param batches: List of job directories currently in the batches dir
+        :return: List of (key, path, job type) in queue order, the job type is None if it was not recorded
+        """
+        queued = {}  # name -> [path, key, job type]
+        try:
+            with open(self.snapshot_path, "r") as f:
+                for name, path, key, *job_type in json.load(f):  # Snapshots of older versions have no job type
+                    queued[name] = [path, key, job_type[0] if job_type else None]
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            self.logs.log_error("Queue snapshot {} is corrupt, ignoring it: {}".format(self.snapshot_path, e))
+
+        replayed = 0
+        try:
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # Partially written last record from a crash
+                        self.logs.log_error("Skipping corrupt queue journal record: {!r}".format(line))
+                        continue
+                    self._apply(queued, record)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+
+        on_disk = {os.path.basename(p): p for p in batches}
+        entries = []
+        for name, (path, key, job_type) in queued.items():
+            if not os.path.isdir(path):  # Job was moved back into batches after the record was written
+                path = on_disk.get(name)
+                if path is None:
+                    self.logs.log_debug("Dropping {} from the queue, job no longer exists".format(name))
+                    continue
+            entries.append((key, path, job_type))
+        known = {os.path.basename(p) for _, p, _ in entries}
+        unknown = sorted((p for n, p in on_disk.items() if n not in known), key=os.path.getmtime)
+        front = min((k for k, _, _ in entries), default=1.0)
+        for i, path in enumerate(reversed(unknown), start=1):
+            entries.append((front - i, path, None))
+        entries.sort(key=lambda e: (e[0], e[1]))
+        self.logs.log_debug("Recovered {} queued jobs from {} journal records".format(len(entries), replayed))
+        return entries
+
+    @staticmethod
+    def _apply(queued, record):
+        """
+        Applies a journal record to the queue being recovered
+        :param queued: Dict of name -> [path, key, job type]
+        :param record: Journal record
+        :return: None
+        """
+        op = record.get("op")
+        name = record.get("name")
+        if op == ENQUEUE:
+            queued[name] = [record.get("path"), record.get("key"), record.get("type")]
+        elif op in (DEQUEUE, REMOVE):
+            queued.pop(name, None)
+        elif op == MOVE and name in queued:
+            queued[name][1] = record.get("key")
+            if record.get("type") is not None:
+                queued[name][2] = record.get("type")
+
+    def close(self):
+        """
+        Closes the journal file
+        :return: None
+        """
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -9,35 +9,58 @@ Package Dependencies: psutil, daemon, pwd
 import traceback
 
 from job import JobManager
+from job_types import JOB_TYPES, is_batched
+from metrics import METRICS
 from process import Processor
-from queue_manager import ManagedQueue
+from queue_manager import ManagedQueue, read_job_type
 from ip_logging import Logger
 from send import Send
 from ip_cli import CLI
+from scheduler import ResourceGovernor
+from pipeline import Stage
+from transfer_queue import TransferQueue
+from watcher import DirectoryWatcher
+from readiness import FileNotReadyError
 import constants, ip_utils
 
 
 import os
+import signal
 import time
 import threading
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Main:
-    def __init__(self):
+    def __init__(self, cli=True):
         """
         Constructor method
+        :param cli: False to run without the CLI socket and signal handlers, the caller then owns the main thread and
+                    stops the server with shutdown (used by the benchmark)
         """
         self.logs = Logger()
         self.file_manager = JobManager(self.logs)
         self.processor = Processor(self.logs, self.file_manager)
         self.job_queue = ManagedQueue(self.logs)
         self.transfer = Send(self.logs)
-        self.Cli = CLI(self.job_queue, self.processor, self.transfer, self.file_manager, self)
+        self.governor = ResourceGovernor(self.logs)
+        # Segmented jobs wait in the outbox for the transfer queue, which retries failed transfers, and every finished
+        # job is handed to the archive stage
+        self.archive_stage = Stage("archive", self._archive_job, self.logs, 1)
+        self.transfer_queue = TransferQueue(self.logs, self._transfer_jobs, self._transferred, self.transfer.batch_key)
+        self.Cli = CLI(self.job_queue, self.processor, self.transfer, self.file_manager, self) if cli else None
+        # Any file wakes the watcher, an image finishing its upload can make a waiting submission ready
+        self.watcher = DirectoryWatcher(constants.REC, self.logs, suffixes=None)
 
         self.running = True
         self.paused = True
+        self.resumed = threading.Event()  # Set while processing is not paused, workers wait on it
+        self.threads = []
 
+        if cli:
+            signal.signal(signal.SIGTERM, self._handle_signal)
+            signal.signal(signal.SIGINT, self._handle_signal)
         self.start()
         self.logs.log_debug("Server Started")
 
@@ -47,11 +70,18 @@ class Main:
         :return: None
         """
         # Monitor directory thread
-        threading.Thread(target=self.monitor, args=()).start()  # Passing fn as reference
-        # Worker thread
-        threading.Thread(target=self.processing).start()
+        self.threads.append(threading.Thread(target=self.monitor, args=(), name="monitor"))  # Passing fn as reference
+        # Worker threads, the ResourceGovernor decides how many of them actually run a job at once
+        for i in range(constants.PROCESSING_WORKERS):
+            self.threads.append(threading.Thread(target=self.processing, name="worker-{}".format(i)))
+        for thread in self.threads:
+            thread.start()
+        # Transfer and archive threads
+        self.transfer_queue.start()
+        self.archive_stage.start()
         # CLI thread
-        threading.Thread(target=self.cli_handle(), args=()).start()
+        if self.Cli is not None:
+            threading.Thread(target=self.cli_handle(), args=()).start()
         
 
     def cli_handle(self):
@@ -63,63 +93,292 @@ class Main:
             self.Cli.cli()
             
     def set_processing_state(self, state):
+        """
+        Pauses or resumes processing, workers blocked waiting for a job notice at once
+        A job that is already running finishes before its worker pauses
+        :param state: True to pause, False to resume
+        :return: None
+        """
         self.paused = state
+        if state:
+            self.resumed.clear()
+        else:
+            self.resumed.set()
+        self._wake_workers()
+
+    def _wake_workers(self):
+        """
+        Wakes the workers blocked on the queue so they check if they should stop waiting
+        :return: None
+        """
+        self.job_queue.wake()
+
+    def _cancelled(self):
+        """
+        Cancel function for the blocking waits of the workers
+        :return: True if processing was paused or the server is shutting down
+        """
+        return self.paused or not self.running
+
+    def shutdown(self):
+        """
+        Stops every thread of the server, running segmentations are killed
+        Jobs that were not finished are left in destination and resumed from their last stage on the next startup
+        :return: None
+        """
+        if not self.running:
+            return
+        self.logs.log_debug("Shutting down")
+        self.running = False
+        self.resumed.set()  # Releases paused workers so they can see the server is stopping
+        self._wake_workers()
+        self.watcher.interrupt()
+        self.processor.shutdown()
+        self.transfer_queue.stop()  # Frees up workers blocked handing a job to the transfer queue
+        self.transfer.close()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.archive_stage.stop()
+        self.job_queue.close()
+        self.logs.log_debug("Server stopped")
+
+    def _handle_signal(self, signum, frame):
+        """
+        Shuts the server down on SIGTERM or SIGINT
+        :param signum: Signal number
+        :param frame: Current stack frame
+        :return: None
+        """
+        self.shutdown()
+        raise SystemExit(0)
 
     def monitor(self):
         """
         Method to start the event loop to monitor the rec directory, format files and enqueue them
         :return: None
         """
+        watcher = self.watcher
+        pool = ThreadPoolExecutor(max_workers=constants.INGEST_WORKERS, thread_name_prefix="ingest")
         last = time.time()
-        while self.running:
-            if time.time() - last > 3600:  # Checks every hour to clean up files that are more than a
-                self.file_manager.cleanup(constants.FAILED)                       # week old
-                self.file_manager.cleanup(constants.DONE)
-                last = time.time()
-            file_list = os.listdir(constants.REC)
-            if len(file_list) != 0:
-                for file in file_list:
-                    file = 'rec/' + file
-                    file = os.path.abspath(file)
-                    if file.lower().endswith(".yaml"):  # change to .yaml?
-                        try:
-                            job_dir = self.file_manager.create_job_data(file)
-                            job_path = self.file_manager.move(job_dir, constants.BATCHES)
-                            self.job_queue.enqueue(job_path)
-                            break
-                        except FileNotFoundError as e:
-                            self.logs.log_error(f"{e}")
-                            self.logs.log_error(traceback.format_exc())
-                            try:
-                                shutil.move(file, constants.FAILED)
-                            except shutil.Error as e:
-                                os.remove(file)
-                            break
-            time.sleep(1)
+        pending = True  # Scan once on startup for anything that arrived while the server was down
+        try:
+            while self.running:
+                if time.time() - last > constants.CLEANUP_INTERVAL:  # Checks every hour to clean up files that are
+                    self.file_manager.cleanup(constants.FAILED)       # more than a week old
+                    self.file_manager.cleanup(constants.DONE)
+                    last = time.time()
+                waiting = 0
+                if pending:
+                    handled, waiting = self._ingest_all(pool)
+                    if handled:  # Rescan in case more arrived while the batch was being formatted
+                        continue
+                timeout = max(0, min(constants.WATCH_TIMEOUT, constants.CLEANUP_INTERVAL - (time.time() - last)))
+                if waiting:  # Submissions still uploading are checked again once the stability window can pass
+                    timeout = min(timeout, constants.READY_CHECK_INTERVAL)
+                pending = watcher.wait(timeout) or waiting > 0
+        finally:
+            watcher.close()
+            pool.shutdown(wait=True)
+
+    def _ingest_all(self, pool):
+        """
+        Formats every complete .yaml submission in the rec directory in parallel and enqueues them in arrival order
+        :param pool: Executor used to format and move the submissions
+        :return: Tuple of the number of submissions handled (enqueued or failed) and the number still uploading
+        """
+        self.file_manager.readiness.tick()
+        files = []
+        present = []
+        for entry in os.scandir(constants.REC):
+            path = os.path.abspath(entry.path)
+            present.append(path)
+            if entry.name.lower().endswith(".yaml") and entry.is_file():
+                try:
+                    files.append((entry.stat().st_mtime, path))
+                except FileNotFoundError:  # Removed between listing and stat
+                    continue
+        self.file_manager.readiness.prune(present)
+        if not files:
+            return 0, 0
+        files.sort()
+        futures = [pool.submit(self._ingest, file) for _, file in files]
+        handled = 0
+        waiting = 0
+        for future in futures:  # Results are collected in arrival order so the queue keeps submission order
+            try:
+                job_path = future.result()
+            except FileNotReadyError:
+                waiting += 1
+                continue
+            handled += 1
+            if job_path is not None:
+                self.job_queue.enqueue(job_path)
+        if handled:
+            self.logs.log_debug("Ingested {} submission(s), {} still uploading".format(handled, waiting))
+        return handled, waiting
+
+    def _ingest(self, file):
+        """
+        Formats a submission into a job and moves it to batches, failed submissions are moved to failed
+        Runs on the ingest pool, every submission fails on its own without affecting the others
+        :param file: Path to the .yaml file of the submission
+        :return: Path to the job in batches, None if the submission failed
+        :raises FileNotReadyError: if the submission is still being uploaded, it is left in rec
+        """
+        try:
+            job_dir = self.file_manager.create_job_data(file)
+            return self.file_manager.move(job_dir, constants.BATCHES)
+        except FileNotReadyError:
+            raise
+        except Exception as e:
+            self.logs.log_error("Failed to ingest {}: {}".format(os.path.basename(file), e))
+            self.logs.log_error(traceback.format_exc())
+            try:
+                shutil.move(file, constants.FAILED)
+            except FileNotFoundError:  # Already moved into a job directory before the failure
+                pass
+            except shutil.Error:
+                os.remove(file)
+            return None
 
     def processing(self):
         """
-        Method to handle the event loop for processing jobs
+        Method to handle the event loop for processing jobs, one of these runs on each worker thread
         :return: None
         """
         while self.running:
-            
-            if self.paused:
-                time.sleep(1)
+            self.resumed.wait()
+            if not self.running:
+                break
+
+            # The first queued job whose resources are free is taken, so light jobs can start beside heavy ones
+            job_path, reservation = self.job_queue.dequeue_admissible(self._admit, self.governor.release,
+                                                                      cancel=self._cancelled)
+            if job_path is None:  # Paused or shutting down
                 continue
-        
-            if self.job_queue.JOB_QUEUE.not_empty:
-                job_path = self.job_queue.dequeue()  # First item is gotten from the queue
-                job_path = self.file_manager.move(job_path, constants.DEST)
-                is_successful = self.processor.process_image(job_path)
-                if is_successful: # If the image is processed successfully then it gets sent 
-                    is_successful = self.transfer.send(job_path) 
-                    job_path = self.file_manager.move(job_path, constants.DONE)
-                    if not is_successful: # Failed transfer of files will move the files to the failed directory
-                        self.file_manager.move(job_path, constants.FAILED)
-                else:
-                    self.file_manager.move(job_path, constants.FAILED)
-            time.sleep(1)
+            job_paths = [job_path]
+            results = []
+            try:
+                job_paths += self._collect_batch(job_path)
+                self.governor.rename(reservation, ", ".join(os.path.basename(p) for p in job_paths))
+                results = self._process_jobs(job_paths, reservation)
+            except Exception as e:  # A broken job fails on its own, the worker keeps running
+                self.logs.log_error("Failed to process {}: {}".format(
+                    ", ".join(os.path.basename(p) for p in job_paths), e))
+                self.logs.log_error(traceback.format_exc())
+                results = [(path, False) for path in self._locate(job_paths, [constants.BATCHES, constants.DEST])]
+            finally:
+                self.governor.release(reservation)
+                self.job_queue.wake()  # Queued jobs that did not fit may fit now
+            if not self.running:  # Jobs killed by the shutdown stay in destination
+                break
+            for job_path, is_successful in results:
+                try:
+                    if is_successful: # If the image is processed successfully then it gets sent
+                        job_path = self.file_manager.move(job_path, constants.OUTBOX)
+                        self.transfer_queue.put(job_path)  # Blocks while the transfer queue is full
+                    else:
+                        self.archive_stage.put((job_path, False))
+                except Exception as e:
+                    self.logs.log_error("Failed to hand off {}: {}".format(os.path.basename(job_path), e))
+                    self.logs.log_error(traceback.format_exc())
+
+    @staticmethod
+    def _locate(job_paths, dirs):
+        """
+        Finds where jobs are after handling them failed part way
+        :param job_paths: Paths to the jobs
+        :param dirs: Directories the jobs can be in
+        :return: List of the current paths of the jobs that were found
+        """
+        found = []
+        for job_path in job_paths:
+            for folder in dirs:
+                path = os.path.abspath(os.path.join(folder, os.path.basename(job_path)))
+                if os.path.isdir(path):
+                    found.append(path)
+                    break
+        return found
+
+    def _admit(self, name, job_type):
+        """
+        Reserves the resources of a queued job if it can start now, uses the profile of its job type
+        Jobs of unknown types get the default profile, they fail as soon as they are processed
+        :param name: Job name
+        :param job_type: Job type the queue read when the job was enqueued
+        :return: Reservation, None if the job does not fit yet
+        """
+        profile = JOB_TYPES.get(job_type)
+        if profile is None:
+            return self.governor.try_acquire(name)
+        return self.governor.try_acquire(name, profile.cores, profile.memory_gb, profile.name, profile.max_concurrency)
+
+    def _collect_batch(self, job_path):
+        """
+        Takes more queued jobs of the same type as a job so they can be segmented together
+        :param job_path: Path to the job that was dequeued
+        :return: List of paths to the other jobs in the batch, empty if the job type is not batched
+        """
+        if constants.BATCH_SIZE <= 1:
+            return []
+        job_type = read_job_type(job_path)
+        if not is_batched(job_type):
+            return []
+        return self.job_queue.dequeue_matching(job_type, constants.BATCH_SIZE - 1, constants.BATCH_WINDOW)
+
+    def _process_jobs(self, job_paths, reservation=None):
+        """
+        Moves jobs into destination and processes them
+        :param job_paths: Paths to the jobs in batches, more than one job is processed as a batch
+        :param reservation: Reservation the jobs run under
+        :return: List of (path in destination, True if processed successfully)
+        """
+        job_paths = [self.file_manager.move(job_path, constants.DEST) for job_path in job_paths]
+        if len(job_paths) > 1:
+            results = self.processor.process_batch(job_paths, reservation)
+        else:
+            results = {job_paths[0]: self.processor.process_image(job_paths[0], reservation)}
+        return [(job_path, results.get(job_path, False)) for job_path in job_paths]
+
+    def _transfer_jobs(self, job_paths):
+        """
+        Transfer queue handler, sends processed jobs for the same host and directory back to the scanner together
+        :param job_paths: Paths to the jobs in the outbox
+        :return: Dict of path -> None if the job was sent, the exception it failed with otherwise, the transfer queue
+                 decides if a failed job is retried
+        """
+        start = time.monotonic()
+        results = self.transfer.try_send_batch(job_paths)
+        elapsed = time.monotonic() - start
+        sent = [os.path.basename(job_path) for job_path in job_paths if results.get(job_path) is None]
+        if sent:  # Failed sends are counted, their time is not a transfer latency
+            METRICS.observe("transfer", elapsed, sent)
+        if len(sent) < len(job_paths):
+            METRICS.incr("transfer_failed", len(job_paths) - len(sent))
+        return results
+
+    def _transferred(self, job_path, is_successful):
+        """
+        Called by the transfer queue once a job was sent or has failed for good, hands it to the archive stage
+        :param job_path: Path to the job in the outbox
+        :param is_successful: True if the job was sent
+        :return: None
+        """
+        self.archive_stage.put((job_path, is_successful))
+
+    def _archive_job(self, item):
+        """
+        Archive stage handler, moves a finished job into processed or failed
+        :param item: Tuple of the path to the job in destination or the outbox and True if the job was successful
+        :return: None
+        """
+        job_path, is_successful = item
+        if is_successful:
+            job_path = self.file_manager.move(job_path, constants.DONE)
+        else: # Failed jobs and failed transfers of files will move the files to the failed directory
+            job_path = self.file_manager.move(job_path, constants.FAILED)
+        METRICS.finish_job(os.path.basename(job_path), "done" if is_successful else "failed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,262 @@
+"""
+metrics.py
+Author: Ian Smith
+Description: Timing and counters for the stages a job goes through. Every stage keeps a rolling window of its latest
+durations for percentiles, and counters count events like cache hits and failures. The stage times of each job are
+collected while it runs and written as one JSON line to constants.TIMINGS_FILE when it is archived. The shared
+instance METRICS is used by the modules being timed, like JOB_CACHE in job.py.
+"""
+import constants
+
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+
+def percentile(values, fraction):
+    """
+    Gets a percentile of a list of values by the nearest rank method
+    :param values: Sorted list of values
+    :param fraction: Percentile as a fraction, e.g. 0.95
+    :return: Value at the percentile, None for an empty list
+    """
+    if not values:
+        return None
+    rank = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Histogram:
+    """
+    Durations of one stage, percentiles are taken over the latest samples and totals over all of them
+    """
+    def __init__(self, window=None):
+        """
+        Constructor method
+        :param window: Number of latest samples percentiles are taken over, defaults to constants.METRICS_WINDOW
+        """
+        self.samples = collections.deque(maxlen=constants.METRICS_WINDOW if window is None else window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Adds a duration
+        :param seconds: Duration in seconds
+        :return: None
+        """
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        """
+        Summarizes the stage
+        :return: Dict of count, mean, p50, p95, p99 and max, durations in seconds
+        """
+        values = sorted(self.samples)
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": self.max,
+        }
+
+
+class _Timer:
+    """
+    Context manager returned by Metrics.time
+    """
+    def __init__(self, metrics, stage, job):
+        self.metrics = metrics
+        self.stage = stage
+        self.job = job
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.metrics.observe(self.stage, time.monotonic() - self.start, self.job)
+        else:  # Failed attempts are counted but kept out of the latencies
+            self.metrics.incr(self.stage + "_failed")
+
+
+class Metrics:
+    """
+    A class to collect stage latencies, counters and per job timing records
+    """
+    def __init__(self, timings_file=None, max_jobs=10000):
+        """
+        Constructor method
+        :param timings_file: File the per job timing records are appended to, defaults to constants.TIMINGS_FILE
+        :param max_jobs: Max number of unfinished jobs timings are kept for, the oldest are dropped past that
+        """
+        self.timings_file = constants.TIMINGS_FILE if timings_file is None else timings_file
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.jobs = collections.OrderedDict()  # Job name -> {"started": time, "stages": {stage: seconds}}
+        self.marks = {}  # (job name, mark) -> monotonic time
+
+    def time(self, stage, job=None):
+        """
+        Times a block of code as a stage, only blocks that finish without an exception are recorded
+        :param stage: Name of the stage
+        :param job: Name of the job the time is added to, a list of names for a stage several jobs shared, None if it
+                    does not belong to a job
+        :return: Context manager
+        """
+        return _Timer(self, stage, job)
+
+    def observe(self, stage, seconds, job=None):
+        """
+        Records the duration of a stage
+        :param stage: Name of the stage
+        :param seconds: Duration in seconds
+        :param job: Name of the job the time is added to, a list of names for a stage several jobs shared, None if it
+                    does not belong to a job
+        :return: None
+        """
+        jobs = [] if job is None else [job] if isinstance(job, str) else job
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(seconds)
+            for name in jobs:
+                stages = self._job(name, time.time() - seconds)["stages"]
+                stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def incr(self, name, n=1):
+        """
+        Increments a counter
+        :param name: Name of the counter
+        :param n: Amount to add
+        :return: None
+        """
+        with self.lock:
+            self.counters[name] += n
+
+    def mark(self, job, name):
+        """
+        Records the time of an event of a job, the time until the next call of since is recorded as a stage
+        :param job: Name of the job
+        :param name: Name of the event
+        :return: None
+        """
+        with self.lock:
+            self.marks[(job, name)] = time.monotonic()
+
+    def since(self, job, name, stage):
+        """
+        Records the time since an event of a job as a stage, e.g. the time a job waited on the queue
+        :param job: Name of the job
+        :param name: Name of the event passed to mark
+        :param stage: Name of the stage
+        :return: None
+        """
+        with self.lock:
+            start = self.marks.pop((job, name), None)
+        if start is not None:
+            self.observe(stage, time.monotonic() - start, job)
+
+    def rename(self, old, new):
+        """
+        Moves the timings of a job that was renamed
+        :param old: Old name of the job
+        :param new: New name of the job
+        :return: None
+        """
+        with self.lock:
+            if old in self.jobs:
+                self.jobs[new] = self.jobs.pop(old)
+            for key in [k for k in self.marks if k[0] == old]:
+                self.marks[(new, key[1])] = self.marks.pop(key)
+
+    def _job(self, job, started):
+        """
+        Gets the timings of a job, lock must be held
+        :param job: Name of the job
+        :param started: Time the job started if it has no timings yet
+        :return: Dict of the job's timings
+        """
+        record = self.jobs.get(job)
+        if record is None:
+            record = self.jobs[job] = {"started": started, "stages": {}}
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        return record
+
+    def forget(self, job):
+        """
+        Drops the timings of a job that was deleted before it finished
+        :param job: Name of the job
+        :return: None
+        """
+        with self.lock:
+            self.jobs.pop(job, None)
+            for key in [k for k in self.marks if k[0] == job]:
+                del self.marks[key]
+
+    def finish_job(self, job, outcome):
+        """
+        Writes the timing record of a finished job and forgets its timings
+        :param job: Name of the job
+        :param outcome: How the job ended, e.g. done or failed
+        :return: None
+        """
+        with self.lock:
+            record = self.jobs.pop(job, None)
+            for key in [k for k in self.marks if k[0] == job]:
+                del self.marks[key]
+            self.counters["jobs_" + outcome] += 1
+        if record is None:
+            return
+        finished = time.time()
+        self.observe("total", finished - record["started"])
+        line = json.dumps({"job": job, "outcome": outcome, "started": record["started"], "finished": finished,
+                           "stages": record["stages"]})
+        try:
+            if os.path.exists(self.timings_file) and \
+                    os.path.getsize(self.timings_file) > constants.TIMINGS_FILE_MAX_MB * 1024 * 1024:
+                os.replace(self.timings_file, self.timings_file + ".1")
+            with open(self.timings_file, "a") as f:
+                f.write(line + "\n")
+        except OSError:  # Timings are not worth failing a job over
+            pass
+
+    def reset(self):
+        """
+        Drops every latency, counter and job timing, used between benchmark runs
+        :return: None
+        """
+        with self.lock:
+            self.histograms = {}
+            self.counters = collections.Counter()
+            self.jobs = collections.OrderedDict()
+            self.marks = {}
+
+    def summary(self):
+        """
+        Summarizes every stage and counter
+        :return: Dict with "stages", stage name -> histogram summary, and "counters", counter name -> count
+        """
+        with self.lock:
+            return {
+                "stages": {stage: h.summary() for stage, h in self.histograms.items()},
+                "counters": dict(self.counters),
+            }
+
+
+METRICS = Metrics()
@@ -0,0 +1,182 @@
+"""
+mover.py
+Author: Ian Smith
+Description: Move engine used by the JobManager to move job files and directories between the stage directories.
+Uses a plain rename when the source and target are on the same device. Across devices the data is copied by the kernel
+(os.copy_file_range or os.sendfile) into a temp dir on the target, fsync'd, verified and renamed into place before the
+source is removed.
+"""
+import errno
+import os
+import shutil
+
+RENAME = "rename"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+COPY = "copy"
+
+PARTIAL_SUFFIX = ".partial"  # Temp copies are hidden .<name>.partial entries in the target directory
+
+_CHUNK = 64 * 1024 * 1024
+
+
+def move(src, dst_dir):
+    """
+    Moves a file or directory into a directory
+    :param src: Path to the file or directory to move
+    :param dst_dir: Directory to move it into
+    :return: Tuple of the new path and the method used (RENAME, COPY_FILE_RANGE, SENDFILE or COPY)
+    :raises shutil.Error: if something with the same name already exists in dst_dir
+    """
+    src = os.path.abspath(src)
+    dst = os.path.join(os.path.abspath(dst_dir), os.path.basename(src))
+    if os.path.lexists(dst):
+        raise shutil.Error("Destination path '{}' already exists".format(dst))
+
+    if os.stat(src).st_dev == os.stat(dst_dir).st_dev:
+        try:
+            os.rename(src, dst)
+            return dst, RENAME
+        except OSError as e:
+            if e.errno != errno.EXDEV:  # Bind mounts can share st_dev but still refuse to rename across them
+                raise
+
+    tmp = os.path.join(os.path.dirname(dst), ".{}{}".format(os.path.basename(dst), PARTIAL_SUFFIX))
+    if os.path.lexists(tmp):  # Left over from a crash during an earlier copy
+        _remove(tmp)
+    try:
+        if os.path.isdir(src):
+            method = _copy_tree(src, tmp)
+        else:
+            method = _copy_file(src, tmp)
+        _fsync_dir(os.path.dirname(dst))
+        os.rename(tmp, dst)
+        _fsync_dir(os.path.dirname(dst))
+    except BaseException:
+        if os.path.lexists(tmp):
+            _remove(tmp)
+        raise
+    _remove(src)
+    return dst, method
+
+
+def remove_partials(directory):
+    """
+    Removes the temp copies a crash in the middle of a move left in a directory, the source of the move still exists
+    :param directory: Directory to clean up
+    :return: List of the names removed
+    """
+    removed = []
+    for entry in os.scandir(directory):
+        if entry.name.startswith(".") and entry.name.endswith(PARTIAL_SUFFIX):
+            _remove(entry.path)
+            removed.append(entry.name)
+    return removed
+
+
+def _copy_tree(src, dst):
+    """
+    Copies a directory tree, every file is fsync'd and verified
+    :param src: Source directory
+    :param dst: Target directory, must not exist
+    :return: The slowest copy method that had to be used for any file
+    """
+    methods = [COPY_FILE_RANGE]
+    os.mkdir(dst)
+    for entry in os.scandir(src):
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            methods.append(_copy_tree(entry.path, target))
+        elif entry.is_symlink():
+            os.symlink(os.readlink(entry.path), target)
+        else:
+            methods.append(_copy_file(entry.path, target))
+    shutil.copystat(src, dst)
+    _fsync_dir(dst)
+    order = [COPY_FILE_RANGE, SENDFILE, COPY]
+    return max(methods, key=order.index)
+
+
+def _copy_file(src, dst):
+    """
+    Copies a single file with kernel copy offload when available, then fsyncs it and verifies its size
+    :param src: Source file
+    :param dst: Target file, must not exist
+    :return: The copy method used
+    """
+    size = os.stat(src).st_size
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        method = _copy_data(fsrc.fileno(), fdst.fileno(), size)
+        if method == COPY:
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, _CHUNK)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, dst)
+    copied = os.stat(dst).st_size
+    if copied != size:
+        raise OSError(errno.EIO, "Copy of {} is incomplete ({} of {} bytes)".format(src, copied, size))
+    return method
+
+
+def _copy_data(fd_in, fd_out, size):
+    """
+    Copies file contents in the kernel, tries copy_file_range first and then sendfile
+    :param fd_in: Source file descriptor
+    :param fd_out: Target file descriptor
+    :param size: Number of bytes to copy
+    :return: COPY_FILE_RANGE or SENDFILE on success, COPY if the caller has to copy in user space
+    """
+    for method, func in ((COPY_FILE_RANGE, getattr(os, "copy_file_range", None)),
+                         (SENDFILE, getattr(os, "sendfile", None))):
+        if func is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if method == COPY_FILE_RANGE:
+                    sent = func(fd_in, fd_out, min(_CHUNK, size - offset), offset, offset)
+                else:
+                    sent = func(fd_out, fd_in, offset, min(_CHUNK, size - offset))
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF):
+                raise
+        if offset == size:
+            return method
+        os.ftruncate(fd_out, 0)  # Unsupported or short copy, start over with the next method
+    return COPY
+
+
+def _fsync_dir(path):
+    """
+    fsyncs a directory so renames and new entries in it survive a crash
+    :param path: Directory
+    :return: None
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _remove(path):
+    """
+    Removes a file or directory tree
+    :param path: Path to remove
+    :return: None
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
@@ -0,0 +1,93 @@
+"""
+pipeline.py
+Author: Ian Smith
+Description: Contains the Stage class used to split job handling into stages (segment -> transfer -> archive) that run
+on their own worker threads. Stages hand jobs to each other through bounded queues, when a stage falls behind its
+queue fills up and the stage before it blocks instead of piling up more work.
+"""
+import queue
+import threading
+import traceback
+
+
+_STOP = object()  # Put on a stage once per worker thread to stop it
+
+
+class Stage:
+    """
+    A class for one stage of the pipeline, a bounded queue of items and the worker threads that handle them
+    """
+    def __init__(self, name, handler, logger, workers=1, maxsize=0):
+        """
+        Constructor method
+        :param name: Name of the stage, used for thread names and logging
+        :param handler: Function called with every item put on the stage
+        :param logger: Injected Logger from ip_logging
+        :param workers: Number of worker threads
+        :param maxsize: Max number of items waiting on the stage, 0 for no limit
+        """
+        self.name = name
+        self.handler = handler
+        self.logs = logger
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        """
+        Starts the worker threads of the stage
+        :return: None
+        """
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="{}-{}".format(self.name, i))
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item, timeout=None):
+        """
+        Hands an item to the stage, blocks while the stage is full
+        :param item: Item for the handler
+        :param timeout: Max time to wait for space in seconds, None to wait until there is space
+        :return: None
+        :raises queue.Full: if the timeout elapsed
+        """
+        if self.queue.full():
+            self.logs.log_debug("{} stage is full, waiting for space".format(self.name))
+        self.queue.put(item, timeout=timeout)
+
+    def _run(self):
+        """
+        Event loop of a worker thread
+        :return: None
+        """
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                return
+            if not self.running:  # Left for whoever stopped the stage to recover
+                self.logs.log_debug("{} stage stopped, not handling {}".format(self.name, item))
+                self.queue.task_done()
+                continue
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.logs.log_error("Error in {} stage handling {}: {}".format(self.name, item, e))
+                self.logs.log_error(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker threads once they finish their current item, items still waiting on the stage are not handled
+        :param timeout: Max time to wait for each worker thread in seconds, None to wait until they finish
+        :return: None
+        """
+        self.running = False
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
@@ -3,12 +3,21 @@ process.py
 Author: Ian Smith
 Description: This module should contain all operations related to calling/executing image processing algorithms.
 """
+import yaml
 
 import constants, ip_utils
-from job import JobData
+from job import get_job_data, set_stage, stage_reached
+from job_types import get_job_type
+from metrics import METRICS
+from result_cache import ResultCache
+from supervisor import JobKilledError, JobTimeoutError, SupervisedProcess, apply_limits
+from warm_worker import WarmWorkerPool, WorkerCrashedError
 
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import traceback
 
 
@@ -26,31 +35,60 @@ class Processor:
         """
         self.logs = logger
         self.file_manager = file_manager
-        self.current = None
-        self.process = None
+        self.lock = threading.Lock()
+        self.current = {}  # Job name -> JobData of the jobs being processed
+        self.processes = {}  # Job name -> SupervisedProcess or WarmWorker running the job, shared by a batch's jobs
+        self.skipped = set()  # Names of jobs killed from the CLI, they are failed instead of retried
+        self._local = threading.local()  # Jobs and limits of the job a worker thread is running
+        self.warm_workers = WarmWorkerPool(logger) if constants.WARM_WORKERS > 0 else None
+        self.results = ResultCache(logger) if constants.RESULT_CACHE else None
+        self.stopped = False  # Set on shutdown, no new segmentation is started after that
         self._perform_startup()
 
     def _perform_startup(self):
         """
         On startup, clears the destination directory of jobs
+        Jobs are put back in batches and resume at their first incomplete stage when they are processed again
         :return: None
         """
         self.logs.log_debug("Retrieving files from destination dir")
         files = ip_utils.get_abs_paths(constants.DEST)
         for i in files:
+            try:
+                stage = get_job_data(i).data.get(constants.STAGE, constants.STAGE_INGESTED)
+            except (OSError, AttributeError, yaml.YAMLError) as e:  # Com file missing or corrupt, can not be resumed
+                self.logs.log_error("{} has an unreadable com file, moving it to {}: {}".format(
+                    os.path.basename(i), constants.FAILED, e))
+                self.file_manager.move(i, constants.FAILED)
+                continue
+            self.logs.log_debug("{} was interrupted after stage {}".format(os.path.basename(i), stage))
             self.file_manager.move(i, constants.BATCHES)
 
-    def process_image(self, job_base):
+    def process_image(self, job_base, reservation=None):
         """
-        Method to initialize the processing of an image
+        Method to initialize the processing of an image, can be called from several worker threads at once
         :param job_base: Path to the job
+        :param reservation: Reservation from the ResourceGovernor, the job is pinned to its cores
         :return: None
         """
-        job_data = JobData(job_base)
-        self.current = job_data
+        job_data = get_job_data(job_base)
+        if self._is_segmented(job_data):
+            self.logs.log_debug("{} already segmented, skipping segmentation".format(job_data.base_name))
+            return True
+        with self.lock:
+            if job_data.base_name in self.skipped:  # Skipped while part of a batch
+                self.skipped.discard(job_data.base_name)
+                self.logs.log_error("{} was skipped".format(job_data.base_name))
+                return False
+            self.current[job_data.base_name] = job_data
+        self._set_limits([job_data], reservation)
         try:
-            self._get_processor(job_data)
-            self.current = None
+            key = self._result_key(job_data)
+            if not self._restore_result(job_data, key):
+                with METRICS.time("segment", job_data.base_name):
+                    self._get_processor(job_data)
+                self._store_result(job_data, key)
+            set_stage(job_base, constants.STAGE_SEGMENTED)
             return True
         except FileNotFoundError as e:
             self.logs.log_error(f"FileNotFoundError: {e}")
@@ -58,26 +96,206 @@ class Processor:
         except NotImplementedError as e:
             self.logs.log_error(f"NotImplementedError: {e}")
             return False
+        except (JobTimeoutError, JobKilledError) as e:
+            self.logs.log_error("{} did not finish: {}".format(job_data.base_name, e))
+            return False
         except Exception as e:
             self.logs.log_error("An error has occurred with {}: {}".format(job_data.base_name, e))
             self.logs.log_error(traceback.format_exc())
             return False
         finally:
-            self.process = None
-            self.current = None
+            with self.lock:
+                self.processes.pop(job_data.base_name, None)
+                self.current.pop(job_data.base_name, None)
+                self.skipped.discard(job_data.base_name)
+
+    def process_batch(self, job_bases, reservation=None):
+        """
+        Method to process several jobs of the same type with one invocation of the processing algorithm
+        Jobs that are not part of the batch result are processed again on their own so that every failure is
+        attributed to the job that caused it
+        :param job_bases: List of paths to the jobs
+        :param reservation: Reservation from the ResourceGovernor, the jobs are pinned to its cores
+        :return: Dict of job path -> True if the job was processed successfully
+        """
+        results = {}
+        batch = []
+        stems = set()
+        keys = {}
+        for job_base in job_bases:
+            job_data = get_job_data(job_base)
+            if self._is_segmented(job_data):
+                self.logs.log_debug("{} already segmented, skipping segmentation".format(job_data.base_name))
+                results[job_base] = True
+                continue
+            keys[job_base] = self._result_key(job_data)
+            if self._restore_result(job_data, keys[job_base]):
+                set_stage(job_base, constants.STAGE_SEGMENTED)
+                results[job_base] = True
+                continue
+            image = (job_data.image_file_name or "").lower()
+            stem = os.path.splitext(image)[0]
+            if not image.endswith(constants.BATCH_IMAGE_EXT) or stem in stems:  # Masks could not be told apart
+                results[job_base] = None
+                continue
+            stems.add(stem)
+            batch.append(job_data)
+
+        done = set()
+        if len(batch) > 1:
+            with self.lock:
+                for job_data in batch:
+                    self.current[job_data.base_name] = job_data
+            self._set_limits(batch, reservation)
+            try:
+                with METRICS.time("segment_batch", [job_data.base_name for job_data in batch]):
+                    done = self._get_batch_processor(batch)
+            except (JobTimeoutError, JobKilledError) as e:
+                self.logs.log_error("Batch of {} jobs did not finish: {}".format(len(batch), e))
+            except Exception as e:
+                self.logs.log_error("An error has occurred with a batch of {} jobs: {}".format(len(batch), e))
+                self.logs.log_error(traceback.format_exc())
+            finally:
+                with self.lock:
+                    for job_data in batch:
+                        self.current.pop(job_data.base_name, None)
+        for job_data in batch:
+            if job_data.base in done:
+                self._store_result(job_data, keys.get(job_data.base))
+                set_stage(job_data.base, constants.STAGE_SEGMENTED)
+                self.logs.log_debug("{} finished successfully in a batch".format(job_data.base_name))
+                results[job_data.base] = True
+            else:
+                results[job_data.base] = None
+        for job_base, result in results.items():
+            if result is None:
+                results[job_base] = self.process_image(job_base, reservation)
+        return results
+
+    def _get_batch_processor(self, batch):
+        """
+        Factory method to choose the batch processing method for a batch of jobs of one type
+        :param batch: List of JobData
+        :return: Set of base dirs of the jobs that were processed successfully
+        """
+        job_type = get_job_type(batch[0].data.get(constants.JOB_TYPE))
+        if job_type.process_batch is None:
+            return set()
+        return getattr(self, job_type.process_batch)(batch)
+
+    def _set_limits(self, jobs, reservation):
+        """
+        Records the jobs a worker thread is about to run and the limits their processing command runs under
+        :param jobs: List of JobData processed by one command
+        :param reservation: Reservation from the ResourceGovernor, None to run on any core
+        :return: None
+        """
+        try:
+            timeout = get_job_type(jobs[0].data.get(constants.JOB_TYPE)).timeout
+        except NotImplementedError:
+            timeout = constants.JOB_TIMEOUT
+        self._local.jobs = [job_data.base_name for job_data in jobs]
+        self._local.cores = reservation.cores if reservation is not None else None
+        self._local.memory_gb = reservation.memory_gb if reservation is not None else None
+        self._local.timeout = timeout * len(jobs) if timeout else None
+
+    def skip(self, jobname):
+        """
+        Kills the processing of a running job, a job in a batch takes the rest of the batch down with it and they are
+        processed again on their own
+        :param jobname: Name of the job
+        :return: List of JobData of the jobs that were killed, empty if the job is not being processed
+        """
+        with self.lock:
+            if jobname not in self.current:
+                return []
+            self.skipped.add(jobname)
+            process = self.processes.get(jobname)
+            if process is None:  # Process not started yet, it is killed as soon as it is
+                return [self.current[jobname]]
+            killed = [self.current[name] for name, p in self.processes.items() if p is process and name in self.current]
+        self.logs.log_debug("Skipping {}".format(jobname))
+        process.kill()
+        return killed
+
+    def get_running(self):
+        """
+        Gets the jobs that are currently being processed
+        :return: List of JobData
+        """
+        with self.lock:
+            return list(self.current.values())
+
+    def _result_key(self, job_data):
+        """
+        Computes the result cache key of a job
+        :param job_data: JobData
+        :return: Key, None if the result cache is off or the job can not be cached
+        """
+        if self.results is None:
+            return None
+        try:
+            with METRICS.time("hash", job_data.base_name):
+                return self.results.key(self._image_path(job_data),
+                                        get_job_type(job_data.data.get(constants.JOB_TYPE)))
+        except NotImplementedError:  # Fails as soon as it is processed
+            return None
+        except OSError as e:
+            self.logs.log_error("Could not hash {} for the result cache: {}".format(job_data.base_name, e))
+            return None
+
+    def _restore_result(self, job_data, key):
+        """
+        Copies the cached result of an identical job into a job's masks dir
+        :param job_data: JobData
+        :param key: Result cache key of the job
+        :return: True if the result was restored and the job does not need to be processed
+        """
+        if key is None:
+            return False
+        stem = os.path.splitext(os.path.basename(self._image_path(job_data)))[0]
+        with METRICS.time("cache_restore", job_data.base_name):
+            restored = self.results.restore(key, job_data.proc_dir_path, stem)
+        METRICS.incr("result_cache_hit" if restored else "result_cache_miss")
+        if not restored:
+            return False
+        self.logs.log_debug("{} reused the cached result of an identical image".format(job_data.base_name))
+        return True
+
+    def _store_result(self, job_data, key):
+        """
+        Adds the result of a processed job to the result cache, failures only cost the cache entry
+        :param job_data: JobData
+        :param key: Result cache key of the job
+        :return: None
+        """
+        if key is None:
+            return
+        try:
+            stem = os.path.splitext(os.path.basename(self._image_path(job_data)))[0]
+            self.results.store(key, job_data.proc_dir_path, stem)
+        except OSError as e:
+            self.logs.log_error("Could not cache the result of {}: {}".format(job_data.base_name, e))
+
+    @staticmethod
+    def _is_segmented(job_data):
+        """
+        Checks if a job was already segmented before a restart and its masks are still there
+        :param job_data: JobData
+        :return: True if segmentation can be skipped
+        """
+        if not stage_reached(job_data, constants.STAGE_SEGMENTED):
+            return False
+        return os.path.isdir(job_data.proc_dir_path) and len(os.listdir(job_data.proc_dir_path)) > 0
 
     def _get_processor(self, job_data):
         """
-        Factory method to choose the processing method for selected job
+        Factory method to choose the processing method for selected job, the method is looked up in job_types
         :param job_data: JobData
         :return: None
         """
-        job_type = job_data.data.get(constants.JOB_TYPE)
-        job_type = job_type.lower()
-        if job_type == "radius_tibia_final":
-            self._radius_tibia_final(job_data)
-        else:
-            raise NotImplementedError(f"Job Type: {job_type} not implemented in this system.")
+        job_type = get_job_type(job_data.data.get(constants.JOB_TYPE))
+        getattr(self, job_type.process)(job_data)
 
     def _radius_tibia_final(self, job_data):
         """
@@ -98,17 +316,178 @@ class Processor:
         cmd = [constants.RAD_TIB_PATH_TO_ENV, constants.RAD_TIB_PATH_TO_START, job_data.base,
                constants.RAD_TIB_TRAINED_MODELS, "--image-pattern", job_data.image_file_name.lower()]
 
-        self.process = subprocess.run(cmd)
+        returncode = self._segment(job_data.base_name, cmd)
 
-        if self.process.returncode == 0:
+        if returncode == 0:
             self.logs.log_debug("radius-tibia-final job {} finished successfully".format(job_data.base_name))
         else:
-            raise subprocess.CalledProcessError(self.process.returncode, cmd)
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def _radius_tibia_final_batch(self, batch):
+        """
+        Method to execute the radius-tibia image segmentation on several jobs with one invocation of segment.py
+        The images are linked into a staging dir in tmp, segmented together and the masks are moved back into the
+        masks dir of the job they belong to
+        :param batch: List of JobData
+        :return: Set of base dirs of the jobs that got both of their masks
+        """
+        if not os.path.exists(constants.RAD_TIB_PATH_TO_ENV):
+            raise FileNotFoundError("Path to bl_torch python executable does not exist")
+        elif not os.path.exists(constants.RAD_TIB_PATH_TO_START):
+            raise FileNotFoundError("Path to HR-pQCT-Segmentation segment.py does not exist")
+
+        staging = tempfile.mkdtemp(prefix="batch-", dir=os.path.abspath(constants.TMP))
+        try:
+            stems = {}
+            for job_data in batch:
+                image = self._image_path(job_data)
+                name = os.path.basename(image).lower()
+                try:
+                    os.link(image, os.path.join(staging, name))
+                except OSError:  # tmp is on another file system
+                    os.symlink(image, os.path.join(staging, name))
+                stems[os.path.splitext(name)[0]] = job_data
+            self.logs.log_debug("Processing batch of {} jobs: {}".format(
+                len(batch), ", ".join(jd.base_name for jd in batch)))
+
+            cmd = [constants.RAD_TIB_PATH_TO_ENV, constants.RAD_TIB_PATH_TO_START, staging,
+                   constants.RAD_TIB_TRAINED_MODELS, "--image-pattern", "*" + constants.BATCH_IMAGE_EXT]
+            returncode = self._segment(os.path.basename(staging), cmd)
+            if returncode != 0:
+                self.logs.log_error("Batch segmentation failed with code {}".format(returncode))
+                return set()
+
+            masks_dir = os.path.join(staging, "masks")
+            found = {}
+            for mask in (os.listdir(masks_dir) if os.path.isdir(masks_dir) else []):
+                # Masks are named <image stem>_..., the longest matching stem wins in case one stem prefixes another
+                owners = [stem for stem in stems if mask.lower().startswith(stem + "_")]
+                if not owners:
+                    continue
+                job_data = stems[max(owners, key=len)]
+                os.makedirs(job_data.proc_dir_path, exist_ok=True)
+                os.replace(os.path.join(masks_dir, mask), os.path.join(job_data.proc_dir_path, mask))
+                found.setdefault(job_data.base, []).append(mask.upper())
+            done = set()
+            for base, masks in found.items():
+                if any(m.endswith("_CORT_MASK.AIM") for m in masks) and any(m.endswith("_TRAB_MASK.AIM") for m in masks):
+                    done.add(base)
+            return done
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @staticmethod
+    def _image_path(job_data):
+        """
+        Gets the path of a job's image whatever the case of its file name
+        :param job_data: JobData instance
+        :return: Path to the image
+        """
+        if job_data.image_file_path is not None:
+            return job_data.image_file_path
+        for file in os.listdir(job_data.base):
+            if file.lower() == job_data.image_file_name.lower():
+                return os.path.join(job_data.base, file)
+        raise FileNotFoundError("Image file for {} not found".format(job_data.base_name))
+
+    def _segment(self, name, cmd):
+        """
+        Runs a segment.py command, in a warm worker if one is available and in a new process otherwise
+        The command is pinned to the cores reserved for the job, runs at constants.JOB_NICE and is killed after the
+        timeout of its job type
+        :param name: Name of the job or the batch, used for logging
+        :param cmd: Full command, interpreter and script followed by the arguments for segment.py
+        :return: Return code of segment.py
+        :raises JobTimeoutError: if segment.py ran past the timeout
+        :raises JobKilledError: if the job was skipped or the server is shutting down
+        """
+        if self.stopped:
+            raise JobKilledError("Processor is shut down, not starting {}".format(name))
+        returncode = self._run_warm(name, cmd[2:])
+        if returncode is None:  # No warm worker available, run segment.py in a new interpreter
+            memory_gb, cpu_seconds = self._limits()
+            process = SupervisedProcess(cmd, self.logs, self._local.cores, constants.JOB_NICE, memory_gb, cpu_seconds)
+            self._track(process)
+            try:
+                returncode = process.wait(self._local.timeout)
+            finally:
+                self._untrack()
+        return returncode
+
+    def _limits(self):
+        """
+        Gets the rlimits for the jobs of the current worker thread from their reservation and timeout
+        :return: Tuple of the memory limit in GB and the CPU time limit in seconds, either can be None for no limit
+        """
+        memory_gb = self._local.memory_gb * constants.JOB_MEMORY_RLIMIT_FACTOR if self._local.memory_gb else None
+        cpu_seconds = self._local.timeout * len(self._local.cores) if self._local.timeout and self._local.cores \
+            else None
+        return memory_gb, cpu_seconds
+
+    def _track(self, process):
+        """
+        Registers the process running the jobs of the current worker thread so they can be skipped
+        :param process: SupervisedProcess or WarmWorker
+        :return: None
+        :raises JobKilledError: if one of the jobs was skipped or the server shut down before the process was registered
+        """
+        with self.lock:
+            for name in self._local.jobs:
+                self.processes[name] = process
+            cancelled = self.stopped or any(name in self.skipped for name in self._local.jobs)
+        if cancelled:
+            process.kill()
+
+    def _untrack(self):
+        """
+        Removes the process of the current worker thread
+        :return: None
+        """
+        with self.lock:
+            for name in self._local.jobs:
+                self.processes.pop(name, None)
+
+    def _run_warm(self, name, argv):
+        """
+        Runs segment.py in a warm worker that already has the interpreter and model libraries loaded
+        :param name: Name of the job or the batch, used for logging
+        :param argv: Arguments for segment.py
+        :return: Return code of segment.py, None if no warm worker could be used
+        :raises JobTimeoutError: if segment.py ran past the timeout, the worker is killed
+        :raises JobKilledError: if the job was skipped or the server is shutting down, the worker is killed
+        """
+        if self.warm_workers is None:
+            return None
+        worker = self.warm_workers.checkout()
+        if worker is None:
+            return None
+        memory_gb, cpu_seconds = self._limits()
+        apply_limits(worker.process.pid, self.logs, self._local.cores, constants.JOB_NICE, memory_gb, cpu_seconds,
+                     reusable=True)
+        self._track(worker)
+        try:
+            returncode = worker.run(argv, self._local.timeout)
+        except WorkerCrashedError as e:
+            self.logs.log_error("Warm worker crashed on {}, retrying in a new process: {}".format(name, e))
+            self.warm_workers.checkin(worker, crashed=True)
+            return None
+        except (JobTimeoutError, JobKilledError):
+            self.warm_workers.checkin(worker, crashed=True)
+            raise
+        finally:
+            self._untrack()
+        self.warm_workers.checkin(worker)
+        return returncode
 
     def shutdown(self):
         """
         Method to shut down the processing module
         :return:
         """
-        if self.process is not None:
-            self.process.kill()
+        self.stopped = True
+        with self.lock:
+            processes = set(self.processes.values())
+        for process in processes:
+            process.kill()
+        if self.warm_workers is not None:
+            self.warm_workers.kill_all()
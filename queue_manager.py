@@ -5,34 +5,165 @@ Description: This module contains only one class ManagedQueue which is to be use
 Created: 2023-06-20
 """
 import os
+import heapq
+import itertools
 import threading
-from queue import Queue
-import json
+import time
 
 import constants
-from job import JobData
+import journal
+from journal import QueueJournal
+from job import get_job_data
+from metrics import METRICS
 import ip_utils
 
+
+def read_job_type(job_dir):
+    """
+    Reads the job type of a job, done once when it is queued so the queue never has to read the com file again
+    :param job_dir: Base directory of a job
+    :return: Lowercase job type, None if the metadata can not be read
+    """
+    try:
+        return (get_job_data(job_dir).data.get(constants.JOB_TYPE) or "").lower()
+    except (OSError, AttributeError):  # Metadata unreadable, the job fails when it is processed
+        return None
+
+
 class ManagedQueue:
-    def __init__(self, logger):
+    """
+    Job queue for the system, a lock protected heap of entries indexed by job name
+    Each entry is [key, seq, name, path, valid, job type], jobs come off the queue in order of key. Removed or
+    re-prioritized entries are marked invalid and skipped when popped so that they do not have to be searched for in the
+    heap. Every job type has its own heap of the same entries, jobs of one type need the same resources so only the
+    first job of each type has to be checked to find the first job that can start.
+    """
+    def __init__(self, logger, journal=None):
         """
         Constructor Method
         :param logger: Injected logger from the ip_logging module
+        :param journal: QueueJournal used to persist the queue, defaults to one at constants.QUEUE_JOURNAL
         """
+        self.logs = logger
+        self.journal = QueueJournal(logger) if journal is None else journal
         self.lock = threading.Lock()
-        self.JOB_QUEUE = Queue()
+        self.not_empty = threading.Condition(self.lock)
+        self._heap = []
+        self._by_type = {}  # job type -> heap of the entries of that type
+        self._index = {}  # lowercase job name -> entry
+        self._version = 0  # Bumped whenever waiting workers are notified, a change they may have missed
+        self._seq = itertools.count()
+        self._passed = {}  # seq -> times the entry was passed by a job behind it that fit when it did not
+        self._last_key = 0.0
         self._perform_startup()
-        self.logs = logger
 
     def _perform_startup(self):
         """
         After a restart/crash this method allows for the jobs that were on the queue to be re-queued
+        The queue order is replayed from the journal and reconciled with the jobs in the batches dir, the job types come
+        from the journal too, only jobs it has no type for have their com file read
         :return:None
         """
+        entries = [(key, item, read_job_type(item) if job_type is None else job_type)
+                   for key, item, job_type in self.journal.recover(ip_utils.get_abs_paths(constants.BATCHES))]
+        with self.lock:
+            for key, item, job_type in entries:
+                self._push(item, key, job_type)
+            self.journal.compact(self._snapshot())
+
+    def _push(self, job_dir, key=None, job_type=None):
+        """
+        Adds an entry to the heaps and index, lock must be held
+        :param job_dir: Base directory of a job
+        :param key: Position key, defaults to the back of the queue
+        :param job_type: Job type from read_job_type
+        :return: The new entry
+        """
+        if key is None:
+            self._last_key += 1.0
+            key = self._last_key
+        else:
+            self._last_key = max(self._last_key, key)
+        name = os.path.basename(job_dir)
+        old = self._index.get(name.lower())
+        if old is not None:
+            old[4] = False
+        entry = [key, next(self._seq), name, job_dir, True, job_type]
+        self._index[name.lower()] = entry
+        heapq.heappush(self._heap, entry)
+        heapq.heappush(self._by_type.setdefault(job_type, []), entry)
+        self._notify()  # Both idle workers and workers collecting a batch may be waiting
+        return entry
+
+    def _notify(self):
+        """
+        Wakes every waiting thread, lock must be held
+        :return: None
+        """
+        self._version += 1
+        self.not_empty.notify_all()
+
+    def _discard(self, entry):
+        """
+        Marks an entry as removed, compacts the heap once most of it is removed entries, lock must be held
+        :param entry: Entry to remove
+        :return: None
+        """
+        entry[4] = False
+        self._passed.pop(entry[1], None)
+        if self._index.get(entry[2].lower()) is entry:
+            del self._index[entry[2].lower()]
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._index):
+            self._heap = [e for e in self._heap if e[4]]
+            heapq.heapify(self._heap)
+            self._by_type = {}
+            for e in self._heap:
+                self._by_type.setdefault(e[5], []).append(e)
+            for heap in self._by_type.values():
+                heapq.heapify(heap)
+
+    def _head(self, job_type):
+        """
+        Gets the first queued job of a type, lock must be held
+        :param job_type: Job type
+        :return: Entry, None if no job of the type is queued
+        """
+        heap = self._by_type.get(job_type)
+        while heap and not heap[0][4]:
+            heapq.heappop(heap)
+        if not heap:
+            self._by_type.pop(job_type, None)
+            return None
+        return heap[0]
+
+    def _snapshot(self):
+        """
+        Gets the queue as (name, path, key, job type) tuples for the journal snapshot, lock must be held
+        :return: List of tuples in queue order
+        """
+        return [(e[2], e[3], e[0], e[5]) for e in self._ordered()]
 
-        lis = ip_utils.get_abs_paths(constants.BATCHES)
-        for item in lis:
-            self.JOB_QUEUE.put(item)
+    def _journal(self, op, entry):
+        """
+        Records a change to the queue in the journal, takes a new snapshot when the journal gets long, lock must be held
+        :param op: Journal operation
+        :param entry: Entry that was changed
+        :return: None
+        """
+        try:
+            self.journal.append(op, entry[2], entry[3], entry[0],
+                                entry[5] if op in (journal.ENQUEUE, journal.MOVE) else None)
+            if self.journal.needs_compaction():
+                self.journal.compact(self._snapshot())
+        except OSError as e:  # The in memory queue is still correct, only the restart order is at risk
+            self.logs.log_error("Failed to write queue journal: {}".format(e))
+
+    def _ordered(self):
+        """
+        Gets the valid entries in queue order, lock must be held
+        :return: List of entries
+        """
+        return sorted(e for e in self._heap if e[4])
 
     def enqueue(self, job_dir):
         """
@@ -40,30 +171,100 @@ class ManagedQueue:
         :param job_dir: Base directory of a job
         :return: None
         """
-        jd = JobData(job_dir)
+        jd = get_job_data(job_dir)
+        job_type = (jd.data.get(constants.JOB_TYPE) or "").lower()
+        with self.lock:
+            self._journal(journal.ENQUEUE, self._push(job_dir, job_type=job_type))
+        METRICS.mark(os.path.basename(job_dir), "enqueued")
         self.logs.log_debug("Enqueued {}".format(jd.image_file_name))
-        self.JOB_QUEUE.put(job_dir)
-        #self.set_checkpoint()
 
-    def dequeue(self):
+    def dequeue_admissible(self, admit, release, cancel=None, max_skips=None):
         """
-        Method to dequeue a job from the ManagedQueue
-        :return: Base directory of a job
+        Method to dequeue the first job that can be started now, blocks until there is one
+        Jobs that do not fit keep their place and can be passed by smaller jobs behind them, once a job has been passed
+        max_skips times the jobs behind it wait until it is started. Only the first job of each type is tried, the
+        jobs behind it need the same resources
+        :param admit: Function taking the name and job type of a job, returns a reservation if the job can start and
+                      None otherwise. Called without the queue lock
+        :param release: Function giving back a reservation from admit, used when another worker took the job first
+        :param cancel: Function checked whenever the queue is woken, the wait is given up once it returns True
+        :param max_skips: Times a job can be passed, defaults to constants.MAX_QUEUE_SKIPS
+        :return: Tuple of the base directory of the job and the reservation from admit, (None, None) if cancelled
         """
-        jd = JobData(self.JOB_QUEUE.get())
-        self.logs.log_debug("Dequeued {}".format(jd.image_file_name))
-        #self.set_checkpoint()
-        return jd.base
+        max_skips = constants.MAX_QUEUE_SKIPS if max_skips is None else max_skips
+        while True:
+            with self.lock:
+                if cancel is not None and cancel():
+                    return None, None
+                heads = sorted(h for h in (self._head(t) for t in list(self._by_type)) if h is not None)
+                passed = [self._passed.get(e[1], 0) for e in heads]
+                version = self._version
+            taken = reservation = None
+            blocked = []
+            for entry, times in zip(heads, passed):
+                reservation = admit(entry[2], entry[5])
+                if reservation is not None:
+                    taken = entry
+                    break
+                blocked.append(entry)
+                if times >= max_skips:  # Resources are left to drain for this job
+                    break
+            with self.not_empty:
+                if taken is not None and taken[4]:
+                    for entry in blocked:
+                        if entry[4]:
+                            self._passed[entry[1]] = self._passed.get(entry[1], 0) + 1
+                    self._discard(taken)
+                    self._journal(journal.DEQUEUE, taken)
+                    break
+                if taken is None and version == self._version:
+                    # Released resources wake the queue, memory freed outside the server does not so check again later
+                    self.not_empty.wait(None if not self._index else 5)
+            if taken is not None:  # Another worker dequeued the job first
+                release(reservation)
+        METRICS.since(taken[2], "enqueued", "queue_wait")
+        self.logs.log_debug("Dequeued {}".format(taken[2]))
+        return taken[3], reservation
 
-    def queue_to_list(self):
+    def dequeue_matching(self, job_type, limit, window=0):
         """
-        Method to turn the queue into a list
-        :return:
+        Method to take up to limit queued jobs of a type, used to collect batches of similar jobs
+        Jobs of other types keep their place on the queue
+        :param job_type: Job type from read_job_type
+        :param limit: Max number of jobs to take
+        :param window: Max time in seconds to wait for more jobs of the type to be enqueued
+        :return: List of base directories of the jobs taken, in queue order
         """
-        a = []
-        while not self.JOB_QUEUE.empty():
-            a.append(self.JOB_QUEUE.get())
-        return a
+        taken = []
+        deadline = time.monotonic() + window
+        with self.not_empty:
+            while len(taken) < limit:
+                entry = self._head(job_type)
+                if entry is not None:
+                    self._discard(entry)
+                    self._journal(journal.DEQUEUE, entry)
+                    taken.append(entry[3])
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+        for path in taken:
+            METRICS.since(os.path.basename(path), "enqueued", "queue_wait")
+            self.logs.log_debug("Dequeued {} into a batch".format(os.path.basename(path)))
+        return taken
+
+    def wake(self):
+        """
+        Wakes every thread blocked on the queue so that it checks its cancel function
+        :return: None
+        """
+        with self.not_empty:
+            self._notify()
+
+    def __len__(self):
+        with self.lock:
+            return len(self._index)
 
     # Functionality for move function
     def move_queue(self, jobname, index):
@@ -75,32 +276,37 @@ class ManagedQueue:
         """
         index = int(index)
         index = index - 1  # index - 1 because when the queue is displayed via the CLI 0 represents the item being processed
-        a = self.queue_to_list()
-        if index > len(a) - 1 or index < 0:
-            raise ValueError("Index out of range of the queue")
-        to_move = None
-        for item in a:  # Finding item that needs to be moved in the queue
-            if jobname.lower() in JobData(item).data.get(constants.F_NAME):
-                a.remove(item)
-                to_move = item
-                break
-        a.insert(index, to_move)  # Moving requested item
-        for item in a:  # Putting everything back on the queue
-            self.JOB_QUEUE.put(item)
+        with self.lock:
+            entry = self._index.get(jobname.lower())
+            if entry is None:
+                raise ValueError("Job {} is not on the queue".format(jobname))
+            if index > len(self._index) - 1 or index < 0:
+                raise ValueError("Index out of range of the queue")
+            # Only the jobs up to the new position are needed to find the keys on either side of it
+            ahead = [e for e in heapq.nsmallest(index + 2, (e for e in self._heap if e[4])) if e is not entry]
+            if index == 0:
+                key = ahead[0][0] - 1.0 if ahead else self._last_key + 1.0
+            elif index >= len(ahead):
+                key = self._last_key + 1.0
+            else:
+                key = (ahead[index - 1][0] + ahead[index][0]) / 2
+            self._discard(entry)
+            self._journal(journal.MOVE, self._push(entry[3], key, entry[5]))
 
     def remove_from_queue(self, jobname):
         """
         Allows for the removal of a job from the queue, primarily used by the CLI
         :param jobname: Name of a job
-        :return:
+        :return: Base directory of the removed job, None if the job is not on the queue
         """
-        a = self.queue_to_list()
-        for item in a:
-            if JobData(item).base_name.lower() == jobname.lower():
-                item.append_to_com()
-                os.remove(item)
-            else:
-                self.JOB_QUEUE.put(item)
+        with self.lock:
+            entry = self._index.get(jobname.lower())
+            if entry is None:
+                return None
+            self._discard(entry)
+            self._journal(journal.REMOVE, entry)
+        self.logs.log_debug("Removed {} from the queue".format(entry[2]))
+        return entry[3]
 
     # Functionality for jobs command
     def get_state(self):
@@ -108,44 +314,32 @@ class ManagedQueue:
         Method to return a list of jobs that are on the queue, primarily used by the CLI
         :return: Returns a list of jobs from the queue
         """
-        a = self.queue_to_list()
-        b = []
-        for path in a:
-            b.append(JobData(path))
-            self.JOB_QUEUE.put(path)
-        return b
+        with self.lock:
+            paths = [e[3] for e in self._ordered()]
+        return [get_job_data(path) for path in paths]
 
-    # New features below here, still testing
     def clear(self):
-        while not self.JOB_QUEUE.empty():
-            self.JOB_QUEUE.get()
+        with self.lock:
+            self._heap = []
+            self._by_type = {}
+            self._index = {}
+            self.journal.compact([])
 
     def set_state(self, new_state):
-        self.clear()
-        for i in new_state:
-            self.JOB_QUEUE.put(i)
-
-    def set_checkpoint(self):
-        """
-        Sets the json checkpoint file to the state of the queue
-        :return:
-        """
-        state = self.get_state()
-        with open(constants.QUEUE_CHECKPOINT, "w") as checkpoint_file:
-            json.dump(state, checkpoint_file)
+        job_types = [read_job_type(i) for i in new_state]
+        with self.lock:
+            self._heap = []
+            self._by_type = {}
+            self._index = {}
+            for i, job_type in zip(new_state, job_types):
+                self._push(i, job_type=job_type)
+            self.journal.compact(self._snapshot())
 
-    def get_checkpoint(self):
+    def close(self):
         """
-        Used to set the state of the queue on startup
-        :return:
+        Takes a final snapshot of the queue and closes the journal
+        :return: None
         """
-        # TODO Need to make sure that this returns list
-        with open(constants.QUEUE_CHECKPOINT, "r") as checkpoint_file:
-            state = json.load(checkpoint_file)
-        self.set_state(state)
-
-
-
-
-
-
+        with self.lock:
+            self.journal.compact(self._snapshot())
+        self.journal.close()
@@ -0,0 +1,148 @@
+"""
+readiness.py
+Author: Ian Smith
+Description: Contains the ReadinessTracker class which decides if a file in rec has finished uploading. A file is
+considered complete once its size and modification time have been stable for constants.READY_STABLE_TIME seconds or
+as soon as a sidecar marker file (<file><constants.READY_MARKER_EXT>) exists next to it.
+"""
+import constants
+
+import os
+import threading
+import time
+
+
+class FileNotReadyError(Exception):
+    """
+    Raised when a submission is still being uploaded and should be looked at again later
+    """
+    pass
+
+
+class ReadinessTracker:
+    """
+    A class to keep track of files that are being uploaded into the rec directory
+    Keeps a small table of path -> (size, mtime, last change) so every file is only stat'd once per tick
+    """
+    def __init__(self, stable_time=None, marker_ext=None):
+        """
+        Constructor method
+        :param stable_time: Seconds a file has to stay unchanged to be complete, defaults to constants.READY_STABLE_TIME
+        :param marker_ext: Extension of the optional sidecar marker file, defaults to constants.READY_MARKER_EXT
+        """
+        self.stable_time = constants.READY_STABLE_TIME if stable_time is None else stable_time
+        self.marker_ext = constants.READY_MARKER_EXT if marker_ext is None else marker_ext
+        self.lock = threading.Lock()
+        self._table = {}  # path -> [size, mtime_ns, changed_at, tick, ready, parsed contents]
+        self._first_seen = {}  # path -> time the file was first seen, used to time out incomplete submissions
+        self._tick = 0
+
+    def tick(self):
+        """
+        Starts a new scan of the rec directory, files will be stat'd again on their next check
+        :return: None
+        """
+        with self.lock:
+            self._tick += 1
+
+    def is_ready(self, path):
+        """
+        Checks if a file has finished uploading
+        :param path: Path to the file
+        :return: True if the file is complete
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with self.lock:
+            entry = self._table.get(path)
+            if entry is not None and entry[3] == self._tick:
+                return entry[4]
+            now = time.time()
+            self._first_seen.setdefault(path, now)
+            if self.marker_ext and os.path.exists(path + self.marker_ext):
+                st = os.stat(path)
+                self._table[path] = [st.st_size, st.st_mtime_ns, now, self._tick, True, self._contents(entry, st)]
+                return True
+            st = os.stat(path)
+            if entry is None:
+                changed_at = min(now, st.st_mtime)  # A file that has not been touched in a while is already stable
+            elif entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                changed_at = now
+            else:
+                changed_at = entry[2]
+            ready = now - changed_at >= self.stable_time
+            self._table[path] = [st.st_size, st.st_mtime_ns, changed_at, self._tick, ready, self._contents(entry, st)]
+            return ready
+
+    @staticmethod
+    def _contents(entry, st):
+        """
+        Keeps the parsed contents of a file only if the file has not changed since it was parsed
+        :param entry: Previous table entry or None
+        :param st: Current stat result of the file
+        :return: The parsed contents or None
+        """
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[5]
+        return None
+
+    def parse(self, path, parser):
+        """
+        Parses a file once, later calls return the stored result until the file changes
+        Call is_ready on the file first so that its size/mtime are in the table
+        :param path: Path to the file
+        :param parser: Function taking the path and returning the parsed contents
+        :return: The parsed contents
+        """
+        with self.lock:
+            entry = self._table.get(path)
+            if entry is not None and entry[5] is not None:
+                return entry[5]
+        contents = parser(path)
+        with self.lock:
+            entry = self._table.get(path)
+            if entry is not None:
+                entry[5] = contents
+        return contents
+
+    def waiting_for(self, path):
+        """
+        Gets how long a file has been tracked without being ingested
+        :param path: Path to the file
+        :return: Seconds since the file was first checked
+        """
+        with self.lock:
+            first = self._first_seen.get(path)
+        return 0 if first is None else time.time() - first
+
+    def forget(self, *paths):
+        """
+        Removes files from the table once they have been ingested or failed
+        :param paths: Paths to the files
+        :return: None
+        """
+        with self.lock:
+            for path in paths:
+                self._table.pop(path, None)
+                self._first_seen.pop(path, None)
+
+    def prune(self, present):
+        """
+        Drops files that are no longer in the rec directory from the table
+        :param present: Collection of paths that still exist
+        :return: None
+        """
+        present = set(present)
+        with self.lock:
+            for path in [p for p in self._table if p not in present]:
+                self._table.pop(path, None)
+                self._first_seen.pop(path, None)
+
+    def marker_path(self, path):
+        """
+        Gets the path of the sidecar marker of a file
+        :param path: Path to the file
+        :return: Path to the marker file or None if markers are not used
+        """
+        if not self.marker_ext:
+            return None
+        return path + self.marker_ext
@@ -0,0 +1,149 @@
+"""
+remote_procedure.py
+Author: Ian Smith
+Description: Batches the commands run on a VMS host after a transfer into one generated DCL procedure. Every remote
+ssh command starts a new DCL process on the scanner, so instead of one ssh call per step the steps are written to a
+.COM file that is uploaded with the masks and run with a single call. Steps can be grouped, e.g. one group per job
+when several jobs are sent together. The procedure prints a status line after each step and skips the rest of a group
+once one of its steps fails, the output is parsed back into the status of every step.
+"""
+import os
+import re
+
+STEP_MARKER = "IPS_STEP"  # Start of the status lines the procedure prints
+
+
+class RemoteStepError(Exception):
+    """
+    Raised when a step of a remote procedure failed or did not run
+    """
+    pass
+
+
+class ProcedureError(Exception):
+    """
+    Raised when a remote procedure printed no status at all, it was not found or the connection dropped
+    """
+    pass
+
+
+def procedure_name(stem, suffix="_POST"):
+    """
+    Gets a valid VMS file name for the procedure of a job
+    :param stem: Name of the job or image the procedure is for
+    :param suffix: Added to the stem
+    :return: File name ending in .COM, at most 39 characters before the extension
+    """
+    stem = re.sub(r"[^A-Za-z0-9_$-]", "_", os.path.splitext(os.path.basename(stem))[0]).upper()
+    return stem[:39 - len(suffix)] + suffix + ".COM"
+
+
+def vms_status(status):
+    """
+    Formats a VMS condition value the way DCL shows it
+    :param status: Condition value, None if the step did not run
+    :return: e.g. %X00000001
+    """
+    return "not run" if status is None else "%X{:08X}".format(status & 0xFFFFFFFF)
+
+
+class RemoteProcedure:
+    """
+    A class to build a DCL procedure out of steps and read back how they went
+    """
+    def __init__(self, name):
+        """
+        Constructor method
+        :param name: File name of the procedure, see procedure_name
+        """
+        self.name = name
+        self.steps = []  # (group, step name, DCL command, key printed in the status line)
+        self.groups = []  # Groups in the order they were first added to
+
+    def add(self, step, command, group=None):
+        """
+        Adds a step, steps run in the order they were added
+        :param step: Name of the step, letters, digits and underscores
+        :param command: DCL command without the leading $
+        :param group: Group the step belongs to, e.g. the job it is for, None when the procedure is not grouped
+        :return: None
+        """
+        if group not in self.groups:
+            self.groups.append(group)
+        key = step if group is None else "G{}_{}".format(self.groups.index(group), step)
+        self.steps.append((group, step, command, key))
+
+    def script(self):
+        """
+        Generates the procedure, it deletes itself once every step succeeded so a failed one can be run again
+        :return: Text of the procedure
+        """
+        lines = ["$ SET NOON", "$ ALL_STATUS = 1"]
+        for index, group in enumerate(self.groups):
+            for step_group, _, command, key in self.steps:
+                if step_group != group:
+                    continue
+                lines += [
+                    "$ " + command,
+                    "$ STEP_STATUS = $STATUS",
+                    "$ WRITE SYS$OUTPUT \"{} {} ''STEP_STATUS'\"".format(STEP_MARKER, key),
+                    "$ IF .NOT. STEP_STATUS THEN GOTO FAILED_{}".format(index),
+                ]
+            lines += [
+                "$ GOTO END_{}".format(index),
+                "$ FAILED_{}:".format(index),
+                "$ ALL_STATUS = STEP_STATUS",
+                "$ END_{}:".format(index),
+            ]
+        lines += [
+            "$ IF ALL_STATUS THEN DELETE/NOLOG 'F$ENVIRONMENT(\"PROCEDURE\")'",
+            "$ EXIT ALL_STATUS",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        """
+        Writes the procedure into a directory so it can be uploaded
+        :param directory: Local directory
+        :return: Path to the procedure
+        """
+        path = os.path.join(directory, self.name)
+        with open(path, "w") as f:
+            f.write(self.script())
+        return path
+
+    def parse(self, output, group=None):
+        """
+        Reads the status of the steps of a group out of the output of the procedure
+        :param output: Text the procedure printed
+        :param group: Group to read, None for every step
+        :return: List of (step name, condition value), the value is None for steps that did not run
+        :raises ProcedureError: if the output has no status line at all
+        """
+        statuses = {}
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == STEP_MARKER:
+                try:
+                    statuses[parts[1].lower()] = int(parts[2])
+                except ValueError:
+                    continue
+        if not statuses:
+            raise ProcedureError("{} did not run: {}".format(self.name, output.strip()[-200:] or "no output"))
+        return [(step, statuses.get(key.lower())) for step_group, step, _, key in self.steps
+                if group is None or step_group == group]
+
+    def check(self, output, group=None):
+        """
+        Checks that every step of a group succeeded, VMS condition values are successes when they are odd
+        :param output: Text the procedure printed
+        :param group: Group to check, None for every step
+        :return: List of (step name, condition value)
+        :raises RemoteStepError: for the first step that failed or did not run
+        :raises ProcedureError: if the output has no status line at all
+        """
+        results = self.parse(output, group)
+        for step, status in results:
+            if status is None or not status & 1:
+                raise RemoteStepError("Step {} of {} failed: {}".format(step, self.name, vms_status(status)))
+        return results
@@ -0,0 +1,233 @@
+"""
+result_cache.py
+Author: Ian Smith
+Description: Contains the ResultCache class, a content addressed store of segmentation results. Results are keyed on a
+hash of the image bytes, the job type, the model and the version of the segmenter, so a resubmitted or restarted scan
+gets its masks back without running the model again. The cache is bounded in size and evicts the least recently used
+results first, the mtime of a result's directory records when it was last used so the order survives a restart.
+"""
+import constants
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+_MANIFEST = "manifest.json"
+_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, hasher=None):
+    """
+    Streams a file through a hash so large images are never read into memory at once
+    :param path: Path to the file
+    :param hasher: hashlib object to update, defaults to a new sha256
+    :return: The hashlib object
+    """
+    hasher = hashlib.sha256() if hasher is None else hasher
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def _copy(src, dst):
+    """
+    Copies a file, dst is only replaced once the copy is complete
+    Files are copied rather than hard linked so that segmenting a job again can not overwrite a stored result in place
+    :param src: Path to the file
+    :param dst: New path, replaced if it exists
+    :return: None
+    """
+    tmp = dst + ".partial"
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _restem(name, old_stem, new_stem):
+    """
+    Renames an output file of one image for another image, outputs are named <image stem>_...
+    :param name: File name of the output
+    :param old_stem: Stem of the image the output was made from
+    :param new_stem: Stem of the image the output is for
+    :return: New file name, in the same case as the old one
+    """
+    if old_stem.isupper():
+        new_stem = new_stem.upper()
+    elif old_stem.islower():
+        new_stem = new_stem.lower()
+    return new_stem + name[len(old_stem):]
+
+
+class ResultCache:
+    """
+    A class to store and look up the outputs of processing jobs by the content of their input
+    """
+    def __init__(self, logger, directory=None, max_gb=None):
+        """
+        Constructor method
+        :param logger: Injected Logger from ip_logging
+        :param directory: Directory the results are stored in, defaults to constants.RESULT_CACHE_DIR
+        :param max_gb: Max size of the stored results in GB, defaults to constants.RESULT_CACHE_MAX_GB
+        """
+        self.logs = logger
+        self.directory = os.path.abspath(constants.RESULT_CACHE_DIR if directory is None else directory)
+        self.max_bytes = int((constants.RESULT_CACHE_MAX_GB if max_gb is None else max_gb) * 1024 ** 3)
+        self.lock = threading.Lock()
+        self._versions = {}  # (path, mtime_ns, size) -> hash of the segmenter script
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):  # Results that were being stored when the server stopped
+            if name.startswith(".store-"):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        self.size = sum(self._entry_size(key) for key in self._keys())
+
+    def _keys(self):
+        """
+        Gets the keys of the stored results
+        :return: List of keys
+        """
+        return [name for name in os.listdir(self.directory) if not name.startswith(".")]
+
+    def _entry_size(self, key):
+        """
+        Gets the size of a stored result
+        :param key: Key of the result
+        :return: Size in bytes
+        """
+        path = os.path.join(self.directory, key)
+        size = 0
+        for entry in os.scandir(path):
+            if entry.is_file():
+                size += entry.stat().st_size
+        return size
+
+    def _segmenter_version(self, job_type):
+        """
+        Gets the version of the segmenter of a job type, the content hash of its script unless a version is configured
+        :param job_type: JobType
+        :return: Version string
+        """
+        if job_type.segmenter_version:
+            return job_type.segmenter_version
+        if not job_type.segmenter:
+            return ""
+        st = os.stat(job_type.segmenter)
+        stat_key = (job_type.segmenter, st.st_mtime_ns, st.st_size)
+        version = self._versions.get(stat_key)
+        if version is None:
+            version = hash_file(job_type.segmenter).hexdigest()
+            self._versions[stat_key] = version
+        return version
+
+    def key(self, image_path, job_type):
+        """
+        Computes the cache key of a job
+        :param image_path: Path to the image of the job
+        :param job_type: JobType of the job
+        :return: Key as a hex string, None if results of the job type are not cached
+        """
+        if job_type.model is None:
+            return None
+        hasher = hash_file(image_path)
+        for part in (job_type.name, job_type.model, self._segmenter_version(job_type)):
+            hasher.update(b"\0" + part.encode())
+        return hasher.hexdigest()
+
+    def restore(self, key, out_dir, stem):
+        """
+        Copies a stored result into a job's output directory
+        :param key: Key of the job
+        :param out_dir: Output directory of the job, the masks dir
+        :param stem: Stem of the job's image, outputs are renamed to it
+        :return: True if the result was found and restored
+        """
+        if key is None:
+            return False
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, _MANIFEST), "r") as f:
+                manifest = json.load(f)
+            os.makedirs(out_dir, exist_ok=True)
+            for name in manifest["files"]:
+                _copy(os.path.join(path, name), os.path.join(out_dir, _restem(name, manifest["stem"], stem)))
+            os.utime(path)  # Marks the result as recently used
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            self.logs.log_error("Cached result {} is unusable, removing it: {}".format(key, e))
+            self._remove(key)
+            return False
+        return True
+
+    def store(self, key, out_dir, stem):
+        """
+        Stores the outputs of a job, outputs are the masks in its output directory named after its image, other files
+        there like the sftp batch file or the post-processing procedure are not cached
+        :param key: Key of the job
+        :param out_dir: Output directory of the job, the masks dir
+        :param stem: Stem of the job's image
+        :return: None
+        """
+        if key is None or os.path.isdir(os.path.join(self.directory, key)):
+            return
+        files = sorted(f for f in os.listdir(out_dir)
+                       if f.lower().startswith(stem.lower() + "_") and os.path.isfile(os.path.join(out_dir, f)) and
+                       any(fnmatch.fnmatchcase(f, pattern) for pattern in constants.MASK_PATTERNS))
+        if not files:
+            return
+        staging = tempfile.mkdtemp(prefix=".store-", dir=self.directory)
+        try:
+            size = 0
+            for name in files:
+                _copy(os.path.join(out_dir, name), os.path.join(staging, name))
+                size += os.path.getsize(os.path.join(staging, name))
+            with open(os.path.join(staging, _MANIFEST), "w") as f:
+                json.dump({"stem": files[0][:len(stem)], "files": files}, f)
+            size += os.path.getsize(os.path.join(staging, _MANIFEST))
+            os.rename(staging, os.path.join(self.directory, key))
+        except OSError as e:  # Another worker stored the same result first, or the disk is full
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(os.path.join(self.directory, key)):
+                self.logs.log_error("Could not cache result {}: {}".format(key, e))
+            return
+        with self.lock:
+            self.size += size
+        self._evict()
+
+    def _remove(self, key):
+        """
+        Removes a stored result
+        :param key: Key of the result
+        :return: None
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            size = self._entry_size(key)
+        except OSError:
+            size = 0
+        shutil.rmtree(path, ignore_errors=True)
+        with self.lock:
+            self.size -= size
+
+    def _evict(self):
+        """
+        Removes the least recently used results until the cache fits in its max size
+        :return: None
+        """
+        if self.size <= self.max_bytes:
+            return
+        entries = []
+        for key in self._keys():
+            try:
+                entries.append((os.stat(os.path.join(self.directory, key)).st_mtime_ns, key))
+            except FileNotFoundError:
+                continue
+        for _, key in sorted(entries):
+            if self.size <= self.max_bytes:
+                break
+            self.logs.log_debug("Evicting cached result {}".format(key))
+            self._remove(key)
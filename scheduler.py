@@ -0,0 +1,175 @@
+"""
+scheduler.py
+Author: Ian Smith
+Description: Contains the ResourceGovernor class which decides if another job can be started on this machine. Every
+running job holds a Reservation of CPU cores and memory, a job is only admitted if enough cores are free, the
+memory it needs is both unreserved and actually available on the system and its job type is below its max concurrency.
+"""
+import constants
+
+import os
+import threading
+
+
+def _meminfo_gb(field):
+    """
+    Reads a field from /proc/meminfo
+    :param field: Name of the field, e.g. MemAvailable
+    :return: Value in GB, None if it cannot be read on this system
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def available_memory_gb():
+    """
+    Gets the memory available for new processes
+    :return: Available memory in GB, None if it cannot be read on this system
+    """
+    return _meminfo_gb("MemAvailable")
+
+
+def total_memory_gb():
+    """
+    Gets the total memory of the system
+    :return: Total memory in GB, None if it cannot be read on this system
+    """
+    return _meminfo_gb("MemTotal")
+
+
+class Reservation:
+    """
+    Resources held by a running job
+    """
+    def __init__(self, name, cores, memory_gb, job_type=None):
+        """
+        Constructor method
+        :param name: Job name
+        :param cores: List of CPU core ids reserved for the job
+        :param memory_gb: Memory reserved for the job in GB
+        :param job_type: Job type the reservation counts against, None if it is not known
+        """
+        self.name = name
+        self.cores = cores
+        self.memory_gb = memory_gb
+        self.job_type = job_type
+
+
+class ResourceGovernor:
+    """
+    A class to do admission control for processing jobs based on CPU cores and memory
+    """
+    def __init__(self, logger, cores=None, memory_gb=None):
+        """
+        Constructor method
+        :param logger: Injected Logger from ip_logging
+        :param cores: List of core ids jobs may use, defaults to all cores available to the server minus
+                      constants.RESERVED_CORES
+        :param memory_gb: Memory budget for jobs in GB, defaults to the system total minus constants.RESERVED_MEMORY_GB
+        """
+        self.logs = logger
+        if cores is None:
+            try:
+                cores = sorted(os.sched_getaffinity(0))
+            except AttributeError:
+                cores = list(range(os.cpu_count() or 1))
+            cores = cores[constants.RESERVED_CORES:] or cores[-1:]
+        if memory_gb is None:
+            total = total_memory_gb()
+            memory_gb = None if total is None else max(total - constants.RESERVED_MEMORY_GB, 0)
+        self.cores = list(cores)
+        self.memory_gb = memory_gb
+        self.free_cores = list(self.cores)
+        self.reserved_memory_gb = 0
+        self.reservations = {}
+        self.type_counts = {}  # Job type -> number of reservations held by jobs of that type
+        self.lock = threading.Lock()
+
+    def _fits(self, cores, memory_gb, job_type=None, max_concurrency=0):
+        """
+        Checks if a job fits in the unreserved resources, lock must be held
+        :param cores: Number of cores needed
+        :param memory_gb: Memory needed in GB
+        :param job_type: Job type of the job
+        :param max_concurrency: Max jobs of the job type running at once, 0 for no limit
+        :return: True if the job can be admitted
+        """
+        if max_concurrency and self.type_counts.get(job_type, 0) >= max_concurrency:
+            return False
+        if not self.reservations:  # A job that is larger than the whole machine still gets to run on its own
+            return True
+        if len(self.free_cores) < min(cores, len(self.cores)):
+            return False
+        if self.memory_gb is not None and self.reserved_memory_gb + memory_gb > self.memory_gb:
+            return False
+        available = available_memory_gb()
+        if available is not None and available < memory_gb:  # Something outside the server is using the memory
+            return False
+        return True
+
+    def try_acquire(self, name, cores=None, memory_gb=None, job_type=None, max_concurrency=0):
+        """
+        Reserves the resources of a job if it can be admitted right now, does not wait
+        :param name: Job name
+        :param cores: Number of cores needed, defaults to constants.JOB_CPU_CORES
+        :param memory_gb: Memory needed in GB, defaults to constants.JOB_MEMORY_GB
+        :param job_type: Job type the reservation counts against
+        :param max_concurrency: Max jobs of the job type running at once, 0 for no limit
+        :return: Reservation, None if the job does not fit
+        """
+        cores = constants.JOB_CPU_CORES if cores is None else cores
+        memory_gb = constants.JOB_MEMORY_GB if memory_gb is None else memory_gb
+        with self.lock:
+            if not self._fits(cores, memory_gb, job_type, max_concurrency):
+                return None
+            return self._reserve(name, cores, memory_gb, job_type)
+
+    def _reserve(self, name, cores, memory_gb, job_type=None):
+        """
+        Takes resources for a job that was admitted, lock must be held
+        :param name: Job name
+        :param cores: Number of cores needed
+        :param memory_gb: Memory needed in GB
+        :param job_type: Job type the reservation counts against
+        :return: Reservation
+        """
+        taken = self.free_cores[:min(cores, len(self.free_cores))]
+        del self.free_cores[:len(taken)]
+        reservation = Reservation(name, taken, memory_gb, job_type)
+        self.reserved_memory_gb += memory_gb
+        self.reservations[id(reservation)] = reservation
+        if job_type is not None:
+            self.type_counts[job_type] = self.type_counts.get(job_type, 0) + 1
+        return reservation
+
+    def rename(self, reservation, name):
+        """
+        Changes the job name on a reservation once the job is known
+        :param reservation: Reservation
+        :param name: Job name
+        :return: None
+        """
+        with self.lock:
+            reservation.name = name
+
+    def release(self, reservation):
+        """
+        Frees the resources held by a job
+        :param reservation: Reservation returned by try_acquire
+        :return: None
+        """
+        with self.lock:
+            if self.reservations.pop(id(reservation), None) is None:
+                return
+            self.free_cores.extend(reservation.cores)
+            self.free_cores.sort()
+            self.reserved_memory_gb -= reservation.memory_gb
+            if reservation.job_type is not None:
+                self.type_counts[reservation.job_type] -= 1
+
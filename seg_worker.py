@@ -0,0 +1,99 @@
+"""
+seg_worker.py
+Author: Ian Smith
+Description: Long lived segmentation worker. This script is started by the server with the python interpreter of the
+segmentation environment (RAD_TIB_PATH_TO_ENV) and runs segment.py in process for every job it is sent, so the
+interpreter, torch and the other heavy imports are only loaded once. It must not import any of the server modules.
+
+Protocol: one JSON object per line on stdin {"id": n, "argv": [...]} where argv are the arguments for segment.py, and
+one JSON object per line back on the original stdout {"id": n, "returncode": rc, "error": msg}. Anything segment.py
+prints goes to stderr so it can not corrupt the protocol.
+Usage: python seg_worker.py <path to segment.py> [--cache-weights]
+"""
+import copy
+import json
+import os
+import runpy
+import sys
+import traceback
+
+
+def _cache_torch_load():
+    """
+    Wraps torch.load so model weights loaded from a file are only read from disk once while the file is unchanged
+    :return: None
+    """
+    torch = sys.modules.get("torch")
+    if torch is None or getattr(torch.load, "_seg_worker_cached", False):
+        return
+    original = torch.load
+    cache = {}
+
+    def load(f, *args, **kwargs):
+        if not isinstance(f, (str, os.PathLike)):
+            return original(f, *args, **kwargs)
+        path = os.path.abspath(os.fspath(f))
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size, repr(args), repr(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = original(f, *args, **kwargs)
+        return copy.deepcopy(cache[key])
+
+    load._seg_worker_cached = True
+    torch.load = load
+
+
+def _run(script, argv):
+    """
+    Runs segment.py as if it was started from the command line
+    :param script: Path to segment.py
+    :param argv: Arguments for segment.py
+    :return: Tuple of the return code and an error message or None
+    """
+    old_argv = sys.argv
+    old_cwd = os.getcwd()
+    sys.argv = [script] + list(argv)
+    try:
+        runpy.run_path(script, run_name="__main__")
+        return 0, None
+    except SystemExit as e:
+        code = e.code
+        if code is None:
+            return 0, None
+        if isinstance(code, int):
+            return code, None
+        return 1, str(code)
+    except BaseException as e:
+        traceback.print_exc()
+        return 1, "{}: {}".format(type(e).__name__, e)
+    finally:
+        sys.argv = old_argv
+        os.chdir(old_cwd)
+
+
+def main():
+    script = sys.argv[1]
+    cache_weights = "--cache-weights" in sys.argv[2:]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+    # Keep the real stdout for the protocol and send everything printed by segment.py to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    protocol.write(json.dumps({"id": None, "ready": True, "pid": os.getpid()}) + "\n")
+    protocol.flush()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        returncode, error = _run(script, request["argv"])
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if cache_weights:
+            _cache_torch_load()
+        protocol.write(json.dumps({"id": request.get("id"), "returncode": returncode, "error": error}) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    main()
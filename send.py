@@ -4,151 +4,235 @@ Author: Ian Smith
 Description: Class to handle sending data back to the OpenVMS system
 """
 import shutil
-import subprocess
 import os
 import fnmatch
-import traceback
 
 import constants
 import ip_utils
-from job import JobData
+from job import get_job_data, set_stage, stage_reached
+from job_types import JOB_TYPES, get_job_type
+from metrics import METRICS
+from remote_procedure import RemoteProcedure, RemoteStepError, procedure_name, vms_status
+from ssh_session import SessionManager
 
 
 class Send:
     def __init__(self, logger):
         """
         Constructor method
+        Job state is passed between the methods instead of kept on the instance, so jobs can be sent from several
+        threads at once
         :param logger: Injected Logger from ip_logging
         """
-        self.image_dir = None
-        self.image_name = None
-        self.destination = None
-        self.hostname = None
-        self.username = None
-        self.dat = None
-        self.job_type = None
         self.logs = logger
+        self.sessions = SessionManager(logger)  # One master connection per host, shared by every job
 
-    def _prepare(self, base_dir):
+    def try_send(self, base_dir):
         """
-        Prepares data for sending, extracts username/hostname etc...
-        :param base_dir:
-        :return:
+        Sends a job back to OpenVMS, used by the TransferQueue which decides if a failure is worth retrying
+        :param base_dir: Base directory/reference to job data
+        :return: None
+        :raises Exception: whatever made the transfer fail
+        """
+        jd = get_job_data(base_dir)
+        hostname, destination = jd.data.get("CLIENT_HOSTNAME"), jd.data.get("CLIENT_DIR")
+        if stage_reached(jd, constants.STAGE_POST_PROCESSED):
+            self.logs.log_debug("{} was already sent to {}".format(jd.image_file_name, hostname))
+            return
+        self.logs.log_debug("Sending {} to {} at {}".format(jd.image_file_name, hostname, destination))
+        self._get_send_for_job(jd)
+        self.logs.log_debug("{} successfully transferred to {} at {}".format(jd.image_file_name, hostname, destination))
+
+    def try_send_batch(self, base_dirs):
+        """
+        Sends several jobs going to the same host and directory together, see batch_key
+        Jobs of a type without a batch method and batches of one job are sent on their own
+        :param base_dirs: List of base directories of the jobs
+        :return: Dict of base directory -> None if the job was sent, the exception it failed with otherwise
+        """
+        if len(base_dirs) == 1:
+            try:
+                self.try_send(base_dirs[0])
+                return {base_dirs[0]: None}
+            except Exception as e:
+                return {base_dirs[0]: e}
+        jobs = [get_job_data(base_dir) for base_dir in base_dirs]
+        first = jobs[0].data
+        self.logs.log_debug("Sending {} jobs to {} at {}".format(len(jobs), first.get("CLIENT_HOSTNAME"),
+                                                                 first.get("CLIENT_DIR")))
+        try:
+            job_type = get_job_type(first.get(constants.JOB_TYPE))
+            results = getattr(self, job_type.send_batch)(jobs)
+        except Exception as e:  # Nothing was sent
+            return {base_dir: e for base_dir in base_dirs}
+        return {base_dir: results[jd.base] for base_dir, jd in zip(base_dirs, jobs)}
+
+    @staticmethod
+    def batch_key(base_dir):
+        """
+        Gets what a job has to have in common with other jobs to be sent in one batch with them
+        :param base_dir: Base directory of the job
+        :return: Tuple of job type, user, host and directory, None if jobs of the type are only sent on their own
         """
-        with JobData(base_dir) as jd:
-            self.dat = jd.data
-            self.image_dir = jd.proc_dir_path
-            self.image_name = jd.image_file_name
-            self.job_type = jd.data.get(constants.JOB_TYPE)
-            self.job_type = self.job_type.lower()
+        data = get_job_data(base_dir).data
+        job_type = JOB_TYPES.get((data.get(constants.JOB_TYPE) or "").lower())
+        if job_type is None or job_type.send_batch is None:
+            return None
+        return job_type.name, data.get("CLIENT_USERNAME"), data.get("CLIENT_HOSTNAME"), data.get("CLIENT_DIR")
 
-        self.username = self.dat.get("CLIENT_USERNAME")
-        self.hostname = self.dat.get("CLIENT_HOSTNAME")
-        self.destination = self.dat.get("CLIENT_DIR")
+    def _get_send_for_job(self, jd):
+        """
+        Selects method for sending, allows for sending in different formats, the method is looked up in job_types
+        :param jd: JobData of the job
+        :return:
+        """
+        getattr(self, get_job_type(jd.data.get(constants.JOB_TYPE)).send)(jd)
 
-    def _reset(self):
+    def _send_radius_tibia_final(self, jd):
         """
-        Resets class parameters
-        :return: None
+        Send method for radius_tibia_final job type
+        :param jd: JobData of the job
+        :return:
         """
-        self.image_dir = None
-        self.image_name = None
-        self.destination = None
-        self.hostname = None
-        self.username = None
-        self.dat = None
-        self.job_type = None
+        error = self._send_radius_tibia_final_batch([jd])[jd.base]
+        if error is not None:
+            raise error
 
-    def send(self, base_dir):
+    def _send_radius_tibia_final_batch(self, jobs):
         """
-        Method for using sftp to send the data back to OpenVMS
-        :param base_dir: Base directory/reference to job data
-        :return: True on success, False on fail
+        Send method for radius_tibia_final jobs going to the same host and directory
+        The masks of every job go up in one sftp session and the post-processing of every job runs as one DCL
+        procedure with a group of steps per job, so a failed job does not stop the others
+        :param jobs: List of JobData
+        :return: Dict of job base -> None if the job was sent, the exception it failed with otherwise
         """
-        success = False
-        self._prepare(base_dir)
-        self.logs.log_debug("Sending {} to {} at {}".format(self.image_name, self.hostname, self.destination))
+        results = {}
+        first = jobs[0].data
+        username, hostname = first.get("CLIENT_USERNAME"), first.get("CLIENT_HOSTNAME")
+        client_dir = first.get("CLIENT_DIR")
+        destination = ip_utils.convert_path(client_dir).replace("DK0", "DISK2")
+
+        # The post-processing steps run as one DCL procedure that goes up with the masks, so the scanner only starts
+        # one process for them
+        procedure = RemoteProcedure(procedure_name(jobs[0].image_file_name))
+        puts = []
+        sending = []
+        for jd in jobs:
+            if stage_reached(jd, constants.STAGE_POST_PROCESSED):
+                results[jd.base] = None
+                continue
+            try:  # A job with missing masks or a broken com file fails on its own, the rest of the batch still goes
+                masks = self._find_masks(jd.proc_dir_path)
+                vms_path_to_trab_mask = self._vms_path(jd, 'FILE_TRAB_MASK_AIM')
+                vms_path_to_cort_mask = self._vms_path(jd, 'FILE_CORT_MASK_AIM')
+                vms_aim_path = self._vms_path(jd, 'FILE_AIM')
+            except Exception as e:
+                results[jd.base] = e
+                continue
+            if stage_reached(jd, constants.STAGE_TRANSFERRED):
+                # The procedure deletes itself when it succeeds, only it is sent again in case that happened before
+                # the stage was recorded
+                self.logs.log_debug("{} already transferred, resuming at post-processing".format(jd.image_file_name))
+            else:
+                puts += masks[:2]
+            procedure.add("fix_trab", f"set file/attr=(lrl:512, rfm:fix) {vms_path_to_trab_mask}",
+                          jd.base)  # Fixing mask attributes
+            procedure.add("fix_cort", f"set file/attr=(lrl:512, rfm:fix) {vms_path_to_cort_mask}", jd.base)
+            procedure.add("gobj", f"@COM:HIJACK_MASKS_TO_GOBJ.COM {vms_aim_path}", jd.base)  # Turning masks to GOBJ
+            sending.append(jd)
+        if not sending:
+            return results
+
+        work_dir = sending[0].proc_dir_path
+        procedure_path = procedure.write(work_dir)
+        vms_procedure_path = client_dir.replace("DK0", "DISK2") + procedure.name
+        batch_path = self.write_batch_file_radius_tibia(destination, work_dir, *puts, procedure_path)
+
+        # Every command goes over the session's master connection, only the first one of a while does the key exchange
+        server = self.sessions.session('xtremect2', 'emily.ucalgary.ca')  # Possibly add -i option to point to key file
+        scanner = self.sessions.session(username, hostname, constants.VMS_SSH_OPTIONS)
+
+        names = [jd.base_name for jd in sending]
         try:
-            self._get_send_for_job()
-            self.logs.log_debug(
-                "{} successfully transferred to {} at {}".format(self.image_name, self.hostname, self.destination))
-            success = True
-        except NotImplementedError as e:
-            self.logs.log_error(f"NotImplementedError: {e}")
-            success = False
-        except Exception as e:
-            self.logs.log_error("Transfer to {} of {} failed: Error {}".format(self.image_name, self.hostname, e))
-            self.logs.log_error(traceback.format_exc())
-            success = False
-        finally:
-            self._reset()
-
-        return success
-
-    def _get_send_for_job(self):
-        """
-        Selects method for sending, allows for sending in different formats
-        :return:
+            with METRICS.time("sftp", names):
+                server.run('sftp', [f'-b{batch_path}']) # Sending masks as AIMs
+            for jd in sending:
+                if not stage_reached(jd, constants.STAGE_TRANSFERRED):
+                    set_stage(jd.base, constants.STAGE_TRANSFERRED)
+            with METRICS.time("ssh_post", names):
+                output = scanner.run('ssh', remote=[f'@{vms_procedure_path}'], capture=True, check=False).stdout
+                procedure.parse(output)  # Raises if the procedure did not run at all
+        except Exception as e:  # Nothing or only the upload happened, every job is retried
+            for jd in sending:
+                results[jd.base] = e
+            return results
+
+        for jd in sending:
+            try:
+                steps = procedure.check(output, jd.base)
+            except RemoteStepError as e:
+                results[jd.base] = e
+                continue
+            self.logs.log_debug("Post-processed {}: {}".format(
+                jd.image_file_name, ", ".join("{} {}".format(step, vms_status(status)) for step, status in steps)))
+            set_stage(jd.base, constants.STAGE_POST_PROCESSED)
+            results[jd.base] = None
+        return results
+
+    @staticmethod
+    def _vms_path(jd, key):
+        """
+        Gets a path on the VMS host from the com file of a job
+        :param jd: JobData of the job
+        :param key: Key of the path in the com file
+        :return: Path on DISK2
+        :raises KeyError: if the com file has no such path
         """
-        self.job_type = self.job_type.lower()
-        if self.job_type == "radius_tibia_final":
-            self._send_radius_tibia_final()
-        else:
-            raise NotImplementedError(f"Job Type: {self.job_type} not implemented in this system.")
+        path = jd.data.get(key)
+        if not isinstance(path, str) or not path:
+            raise KeyError("{} has no {} in its com file".format(jd.image_file_name, key))
+        return path.replace("DK0", "DISK2")
 
-    def _send_radius_tibia_final(self):
+    @staticmethod
+    def _find_masks(masks_dir):
         """
-        Send method for radius_tibia_final job type
-        :return:
+        Finds the masks of a job
+        :param masks_dir: Directory the masks were written to
+        :return: Sorted list of paths to the masks, CORT before TRAB
+        :raises FileNotFoundError: if there are no masks
         """
         # Checking that the images are actually there
-        file_patterns = ["*_CORT_MASK.AIM", "*_TRAB_MASK.AIM"]
         matching_files = []
 
-        for root, dirs, files in os.walk(self.image_dir):
-            for file_pattern in file_patterns:
-                matching_files.extend(fnmatch.filter(files, file_pattern))
+        for root, dirs, files in os.walk(masks_dir):
+            for file_pattern in constants.MASK_PATTERNS:
+                matching_files.extend(os.path.join(root, f) for f in fnmatch.filter(files, file_pattern))
 
         if not matching_files:
             raise FileNotFoundError("Image masks not found in masks dir")
+        return sorted(matching_files)  # Only the masks, the dir can also hold batch.txt from an earlier attempt
+
+    def close(self):
+        """
+        Closes the master connections to the hosts
+        :return: None
+        """
+        self.sessions.close()
 
-        masks = ip_utils.get_abs_paths(self.image_dir)
-        destination = ip_utils.convert_path(self.destination).replace("DK0", "DISK2")
-        
-        batch_path = self.write_batch_file_radius_tibia(destination, self.image_dir, masks[0], masks[1])
-        
-        
-        vms_path_to_trab_mask = self.dat.get('FILE_TRAB_MASK_AIM').replace("DK0", "DISK2")
-        vms_path_to_cort_mask = self.dat.get('FILE_CORT_MASK_AIM').replace("DK0", "DISK2")
-        vms_aim_path = self.dat.get('FILE_AIM').replace("DK0", "DISK2")
-        
-        sftp_cmd = ['sftp', f'-b{batch_path}', 'xtremect2@emily.ucalgary.ca'] # Possibly add -i argument to point to key file 
-        
-        fix_trab_mask = ['ssh', '-p22', '-c3des-cbc', '-oKexAlgorithms=+diffie-hellman-group1-sha1', '-oHostKeyAlgorithms=+ssh-dss', f'{self.username}@{self.hostname}', f'set file/attr=(lrl:512, rfm:fix) {vms_path_to_trab_mask}']
-        fix_cort_mask = ['ssh', '-p22', '-c3des-cbc', '-oKexAlgorithms=+diffie-hellman-group1-sha1', '-oHostKeyAlgorithms=+ssh-dss', f'{self.username}@{self.hostname}', f'set file/attr=(lrl:512, rfm:fix) {vms_path_to_cort_mask}']
-        
-        masks_to_gobj = ['ssh', '-p22', '-c3des-cbc', '-oKexAlgorithms=+diffie-hellman-group1-sha1', '-oHostKeyAlgorithms=+ssh-dss', f'{self.username}@{self.hostname}', f'@COM:HIJACK_MASKS_TO_GOBJ.COM {vms_aim_path}']
-        
-        p1 = subprocess.run(sftp_cmd, check=True) # Sending masks as AIMs
-        
-        p2 = subprocess.run(fix_trab_mask, check=True) # Fixing trab mask attributes
-        
-        p3 = subprocess.run(fix_cort_mask, check=True) # Fixing cort mask attributes
-
-        p4 =  subprocess.run(masks_to_gobj, check=True) # Turning masks to GOBJ
-
-
-
-    def write_batch_file_radius_tibia(self, destination_path, path_to_masks_dir, mask1_name, mask2_name):
+    def write_batch_file_radius_tibia(self, destination_path, path_to_masks_dir, *file_names):
         """
         Takes in a list of sftp commands to generate a batch send file
+        :param destination_path: Directory on the host the files are put in
+        :param path_to_masks_dir: Directory the batch file is written to
+        :param file_names: Paths to the files to put
+        :return: Path to the batch file
         """
         batch_file_path = os.path.join(path_to_masks_dir, "batch.txt") 
         with open(batch_file_path, 'w') as f:
             # f.write("lcd " +  path_to_masks_dir + "\n")
             f.write("cd " + destination_path + "\n")
-            f.write("put " + mask1_name + "\n")
-            f.write("put " + mask2_name + "\n")
+            for file_name in file_names:
+                f.write("put " + file_name + "\n")
             f.write("exit" + "\n")
         return batch_file_path
 
@@ -0,0 +1,227 @@
+"""
+ssh_session.py
+Author: Ian Smith
+Description: Long lived SSH connections to the VMS hosts. An SSHSession keeps an OpenSSH ControlMaster connection to
+one user@host open and runs every ssh and sftp command to it as a channel of that connection, so the slow
+diffie-hellman-group1 key exchange with the VMS box is done once instead of once per command. Masters close themselves
+after constants.SSH_IDLE_TIMEOUT seconds without use and are checked with ssh -O check before they are trusted again.
+When a master cannot be started commands connect on their own like they did before.
+"""
+import constants
+
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class SSHSession:
+    """
+    A class to run ssh and sftp commands to one user@host over a shared master connection
+    """
+    def __init__(self, logger, username, hostname, options, control_path):
+        """
+        Constructor method, the master is started by the first command
+        :param logger: Injected Logger from ip_logging
+        :param username: User to log in as
+        :param hostname: Host to connect to
+        :param options: ssh -o options used for the master and every command, e.g. constants.VMS_SSH_OPTIONS
+        :param control_path: Path of the master's socket
+        """
+        self.logs = logger
+        self.username = username
+        self.hostname = hostname
+        self.options = list(options)
+        self.control_path = control_path
+        self.lock = threading.Lock()
+        self.checked_at = None  # Last time the master was started or passed a check, None while there is no master
+        self.failed_at = None  # Last time the master failed to start
+        self.last_used = 0
+
+    @property
+    def target(self):
+        return "{}@{}".format(self.username, self.hostname)
+
+    @staticmethod
+    def _timeouts():
+        """
+        Gets the options that stop a connection from hanging on a host that does not answer
+        :return: List of ssh -o options
+        """
+        return ["-oConnectTimeout={}".format(constants.SSH_CONNECT_TIMEOUT),
+                "-oServerAliveInterval={}".format(constants.SSH_ALIVE_INTERVAL)]
+
+    def _control(self, command):
+        """
+        Runs a control command (check or exit) on the master
+        :param command: ssh -O command
+        :return: True if the master answered
+        """
+        cmd = ["ssh", "-O", command, "-oControlPath={}".format(self.control_path)] + self.options + [self.target]
+        try:
+            return subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  timeout=constants.SSH_CONNECT_TIMEOUT).returncode == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def _start(self):
+        """
+        Starts the master, it forks into the background once it has logged in and exits once it has been idle for
+        constants.SSH_IDLE_TIMEOUT seconds. Lock must be held
+        :return: True if the master is running
+        """
+        if os.path.exists(self.control_path):  # Left behind by a master that died
+            os.remove(self.control_path)
+        cmd = ["ssh", "-M", "-N", "-f", "-oControlPath={}".format(self.control_path),
+               "-oControlPersist={}".format(constants.SSH_IDLE_TIMEOUT),
+               "-oBatchMode=yes"] + self._timeouts() + self.options + [self.target]
+        # The backgrounded master keeps stderr open, a pipe would never reach EOF so errors go to a file
+        with tempfile.TemporaryFile() as err:
+            try:
+                code = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err,
+                                      timeout=constants.SSH_CONNECT_TIMEOUT + 10).returncode
+            except subprocess.TimeoutExpired:
+                code = None
+            err.seek(0)
+            message = err.read().decode(errors="replace").strip()
+        if code == 0:
+            self.checked_at = time.monotonic()
+            self.failed_at = None
+            self.logs.log_debug("Opened SSH master connection to {}".format(self.target))
+            return True
+        self.checked_at = None
+        self.failed_at = time.monotonic()
+        if not message:
+            message = "timed out" if code is None else "exit code {}".format(code)
+        self.logs.log_error("Could not open SSH master connection to {}, commands will connect on their own: {}"
+                            .format(self.target, message))
+        return False
+
+    def ensure(self):
+        """
+        Makes sure the master is running, starting it if needed
+        A master that was checked and used recently is trusted, otherwise it is checked first
+        :return: True if commands can go through the master
+        """
+        if not constants.SSH_MULTIPLEX:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if self.failed_at is not None and now - self.failed_at < constants.SSH_RETRY_TIME:
+                return False
+            if self.checked_at is not None:
+                if now - self.checked_at < constants.SSH_CHECK_INTERVAL and \
+                        now - self.last_used < constants.SSH_IDLE_TIMEOUT:
+                    return True
+                if self._control("check"):
+                    self.checked_at = now
+                    return True
+                self.logs.log_debug("SSH master connection to {} is gone, reconnecting".format(self.target))
+            return self._start()
+
+    def command(self, program, args=(), remote=(), multiplexed=None):
+        """
+        Builds a command to the host
+        :param program: ssh or sftp
+        :param args: Arguments that go before the destination, e.g. the sftp batch file
+        :param remote: Arguments that go after the destination, e.g. the remote command for ssh
+        :param multiplexed: True to go through the master, None to start or check it first
+        :return: Command as a list
+        """
+        if multiplexed is None:
+            multiplexed = self.ensure()
+        cmd = [program] + self._timeouts() + self.options
+        if multiplexed:
+            cmd += ["-oControlPath={}".format(self.control_path), "-oControlMaster=no"]
+        return cmd + list(args) + [self.target] + list(remote)
+
+    def run(self, program, args=(), remote=(), capture=False, check=True, timeout=None):
+        """
+        Runs a command to the host through the master
+        :param program: ssh or sftp
+        :param args: Arguments that go before the destination
+        :param remote: Arguments that go after the destination
+        :param capture: True to return the output of the command in stdout of the result
+        :param check: False to return the result when the remote command failed, ssh failing to connect still raises
+        :param timeout: Max seconds the command may run before it is killed, defaults to constants.SSH_COMMAND_TIMEOUT
+        :return: CompletedProcess
+        :raises subprocess.CalledProcessError: if the command failed
+        :raises subprocess.TimeoutExpired: if the command hung, the transfer queue retries it like a dropped connection
+        """
+        timeout = constants.SSH_COMMAND_TIMEOUT if timeout is None else timeout
+        multiplexed = self.ensure()
+        try:
+            result = subprocess.run(self.command(program, args, remote, multiplexed), stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE if capture else None, text=capture or None,
+                                    timeout=timeout or None)
+            if result.returncode == 255 or (check and result.returncode != 0):  # 255 is ssh's own error
+                raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout)
+            return result
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            if multiplexed:  # Could be the connection, the master is checked before it is used again
+                with self.lock:
+                    self.checked_at = float("-inf") if self.checked_at is not None else None
+            raise
+        finally:
+            self.last_used = time.monotonic()
+
+    def close(self):
+        """
+        Closes the master connection
+        :return: None
+        """
+        with self.lock:
+            if self.checked_at is not None:
+                self._control("exit")
+                self.logs.log_debug("Closed SSH master connection to {}".format(self.target))
+            self.checked_at = None
+            if os.path.exists(self.control_path):
+                os.remove(self.control_path)
+
+
+class SessionManager:
+    """
+    A class to hand out one SSHSession per user, host and set of options
+    """
+    def __init__(self, logger, control_dir=None):
+        """
+        Constructor method
+        :param logger: Injected Logger from ip_logging
+        :param control_dir: Directory for the master sockets, defaults to constants.SSH_CONTROL_DIR
+        """
+        self.logs = logger
+        self.control_dir = constants.SSH_CONTROL_DIR if control_dir is None else control_dir
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def session(self, username, hostname, options=()):
+        """
+        Gets the session to a host, creating it on first use
+        :param username: User to log in as
+        :param hostname: Host to connect to
+        :param options: ssh -o options for the connection
+        :return: SSHSession
+        """
+        key = (username, hostname, tuple(options))
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+                # Hashed names keep the socket path short, the full key would not fit in a unix socket path
+                name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+                session = SSHSession(self.logs, username, hostname, options, os.path.join(self.control_dir, name))
+                self.sessions[key] = session
+            return session
+
+    def close(self):
+        """
+        Closes every master connection
+        :return: None
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
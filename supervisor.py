@@ -0,0 +1,154 @@
+"""
+supervisor.py
+Author: Ian Smith
+Description: Runs processing commands under supervision. A SupervisedProcess is started in its own session, pinned to
+the CPU cores reserved for its job, given a lower priority and memory/CPU rlimits, and killed together with its
+children when it runs past its timeout or is skipped from the CLI.
+"""
+import os
+import resource
+import signal
+import subprocess
+
+
+class JobTimeoutError(Exception):
+    """
+    Raised when a processing command runs past its wall-clock timeout and was killed
+    """
+    pass
+
+
+class JobKilledError(Exception):
+    """
+    Raised when a processing command was killed on purpose, by a skip from the CLI or on shutdown
+    """
+    pass
+
+
+def cpu_time_used(pid):
+    """
+    Gets the CPU time a process has used so far from /proc
+    :param pid: Process id
+    :return: User and system time in seconds, 0 if it cannot be read
+    """
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()  # The command name in brackets may contain spaces
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def apply_limits(pid, logger, cores=None, nice=None, memory_gb=None, cpu_seconds=None, reusable=False):
+    """
+    Applies scheduling settings and rlimits to a running process, failures are logged and the process keeps running
+    Affinity and niceness are set on every thread of the process so threads started before the call are covered
+    :param pid: Process id
+    :param logger: Injected Logger from ip_logging
+    :param cores: CPU core ids the process may run on, None to leave the affinity alone
+    :param nice: Nice level, None to leave the priority alone
+    :param memory_gb: Limit on the data segment of the process in GB, None for no limit
+    :param cpu_seconds: Limit on the CPU time of the process in seconds, None for no limit
+    :param reusable: True for a process that runs more jobs after this one, only the soft limits are set so the next
+    job can get different ones and the CPU limit counts from the time the process has already used
+    :return: None
+    """
+    try:
+        threads = [int(tid) for tid in os.listdir("/proc/{}/task".format(pid))]
+    except OSError:
+        threads = [pid]
+    errors = set()
+    for tid in threads:
+        try:
+            if cores:
+                os.sched_setaffinity(tid, cores)
+        except ProcessLookupError:  # Thread exited
+            continue
+        except (OSError, AttributeError) as e:
+            errors.add("affinity {}: {}".format(cores, e))
+        try:
+            if nice is not None:
+                os.setpriority(os.PRIO_PROCESS, tid, nice)
+        except ProcessLookupError:
+            continue
+        except (OSError, AttributeError) as e:
+            errors.add("nice {}: {}".format(nice, e))
+    for error in sorted(errors):
+        logger.log_error("Could not set {} on process {}".format(error, pid))
+    try:
+        if reusable:
+            # A lowered hard limit can not be raised again without privileges, so only the soft limits are set and
+            # they go back to the hard limit for jobs without one. RLIMIT_CPU counts the whole life of the process
+            data_hard = resource.prlimit(pid, resource.RLIMIT_DATA)[1]
+            cpu_hard = resource.prlimit(pid, resource.RLIMIT_CPU)[1]
+            data = int(memory_gb * 1024 ** 3) if memory_gb else data_hard
+            cpu = int(cpu_time_used(pid) + cpu_seconds) if cpu_seconds else cpu_hard
+            resource.prlimit(pid, resource.RLIMIT_DATA, (data, data_hard))
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu, cpu_hard))
+            return
+        if memory_gb:
+            limit = int(memory_gb * 1024 ** 3)
+            resource.prlimit(pid, resource.RLIMIT_DATA, (limit, limit))
+        if cpu_seconds:
+            # The soft limit sends SIGXCPU, the hard limit a few seconds later SIGKILL
+            resource.prlimit(pid, resource.RLIMIT_CPU, (int(cpu_seconds), int(cpu_seconds) + 10))
+    except ProcessLookupError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        logger.log_error("Could not set rlimits of process {}: {}".format(pid, e))
+
+
+class SupervisedProcess:
+    """
+    A class to run a processing command with a timeout and resource limits
+    """
+    def __init__(self, cmd, logger, cores=None, nice=None, memory_gb=None, cpu_seconds=None):
+        """
+        Constructor method, starts the command
+        :param cmd: Command as a list of arguments
+        :param logger: Injected Logger from ip_logging
+        :param cores: CPU core ids the command may run on
+        :param nice: Nice level of the command
+        :param memory_gb: Limit on the data segment of the command in GB
+        :param cpu_seconds: Limit on the CPU time of the command in seconds
+        """
+        self.logs = logger
+        self.killed = False
+        # A new session so the command and everything it starts can be killed together. The limits are applied from
+        # here right after the spawn, a preexec_fn could deadlock the child of this multi-threaded server before exec
+        self.process = subprocess.Popen(cmd, start_new_session=True)
+        apply_limits(self.process.pid, logger, cores, nice, memory_gb, cpu_seconds)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def wait(self, timeout=None):
+        """
+        Waits for the command to finish
+        :param timeout: Max time to wait in seconds, None to wait until it finishes
+        :return: Return code of the command
+        :raises JobTimeoutError: if the timeout elapsed, the command is killed
+        :raises JobKilledError: if the command was killed by kill
+        """
+        try:
+            returncode = self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            self.process.wait()
+            raise JobTimeoutError("Command ran for more than {} seconds and was killed: {}".format(
+                timeout, " ".join(self.process.args)))
+        if self.killed:
+            raise JobKilledError("Command was killed: {}".format(" ".join(self.process.args)))
+        return returncode
+
+    def kill(self):
+        """
+        Kills the command and every process it started, can be called from any thread
+        :return: None
+        """
+        self.killed = True
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):  # Already exited
+            pass
@@ -0,0 +1,454 @@
+"""
+transfer_queue.py
+Author: Ian Smith
+Description: Durable queue of segmented jobs waiting to be sent back to the scanners. Jobs wait in the outbox directory
+so they survive a restart, and a failed transfer is retried after an exponential backoff with jitter instead of failing
+the job, so a scanner that is down for maintenance does not cost a re-segmentation of every job finished meanwhile.
+Every host has a circuit breaker, while a host is down its jobs wait without using up their retries. Jobs waiting for
+the same host and directory are sent together, in one sftp session, up to constants.TRANSFER_BATCH_SIZE at a time.
+Sends to different hosts run in parallel on the worker threads, sends to one host are capped at
+constants.TRANSFER_HOST_CONCURRENCY so one slow scanner can not hold up the others.
+"""
+import constants
+import ip_utils
+from job import JobData, get_job_data
+from remote_procedure import ProcedureError, RemoteStepError
+
+import collections
+import heapq
+import itertools
+import os
+import random
+import subprocess
+import threading
+import time
+import traceback
+
+
+# Failures retrying will not fix, the job is failed at once
+PERMANENT_ERRORS = (NotImplementedError, FileNotFoundError, RemoteStepError, KeyError, AttributeError, TypeError,
+                    ValueError)
+# Failures of the ssh and sftp commands, the only ones that say something about the host and count against its breaker.
+# Other errors, e.g. a full local disk, are retried for the job without holding up the rest of the host's jobs
+TRANSPORT_ERRORS = (subprocess.SubprocessError, ProcedureError)
+
+
+def backoff(attempts):
+    """
+    Gets the time to wait before retrying a job, doubles with every attempt and is jittered so jobs that failed
+    together are not all retried at the same moment
+    :param attempts: Failed attempts so far, at least 1
+    :return: Seconds to wait
+    """
+    delay = min(constants.TRANSFER_BACKOFF_MAX, constants.TRANSFER_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """
+    Tracks if a host is up. After constants.BREAKER_THRESHOLD failures in a row the breaker opens and nothing is sent
+    to the host until the cool down is over, then a single job is let through to try the host again
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"  # The trial job is being sent
+
+    def __init__(self):
+        """
+        Constructor method
+        """
+        self.state = self.CLOSED
+        self.failures = 0
+        self.cooldown = constants.BREAKER_COOLDOWN
+        self.retry_at = 0.0
+
+    def allow(self, now):
+        """
+        Checks if a job may be sent to the host, lets the trial job through once the cool down is over
+        :param now: time.monotonic()
+        :return: True if the job may be sent
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and now >= self.retry_at:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def success(self):
+        """
+        Records that the host answered
+        :return: True if the breaker was not closed before
+        """
+        was_down = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        self.cooldown = constants.BREAKER_COOLDOWN
+        return was_down
+
+    def failure(self, now):
+        """
+        Records that the host could not be reached
+        :param now: time.monotonic()
+        :return: True if the breaker opened
+        """
+        self.failures += 1
+        if self.state == self.HALF_OPEN:  # Still down, wait longer before the next try
+            self.cooldown = min(self.cooldown * 2, constants.BREAKER_MAX_COOLDOWN)
+        elif self.state == self.OPEN or self.failures < constants.BREAKER_THRESHOLD:
+            return False
+        self.state = self.OPEN
+        self.retry_at = now + self.cooldown
+        return True
+
+    def release(self, now):
+        """
+        Gives up the trial without learning anything about the host, the next job becomes the trial
+        :param now: time.monotonic()
+        :return: None
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.retry_at = now
+
+
+class TransferQueue:
+    """
+    A class to send jobs from the outbox on its own worker threads, retrying failed transfers
+    Entries are [due, seq, path, host, fresh, batch key, counted], jobs whose host is down are held per host until its
+    breaker lets one through, and jobs whose host is already taking as many sends as it may are blocked until one
+    finishes. Held and blocked jobs do not count against maxsize, so a dead or slow host can not stop new jobs for the
+    other hosts from being queued
+    """
+    def __init__(self, logger, send, on_done, batch_key=None, workers=None, maxsize=None):
+        """
+        Constructor method, jobs left in the outbox by the last run are queued again
+        :param logger: Injected Logger from ip_logging
+        :param send: Function that sends a list of jobs given their paths, returns a dict of path -> None if the job
+                     was sent or the exception it failed with, e.g. Send.try_send_batch
+        :param on_done: Function called with the path and True or False once a job was sent or has failed for good
+        :param batch_key: Function giving the key of a job, jobs with the same key are sent together, a key of None or
+                          no function sends every job on its own
+        :param workers: Number of worker threads, defaults to constants.TRANSFER_WORKERS
+        :param maxsize: Max jobs waiting on their first attempt before put blocks, defaults to
+                        constants.TRANSFER_QUEUE_SIZE, jobs waiting on a retry do not count
+        """
+        self.logs = logger
+        self.send = send
+        self.on_done = on_done
+        self.batch_key = batch_key
+        self.workers = constants.TRANSFER_WORKERS if workers is None else workers
+        self.maxsize = constants.TRANSFER_QUEUE_SIZE if maxsize is None else maxsize
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self._heap = []
+        self._seq = itertools.count()
+        self.held = {}  # Host -> entries waiting for the host's breaker
+        self.breakers = {}  # Host -> CircuitBreaker
+        self.blocked = {}  # Host -> due entries waiting for a send to the host to finish
+        self.busy = collections.Counter()  # Host -> sends in progress
+        self.active = set()  # Paths being sent
+        self.fresh = 0  # Queued jobs that were not tried yet and are not held or blocked by their host
+        self.running = False
+        self.threads = []
+        self._perform_startup()
+
+    def _perform_startup(self):
+        """
+        Queues the jobs in the outbox, jobs that failed before keep their attempts and are retried after a backoff
+        :return: None
+        """
+        for path in ip_utils.get_abs_paths(constants.OUTBOX):
+            attempts = self._attempts(path)[0]
+            self.logs.log_debug("{} is waiting to be sent, {} failed attempt(s)".format(os.path.basename(path),
+                                                                                       attempts))
+            with self.lock:
+                self._push(path, time.monotonic() + (backoff(attempts) if attempts else 0), attempts == 0)
+
+    def start(self):
+        """
+        Starts the worker threads
+        :return: None
+        """
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="transfer-{}".format(i))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the worker threads once they finished the job they are sending, queued jobs stay in the outbox
+        :return: None
+        """
+        with self.lock:
+            self.running = False
+            self.changed.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _at_limit(self, host):
+        """
+        Checks if a host is taking as many sends as it may, lock must be held
+        :param host: Host name
+        :return: True if no more sends to the host may start
+        """
+        return self.busy[host] >= constants.TRANSFER_HOST_LIMITS.get(host, constants.TRANSFER_HOST_CONCURRENCY)
+
+    @staticmethod
+    def _host(path):
+        try:
+            return get_job_data(path).data.get("CLIENT_HOSTNAME") or ""
+        except (OSError, AttributeError):  # Metadata unreadable, the transfer fails on its own
+            return ""
+
+    @staticmethod
+    def _attempts(path):
+        """
+        Gets the retry state of a job from its com file
+        :param path: Path to the job
+        :return: Tuple of failed attempts and time of the first failure, None if it has not failed
+        """
+        data = get_job_data(path).data
+        return int(data.get(constants.TRANSFER_ATTEMPTS) or 0), data.get(constants.TRANSFER_FIRST_FAILURE)
+
+    def _push(self, path, due, fresh=False):
+        """
+        Adds a job to the heap, lock must be held
+        :param path: Path to the job in the outbox
+        :param due: time.monotonic() the job may be sent at
+        :param fresh: True if the job was not tried yet
+        :return: None
+        """
+        try:
+            key = self.batch_key(path) if self.batch_key is not None else None
+        except (OSError, AttributeError):  # Metadata unreadable, the job is sent on its own and fails there
+            key = None
+        entry = [due, next(self._seq), path, self._host(path), fresh, key, False]
+        self._count(entry)
+        heapq.heappush(self._heap, entry)
+        self.changed.notify_all()
+
+    def _count(self, entry):
+        """
+        Counts a job that was not tried yet against maxsize, lock must be held
+        :param entry: Entry of the job
+        :return: None
+        """
+        if entry[4] and not entry[6]:
+            entry[6] = True
+            self.fresh += 1
+
+    def _uncount(self, entry):
+        """
+        Stops counting a job against maxsize once it is being sent, held or blocked, lock must be held
+        :param entry: Entry of the job
+        :return: None
+        """
+        if entry[6]:
+            entry[6] = False
+            self.fresh -= 1
+            self.changed.notify_all()  # Space for jobs waiting in put
+
+    def put(self, path):
+        """
+        Queues a newly segmented job, blocks while too many jobs are waiting on their first attempt
+        :param path: Path to the job in the outbox
+        :return: None, the job stays in the outbox for the next startup if the queue is stopped while waiting
+        """
+        if self._attempts(path)[0]:  # Failed transfers of an earlier run of the job do not count against this one
+            with JobData(path) as jd:
+                jd.data.pop(constants.TRANSFER_ATTEMPTS, None)
+                jd.data.pop(constants.TRANSFER_FIRST_FAILURE, None)
+        with self.lock:
+            if self.fresh >= self.maxsize:
+                self.logs.log_debug("Transfer queue is full, waiting for space")
+            while self.running and self.fresh >= self.maxsize:
+                self.changed.wait()
+            if self.running:
+                self._push(path, time.monotonic(), True)
+
+    def _next(self):
+        """
+        Waits for a job that is due and whose host is not down or at its limit, lock must be held
+        :return: Entry, None once the queue is stopped
+        """
+        while self.running:
+            now = time.monotonic()
+            for host, entries in list(self.held.items()):  # Hosts whose cool down is over get one job through
+                if not self._at_limit(host) and self.breakers[host].allow(now):
+                    trial = entries.pop(0)
+                    if not entries:
+                        del self.held[host]
+                    return trial
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                breaker = self.breakers.setdefault(entry[3], CircuitBreaker())
+                if entry[3] in self.held:
+                    self.held[entry[3]].append(entry)
+                elif self._at_limit(entry[3]):
+                    self.blocked.setdefault(entry[3], []).append(entry)
+                elif not breaker.allow(now):
+                    self.held.setdefault(entry[3], []).append(entry)
+                else:
+                    return entry
+                self._uncount(entry)
+            wake = [self._heap[0][0]] if self._heap else []
+            wake += [self.breakers[host].retry_at for host in self.held
+                     if self.breakers[host].state == CircuitBreaker.OPEN]
+            self.changed.wait(max(min(wake) - now, 0.01) if wake else None)
+        return None
+
+    def _take_batch(self, entry):
+        """
+        Takes the other due jobs that can be sent together with a job, lock must be held
+        No batch is made while the host is being tried after being down, the trial is a single job
+        :param entry: Entry of the job that was taken
+        :return: List of entries
+        """
+        if entry[5] is None or constants.TRANSFER_BATCH_SIZE <= 1 or \
+                self.breakers[entry[3]].state != CircuitBreaker.CLOSED:
+            return []
+        limit = constants.TRANSFER_BATCH_SIZE - 1
+        host = entry[3]
+        batch = []
+        held = []
+        for other in self.held.pop(host, []):  # The host is up again, its held jobs are due
+            (batch if other[5] == entry[5] and len(batch) < limit else held).append(other)
+        if held:
+            self.held[host] = held
+        now = time.monotonic()
+        due = sorted(e for e in self._heap if e[5] == entry[5] and e[0] <= now)[:limit - len(batch)]
+        if due:
+            taken = set(id(e) for e in due)
+            self._heap = [e for e in self._heap if id(e) not in taken]
+            heapq.heapify(self._heap)
+        return batch + due
+
+    def _run(self):
+        """
+        Event loop of a worker thread
+        :return: None
+        """
+        while True:
+            with self.lock:
+                entry = self._next()
+                if entry is None:
+                    return
+                entries = [entry] + self._take_batch(entry)
+                for e in entries:
+                    self._uncount(e)
+                    self.active.add(e[2])
+                self.busy[entry[3]] += 1
+                self.changed.notify_all()  # Space for jobs waiting in put
+            try:
+                self._attempt(entries)
+            except Exception as e:  # Bookkeeping failed, the jobs stay in the outbox for the next startup
+                self.logs.log_error("Transfer worker error: {}".format(e))
+                self.logs.log_error(traceback.format_exc())
+            finally:
+                with self.lock:
+                    for e in entries:
+                        self.active.discard(e[2])
+                    self.busy[entry[3]] -= 1
+                    for e in self.blocked.pop(entry[3], []):  # The host can take another send
+                        self._count(e)
+                        heapq.heappush(self._heap, e)
+                    self.changed.notify_all()
+
+    def _attempt(self, entries):
+        """
+        Sends jobs for the same host and decides what happens to the ones that failed
+        :param entries: Entries of the jobs
+        :return: None
+        """
+        paths = [e[2] for e in entries]
+        host = entries[0][3]
+        try:
+            results = self.send(paths)
+        except Exception as e:
+            results = {path: e for path in paths}
+        errors = [results.get(path) for path in paths]
+        with self.lock:
+            breaker = self.breakers[host]
+            if any(e is None or isinstance(e, RemoteStepError) for e in errors):  # The host answered
+                if breaker.success():
+                    self.logs.log_debug("{} is reachable again, sending its waiting jobs".format(host))
+            elif any(isinstance(e, TRANSPORT_ERRORS) for e in errors):
+                if breaker.failure(time.monotonic()):
+                    self.logs.log_error("{} looks down, holding its jobs for {:.0f} seconds".format(
+                        host, breaker.cooldown))
+            else:  # Failed before reaching the host, nothing was learned about it
+                breaker.release(time.monotonic())
+        for path, error in zip(paths, errors):
+            if error is None:
+                self.on_done(path, True)
+            elif isinstance(error, PERMANENT_ERRORS):
+                self.logs.log_error("Transfer of {} failed and will not be retried: {}".format(
+                    os.path.basename(path), error))
+                self.on_done(path, False)
+            else:
+                self._failed(path, error)
+
+    def _failed(self, path, error):
+        """
+        Records a failed attempt and retries the job after a backoff, or fails it once its retries are used up
+        :param path: Path to the job
+        :param error: Exception the transfer failed with
+        :return: None
+        """
+        name = os.path.basename(path)
+        attempts, first = self._attempts(path)
+        attempts += 1
+        first = time.time() if first is None else float(first)
+        with JobData(path) as jd:
+            jd.data[constants.TRANSFER_ATTEMPTS] = attempts
+            jd.data[constants.TRANSFER_FIRST_FAILURE] = first
+        if attempts >= constants.TRANSFER_RETRY_LIMIT or \
+                time.time() - first >= constants.TRANSFER_RETRY_HOURS * 3600:
+            self.logs.log_error("Transfer of {} failed {} times since {}, giving up: {}".format(
+                name, attempts, time.ctime(first), error))
+            self.on_done(path, False)
+            return
+        delay = backoff(attempts)
+        self.logs.log_error("Transfer of {} failed (attempt {} of {}), retrying in {:.0f} seconds: {}".format(
+            name, attempts, constants.TRANSFER_RETRY_LIMIT, delay, error))
+        with self.lock:
+            if self.running:
+                self._push(path, time.monotonic() + delay)
+
+    def __len__(self):
+        """
+        Gets the number of jobs waiting to be sent, including the ones being sent
+        :return: Number of jobs
+        """
+        with self.lock:
+            waiting = list(self.held.values()) + list(self.blocked.values())
+            return len(self._heap) + sum(len(entries) for entries in waiting) + len(self.active)
+
+    def retrying(self):
+        """
+        Gets the number of queued jobs that failed before
+        :return: Number of jobs
+        """
+        with self.lock:
+            waiting = self._heap + [e for entries in list(self.held.values()) + list(self.blocked.values())
+                                    for e in entries]
+            return sum(1 for e in waiting if not e[4])
+
+    def sending(self):
+        """
+        Gets the number of sends in progress to every host
+        :return: Dict of host -> sends
+        """
+        with self.lock:
+            return {host: n for host, n in self.busy.items() if n}
+
+    def hosts_down(self):
+        """
+        Gets the hosts whose breaker is open
+        :return: List of host names
+        """
+        with self.lock:
+            return sorted(host for host, b in self.breakers.items() if b.state != CircuitBreaker.CLOSED)
@@ -0,0 +1,246 @@
+"""
+warm_worker.py
+Author: Ian Smith
+Description: Server side of the long lived segmentation workers (seg_worker.py). A WarmWorker is one worker process
+that is sent jobs over its stdin/stdout pipes. The WarmWorkerPool hands workers out to the processing threads and
+restarts them when they crash, grow past the memory limit or have run too many jobs.
+"""
+import constants
+from supervisor import JobKilledError, JobTimeoutError
+
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+
+
+class WorkerCrashedError(Exception):
+    """
+    Raised when a warm worker exits or stops following the protocol while it is running a job
+    """
+    pass
+
+
+class WarmWorker:
+    """
+    A class to control a single seg_worker.py process
+    """
+    def __init__(self, logger, python, script):
+        """
+        Constructor method, starts the worker process and waits for it to be ready
+        :param logger: Injected Logger from ip_logging
+        :param python: Python interpreter of the segmentation environment
+        :param script: Path to segment.py
+        """
+        self.logs = logger
+        self.jobs = 0
+        self._next_id = 0
+        self.killed = False  # Set when the worker is killed while running a job, by a skip or a timeout
+        self.timed_out = False
+        cmd = [python, constants.WARM_WORKER_SCRIPT, script]
+        if constants.WARM_WORKER_CACHE_WEIGHTS:
+            cmd.append("--cache-weights")
+        # Own session so kill() also takes down anything the worker started
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1,
+                                        start_new_session=True)
+        ready = self._read()
+        if not ready.get("ready"):
+            self.kill()
+            raise WorkerCrashedError("Warm worker did not start: {}".format(ready))
+        self.logs.log_debug("Started warm segmentation worker {}".format(self.process.pid))
+
+    def _read(self):
+        """
+        Reads one response from the worker
+        :return: Decoded response
+        :raises WorkerCrashedError: if the worker exited or sent something that is not a response
+        """
+        line = self.process.stdout.readline()
+        if not line:
+            self.process.wait()
+            raise WorkerCrashedError("Warm worker exited with code {}".format(self.process.returncode))
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise WorkerCrashedError("Warm worker sent an invalid response: {!r}".format(line))
+
+    def run(self, argv, timeout=None):
+        """
+        Runs segment.py in the worker
+        :param argv: Arguments for segment.py
+        :param timeout: Max time the job may take in seconds, the worker is killed after that
+        :return: Return code of segment.py
+        :raises WorkerCrashedError: if the worker died while running the job
+        :raises JobTimeoutError: if the job took longer than the timeout
+        :raises JobKilledError: if the worker was killed while running the job
+        """
+        self._next_id += 1
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            self.process.stdin.write(json.dumps({"id": self._next_id, "argv": argv}) + "\n")
+            self.process.stdin.flush()
+            response = self._read()
+        except (BrokenPipeError, OSError, WorkerCrashedError) as e:
+            if self.timed_out:
+                raise JobTimeoutError("segment.py ran for more than {} seconds and was killed".format(timeout))
+            if self.killed:
+                raise JobKilledError("Warm worker was killed while running a job")
+            if isinstance(e, WorkerCrashedError):
+                raise
+            raise WorkerCrashedError("Could not send job to warm worker: {}".format(e))
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self.jobs += 1
+        if response.get("error"):
+            self.logs.log_error("segment.py failed in warm worker: {}".format(response["error"]))
+        return response.get("returncode", 1)
+
+    def rss_gb(self):
+        """
+        Gets the resident memory of the worker from /proc
+        :return: Resident memory in GB, None if it cannot be read
+        """
+        try:
+            with open("/proc/{}/status".format(self.process.pid), "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / (1024 * 1024)
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def is_healthy(self):
+        """
+        Checks if the worker can take another job
+        :return: False if the worker exited, has run WARM_WORKER_MAX_JOBS jobs or uses more than WARM_WORKER_MAX_RSS_GB
+        """
+        if self.process.poll() is not None:
+            return False
+        if constants.WARM_WORKER_MAX_JOBS and self.jobs >= constants.WARM_WORKER_MAX_JOBS:
+            return False
+        rss = self.rss_gb()
+        if rss is not None and constants.WARM_WORKER_MAX_RSS_GB and rss > constants.WARM_WORKER_MAX_RSS_GB:
+            self.logs.log_debug("Warm worker {} is using {:.1f} GB, recycling it".format(self.process.pid, rss))
+            return False
+        return True
+
+    def stop(self):
+        """
+        Asks the worker to exit by closing its stdin, kills it if it does not
+        :return: None
+        """
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def _expire(self):
+        """
+        Timer callback, kills the worker when a job runs past its timeout
+        :return: None
+        """
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        """
+        Kills the worker and its process group, can be called from any thread
+        :return: None
+        """
+        self.killed = True
+        if self.process.returncode is None:  # Not reaped yet, so the process group id is still ours
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            self.process.wait()
+
+
+class WarmWorkerPool:
+    """
+    A class to hand out warm workers, at most constants.WARM_WORKERS of them are kept alive
+    """
+    def __init__(self, logger, python=None, script=None, size=None):
+        """
+        Constructor method, workers are started on first use
+        :param logger: Injected Logger from ip_logging
+        :param python: Python interpreter of the segmentation environment, defaults to constants.RAD_TIB_PATH_TO_ENV
+        :param script: Path to segment.py, defaults to constants.RAD_TIB_PATH_TO_START
+        :param size: Max number of workers, defaults to constants.WARM_WORKERS
+        """
+        self.logs = logger
+        self.python = constants.RAD_TIB_PATH_TO_ENV if python is None else python
+        self.script = constants.RAD_TIB_PATH_TO_START if script is None else script
+        self.size = constants.WARM_WORKERS if size is None else size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.busy = set()
+        self.failed_at = None  # Time the last worker failed to start, starting is not retried right away
+
+    def checkout(self):
+        """
+        Takes an idle worker, starting a new one if the pool is not full
+        :return: WarmWorker, None if every worker is busy or workers can not be started
+        """
+        with self.lock:
+            while self.idle:
+                worker = self.idle.pop()
+                if worker.is_healthy():
+                    self.busy.add(worker)
+                    return worker
+                worker.stop()
+            if len(self.busy) >= self.size:
+                return None
+            if self.failed_at is not None and time.time() - self.failed_at < constants.WARM_WORKER_RETRY_TIME:
+                return None
+            placeholder = object()
+            self.busy.add(placeholder)  # Holds the slot while the worker starts outside the lock
+        try:
+            worker = WarmWorker(self.logs, self.python, self.script)
+        except (OSError, WorkerCrashedError) as e:
+            self.logs.log_error("Could not start warm segmentation worker, using one-shot processes: {}".format(e))
+            with self.lock:
+                self.busy.discard(placeholder)
+                self.failed_at = time.time()
+            return None
+        with self.lock:
+            self.busy.discard(placeholder)
+            self.busy.add(worker)
+            self.failed_at = None
+        return worker
+
+    def checkin(self, worker, crashed=False):
+        """
+        Returns a worker to the pool, workers that crashed or are no longer healthy are stopped
+        :param worker: WarmWorker from checkout
+        :param crashed: True if the worker crashed while running a job
+        :return: None
+        """
+        with self.lock:
+            self.busy.discard(worker)
+            if not crashed and worker.is_healthy() and len(self.idle) < self.size:
+                self.idle.append(worker)
+                return
+        if crashed:
+            worker.kill()
+        else:
+            worker.stop()
+
+    def kill_all(self):
+        """
+        Kills every worker, used on shutdown
+        :return: None
+        """
+        with self.lock:
+            workers = self.idle + [w for w in self.busy if isinstance(w, WarmWorker)]
+            self.idle = []
+        for worker in workers:
+            worker.kill()
@@ -0,0 +1,192 @@
+"""
+watcher.py
+Author: Ian Smith
+Description: Contains the DirectoryWatcher class which is used to wake the ingest loop when files are written into a
+directory. Uses inotify on linux and falls back to polling the directory when inotify is not available.
+"""
+import constants
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+
+
+# inotify flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class DirectoryWatcher:
+    """
+    A class to wait for files to be finished writing or moved into a directory
+    """
+    def __init__(self, directory, logger, suffixes=(".yaml",), mode=None):
+        """
+        Constructor method
+        :param directory: Directory to watch
+        :param logger: Injected Logger from ip_logging
+        :param suffixes: File endings (case insensitive) that should wake the watcher, None to wake on every file
+        :param mode: "inotify" or "poll", defaults to constants.WATCH_MODE
+        """
+        self.directory = os.path.abspath(directory)
+        self.logs = logger
+        self.suffixes = None if suffixes is None else tuple(s.lower() for s in suffixes)
+        self.mode = mode if mode is not None else constants.WATCH_MODE
+        self._fd = None
+        self._libc = None
+        self._wake_r, self._wake_w = os.pipe()  # Written to by interrupt to end a wait early
+        self._wake_lock = threading.Lock()  # Keeps interrupt from writing to the pipe while close closes it
+        os.set_blocking(self._wake_r, False)
+        if self.mode == "inotify":
+            self._start_inotify()
+
+    def _start_inotify(self):
+        """
+        Sets up an inotify watch on the directory, falls back to polling on failure
+        :return: None
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, "inotify_add_watch failed on {}".format(self.directory))
+        except (OSError, AttributeError) as e:
+            self.logs.log_error("inotify unavailable, falling back to polling {}: {}".format(self.directory, e))
+            self.mode = "poll"
+            return
+        self._libc = libc
+        self._fd = fd
+        self.logs.log_debug("Watching {} with inotify".format(self.directory))
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a matching file has been written/moved into the directory or the timeout has elapsed
+        :param timeout: Max time to wait in seconds, None to wait forever
+        :return: True if the directory should be scanned, False if the timeout elapsed with nothing new
+        """
+        if self._fd is None:
+            return self._wait_poll(timeout)
+        return self._wait_inotify(timeout)
+
+    def interrupt(self):
+        """
+        Ends a wait in another thread early, used on shutdown
+        :return: None
+        """
+        with self._wake_lock:
+            if self._wake_w is None:  # Closed, nothing is waiting any more
+                return
+            try:
+                os.write(self._wake_w, b"\0")
+            except OSError:  # Pipe full, the waiting thread is being woken anyway
+                pass
+
+    def _interrupted(self):
+        """
+        Empties the wake pipe
+        :return: True if interrupt was called since the last check
+        """
+        try:
+            return len(os.read(self._wake_r, 4096)) > 0
+        except (BlockingIOError, OSError):
+            return False
+
+    def _wait_poll(self, timeout):
+        """
+        Polling fallback, sleeps for the poll interval and then asks for a scan if there are any matching files
+        :param timeout: Max time to wait in seconds
+        :return: True if there are matching files in the directory
+        """
+        interval = constants.POLL_INTERVAL
+        if timeout is not None:
+            interval = min(interval, timeout)
+        select.select([self._wake_r], [], [], interval)
+        if self._interrupted():
+            return False
+        return any(self._matches(f) for f in os.listdir(self.directory))
+
+    def _wait_inotify(self, timeout):
+        """
+        Waits on the inotify file descriptor and reads all of the pending events
+        :param timeout: Max time to wait in seconds
+        :return: True if a matching event was read
+        """
+        try:
+            readable, _, _ = select.select([self._fd, self._wake_r], [], [], timeout)
+        except InterruptedError:
+            return False
+        if self._wake_r in readable:
+            self._interrupted()
+            return False
+        if not readable:
+            return False
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        wake = False
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if mask & IN_Q_OVERFLOW:  # Events were dropped by the kernel, a full scan is needed
+                self.logs.log_error("inotify queue overflowed on {}, rescanning".format(self.directory))
+                wake = True
+            elif mask & IN_IGNORED:  # Watched directory was removed
+                self.logs.log_error("inotify watch on {} removed, falling back to polling".format(self.directory))
+                self._close_inotify()
+                return True
+            elif self._matches(name):
+                wake = True
+        return wake
+
+    def _matches(self, name):
+        """
+        Checks if a file name should wake the watcher
+        :param name: File name
+        :return: True if the file name ends with one of the watched suffixes
+        """
+        return self.suffixes is None or name.lower().endswith(self.suffixes)
+
+    def close(self):
+        """
+        Closes the inotify file descriptor and the wake pipe, the watcher can not be waited on afterwards
+        :return: None
+        """
+        with self._wake_lock:
+            for fd in (self._wake_r, self._wake_w):
+                if fd is not None:
+                    os.close(fd)
+            self._wake_r = self._wake_w = None
+        self._close_inotify()
+
+    def _close_inotify(self):
+        """
+        Closes the inotify file descriptor, the watcher polls from then on
+        :return: None
+        """
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError as e:
+                if e.errno != errno.EBADF:
+                    raise
+            self._fd = None
+            self.mode = "poll"